@@ -35,7 +35,8 @@ def initialize_module(
         True,
         model_path,
         selected_gpu,
-        args['train_last_layers']
+        args['train_last_layers'],
+        shared=False
     )
 
     return training_run, model, args
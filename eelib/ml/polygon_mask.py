@@ -1,21 +1,51 @@
 import cv2
 import numpy as np
 
+# number of (polygons, frame size) masks kept
+MASK_CACHE_SIZE = 64
+masks = {}
+
+
+def get_mask(polygons, height, width):
+    """
+    The mask and the polygons in pixels for polygons with points relative
+    to the frame size. Streams keep the same polygons and frame size, so
+    the mask is drawn once and reused.
+    """
+    key = (
+        tuple(tuple(tuple(point) for point in poly) for poly in polygons),
+        height,
+        width
+    )
+    if key not in masks:
+        if len(masks) >= MASK_CACHE_SIZE:
+            masks.pop(next(iter(masks)))
+
+        resized_polys = np.array([
+            [
+                [int(width * point[0]), int(height * point[1])]
+                 for point in poly]
+            for poly in polygons
+        ])
+        mask = np.zeros((height, width))
+        for poly in resized_polys:
+            cv2.fillPoly(mask, np.int32(np.array([poly])), 1)
+
+        # callers only read the mask
+        mask.setflags(write=False)
+        masks[key] = (mask, np.uint8(mask)[:, :, None], resized_polys)
+
+    return masks[key]
+
+
 def polygon_mask(image, polygons):
     height, width, _ = image.shape
-    resized_polys = np.array([
-        [
-            [int(width * point[0]), int(height * point[1])]
-             for point in poly]
-        for poly in polygons
-    ])
-    mask = np.zeros((height, width))
+    mask, mask_u8, resized_polys = get_mask(polygons, height, width)
     image_with_mask_lines = image.copy()
 
     for poly in resized_polys:
         poly = np.int32(np.array([poly]))
-        cv2.fillPoly(mask, poly, 1)
         cv2.polylines(image_with_mask_lines, poly, 1, (57, 255, 20), 2)
 
-    masked_image = np.uint8(np.multiply(image, np.expand_dims(mask, 2)))
+    masked_image = np.uint8(image) * mask_u8
     return np.uint8(image_with_mask_lines), masked_image, mask
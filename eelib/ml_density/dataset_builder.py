@@ -0,0 +1,82 @@
+import time
+from multiprocessing import Pool
+import eelib.store as store
+import eelib.ml_density.ground_truth as gt
+from eelib.store_utils import make_gt_path, ensure_gt_dir_exists
+
+# number of groundtruths that are inserted (and checkpointed) at once
+CHUNK_SIZE = 100
+
+
+def build_gt_files(task):
+    """
+    Runs in a worker process: computes the groundtruth of one frame and
+    writes the h5 and render files. The database is not touched here.
+    """
+    frame_id, img_path, tags, sigma, beta = task
+    ground_truth = gt.gt_from_tags(img_path, tags, sigma, beta)
+
+    gt_path, gt_render_path = make_gt_path()
+    ensure_gt_dir_exists(gt_path)
+    gt.store_gt(gt_path, ground_truth)
+    gt.store_gt_render(gt_render_path, ground_truth)
+
+    return frame_id, gt_path, gt_render_path
+
+
+def build_density_dataset(
+    frame_ids,
+    dataset,
+    sigma,
+    beta,
+    processes=None,
+    chunk_size=CHUNK_SIZE
+):
+    """
+    Creates the groundtruths for all frames of a density dataset. Frames
+    and tags are fetched in one query, groundtruths are computed and
+    written in a process pool and inserted in chunks. Every inserted chunk
+    is a checkpoint: frames that already have a groundtruth in the dataset
+    are skipped, so a crashed job can be restarted.
+    """
+    done = {row for row in store.get_frame_ids_with_gt_for_dataset(dataset.id)}
+    todo = [frame_id for frame_id in frame_ids if frame_id not in done]
+    print('{} of {} frames already have a groundtruth'.format(
+        len(frame_ids) - len(todo), len(frame_ids)))
+
+    if len(todo) == 0:
+        return 0
+
+    frames = store.get_frames_with_tags_by_ids(todo)
+    tasks = [
+        (
+            frame.id,
+            frame.path,
+            list(zip(frame.tags_x, frame.tags_y)),
+            sigma,
+            beta
+        )
+        for frame in frames
+    ]
+
+    start_time = time.time()
+    inserted = 0
+    rows = []
+    with Pool(processes) as pool:
+        for frame_id, gt_path, gt_render_path in pool.imap_unordered(
+            build_gt_files, tasks, chunksize=4
+        ):
+            rows.append((frame_id, dataset.id, gt_path, gt_render_path))
+            if len(rows) >= chunk_size:
+                inserted += store.insert_gts(rows)
+                rows = []
+                print('created {} of {} groundtruths ({:.1f}/s)'.format(
+                    inserted,
+                    len(tasks),
+                    inserted / (time.time() - start_time)))
+
+    inserted += store.insert_gts(rows)
+    print('created {} groundtruths in {:.1f} seconds'.format(
+        inserted, time.time() - start_time))
+
+    return inserted
@@ -0,0 +1,232 @@
+import os
+import json
+import fcntl
+import numpy as np
+import h5py
+from PIL import Image
+
+IMAGES_FILE = 'images.u8'
+TARGETS_FILE = 'targets.f16'
+INDEX_FILE = 'index.json'
+# the data files are rewritten when more than this fraction is stale
+MAX_STALE_FRACTION = 0.5
+
+
+def get_cache_dir():
+    return os.path.join(os.environ['EAGLE_EYE_PATH'], 'files', 'dataset_cache')
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime, stat.st_size]
+
+
+def entry_key(img_path, gt_path):
+    return '{}|{}'.format(img_path, gt_path)
+
+
+def data_file_names(index):
+    """
+    The images and targets files of the generation in the index. A rewrite
+    of the cache starts a new generation in new files, so files that other
+    jobs have memory-mapped are never truncated.
+    """
+    generation = index.get('generation', 0)
+    if generation == 0:
+        return IMAGES_FILE, TARGETS_FILE
+
+    return tuple(
+        '{}.{}{}'.format(base, generation, extension)
+        for base, extension in [
+            os.path.splitext(IMAGES_FILE), os.path.splitext(TARGETS_FILE)
+        ])
+
+
+class DatasetCache:
+    """
+    Decoded density training samples on disk: one memory-mapped file with
+    the uint8 RGB images, one with the float16 targets and a json index with
+    the offset and size of every sample. target_fn is applied to the density
+    before it is stored, for example to downsample it to the network output.
+
+    Samples are keyed on (image path, ground truth path) and carry the mtime
+    and size of both files, so a changed ground_truths row or a rewritten
+    file is decoded again on the next build.
+    """
+
+    def __init__(self, name, target_fn=None, cache_dir=None):
+        self.path = os.path.join(cache_dir or get_cache_dir(), name)
+        self.target_fn = target_fn
+        self.index = None
+        self.images = None
+        self.targets = None
+
+    def __getstate__(self):
+        # data loader workers open their own memory maps
+        state = self.__dict__.copy()
+        state['images'] = None
+        state['targets'] = None
+        return state
+
+    def file_path(self, name):
+        return os.path.join(self.path, name)
+
+    def read_index(self):
+        try:
+            with open(self.file_path(INDEX_FILE)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {'entries': {}, 'images_size': 0, 'targets_size': 0}
+
+    def write_index(self, index):
+        tmp_path = self.file_path(INDEX_FILE + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, self.file_path(INDEX_FILE))
+
+    def decode(self, img_path, gt_path):
+        image = np.asarray(Image.open(img_path).convert('RGB'), dtype=np.uint8)
+        with h5py.File(gt_path, mode='r') as gt_file:
+            target = np.asarray(gt_file['density'])
+
+        if self.target_fn is not None:
+            target = self.target_fn(target)
+
+        return image, np.ascontiguousarray(target, dtype=np.float16)
+
+    def build(self, data_list):
+        """
+        Makes sure every (img_path, gt_path) in data_list is in the cache.
+        Returns the number of samples that were reused and decoded.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.file_path('.lock'), 'w') as lock:
+            # several training jobs may build the cache of the same dataset
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                index = self.read_index()
+                wanted = {
+                    entry_key(img_path, gt_path): (img_path, gt_path)
+                    for img_path, gt_path in data_list
+                }
+
+                entries = {}
+                for key, (img_path, gt_path) in wanted.items():
+                    entry = index['entries'].get(key)
+                    if entry is not None and entry['signature'] == [
+                        file_signature(img_path), file_signature(gt_path)
+                    ]:
+                        entries[key] = entry
+
+                used = sum(
+                    entry['image'][1] * entry['image'][2] * 3
+                    for entry in entries.values())
+                old_files = []
+                if index['images_size'] > 0 and (
+                    1 - used / index['images_size'] > MAX_STALE_FRACTION
+                ):
+                    # start over in new files instead of keeping mostly
+                    # stale ones, the old files are removed once the new
+                    # index is written
+                    old_files = data_file_names(index)
+                    entries = {}
+                    index['generation'] = index.get('generation', 0) + 1
+                    index['images_size'] = 0
+                    index['targets_size'] = 0
+
+                images_name, targets_name = data_file_names(index)
+                reused = len(entries)
+                with open(self.file_path(images_name), 'ab') as images_file, \
+                        open(self.file_path(targets_name), 'ab') as targets_file:
+                    # drop data written after the index by an interrupted
+                    # build, only the indexed part is ever memory-mapped
+                    images_file.truncate(index['images_size'])
+                    targets_file.truncate(index['targets_size'] * 2)
+                    for key, (img_path, gt_path) in wanted.items():
+                        if key in entries:
+                            continue
+
+                        signature = [
+                            file_signature(img_path), file_signature(gt_path)]
+                        image, target = self.decode(img_path, gt_path)
+                        images_file.write(image.tobytes())
+                        targets_file.write(target.tobytes())
+                        entries[key] = {
+                            'signature': signature,
+                            'image': [index['images_size']] + list(
+                                image.shape[:2]),
+                            'target': [index['targets_size']] + list(
+                                target.shape[:2])
+                        }
+                        index['images_size'] += image.size
+                        index['targets_size'] += target.size
+
+                index['entries'] = entries
+                self.write_index(index)
+
+                for name in old_files:
+                    # jobs that mapped the old files keep reading them
+                    try:
+                        os.remove(self.file_path(name))
+                    except OSError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+        self.index = index
+        self.images = None
+        self.targets = None
+        print('dataset cache {}: reused {} samples, decoded {}'.format(
+            self.path, reused, len(entries) - reused))
+        return reused, len(entries) - reused
+
+    def open(self):
+        if self.index is None:
+            self.index = self.read_index()
+
+        if self.images is None and self.index['images_size'] > 0:
+            try:
+                self.map_files()
+            except FileNotFoundError:
+                # the cache was rewritten after the index was read
+                self.index = self.read_index()
+                self.map_files()
+
+    def map_files(self):
+        images_name, targets_name = data_file_names(self.index)
+        self.images = np.memmap(
+            self.file_path(images_name), dtype=np.uint8, mode='r',
+            shape=(self.index['images_size'],))
+        self.targets = np.memmap(
+            self.file_path(targets_name), dtype=np.float16, mode='r',
+            shape=(self.index['targets_size'],))
+
+    def __contains__(self, img_gt_path):
+        if self.index is None:
+            self.index = self.read_index()
+        return entry_key(*img_gt_path) in self.index['entries']
+
+    def image_size(self, img_path, gt_path):
+        """
+        (width, height) of the image from the index, like PIL's Image.size
+        """
+        if self.index is None:
+            self.index = self.read_index()
+        _, h, w = self.index['entries'][entry_key(img_path, gt_path)]['image']
+        return w, h
+
+    def get(self, img_path, gt_path):
+        """
+        Returns read-only views on the memory maps: the (h, w, 3) uint8
+        image and the float16 target.
+        """
+        self.open()
+        entry = self.index['entries'][entry_key(img_path, gt_path)]
+
+        offset, h, w = entry['image']
+        image = self.images[offset:offset + h * w * 3].reshape(h, w, 3)
+
+        offset, h, w = entry['target']
+        target = self.targets[offset:offset + h * w].reshape(h, w)
+
+        return image, target
@@ -12,9 +12,18 @@ from eelib.ml_density.utils import (
     resize
 )
 from eelib.ml_density.dataset import listDataset as Dataset
+from eelib.ml_density.dataset_cache import DatasetCache
 from eelib.ml_density.train_config import TrainConfig
 
 
+def downsample_target(target):
+    # the density map at the 1/8 resolution of the CSRNet output
+    return cv2.resize(
+        target,
+        (target.shape[1] // 8, target.shape[0] // 8),
+        interpolation=cv2.INTER_CUBIC)*64
+
+
 class Config(TrainConfig):
     def __init__(
         self,
@@ -33,17 +42,33 @@ class Config(TrainConfig):
         self._init_dataloaders(args)
         self._args = args
 
+    def _get_cache(self, args, dataset_id, data_list, enhance):
+        if not args.get('cache_dataset'):
+            return None
+
+        # enhance crops the full resolution target before downsampling it
+        cache = DatasetCache(
+            'csrnet_{}_{}'.format(dataset_id, 'full' if enhance else 'x8'),
+            None if enhance else downsample_target)
+        cache.build(data_list)
+        return cache
+
     def _init_dataloaders(self, args):
         train_list = get_gts_and_frames_in_dataset(
             args['train_dataset_id'])
         val_list = get_gts_and_frames_in_dataset(
             args['val_dataset_id'])
 
+        train_cache = self._get_cache(
+            args, args['train_dataset_id'], train_list, args['enhance'])
+        val_cache = self._get_cache(
+            args, args['val_dataset_id'], val_list, False)
+
         print('num workers', args['workers'])
         self._train_loader = torch.utils.data.DataLoader(
             Dataset(
                 train_list,
-                self._get_load_data(),
+                self._get_load_data(train_cache),
                 enhance=args['enhance'],
                 train=True
             ),
@@ -53,18 +78,23 @@ class Config(TrainConfig):
         self._val_loader = torch.utils.data.DataLoader(
             Dataset(
                 val_list,
-                self._get_load_data(),
+                self._get_load_data(val_cache),
             ),
             num_workers=args['workers'],
             batch_size=args['batch_size'],
         )
 
-    def _get_load_data(self):
+    def _get_load_data(self, cache=None):
         def load_data(img_gt_path, train, enhance):
             img_path, gt_path = img_gt_path
-            img = Image.open(img_path).convert('RGB')
-            gt_file = h5py.File(gt_path, mode='r')
-            target = np.asarray(gt_file['density'])
+            if cache is not None:
+                image, target = cache.get(img_path, gt_path)
+                img = Image.fromarray(image)
+                target = target.astype(np.float32)
+            else:
+                img = Image.open(img_path).convert('RGB')
+                with h5py.File(gt_path, mode='r') as gt_file:
+                    target = np.asarray(gt_file['density'])
 
             if enhance:
                 rand_val = random.randint(0, 100)
@@ -90,10 +120,9 @@ class Config(TrainConfig):
                         target = np.fliplr(target)
                         img = img.transpose(Image.FLIP_LEFT_RIGHT)
 
-            target = cv2.resize(
-                target,
-                (target.shape[1] // 8, target.shape[0] // 8),
-                interpolation=cv2.INTER_CUBIC)*64
+            # a cached target without enhance is downsampled already
+            if cache is None or enhance:
+                target = downsample_target(target)
 
             img = standard_transform(img)
             if self._args['scale_factor'] != 1.0:
@@ -1,7 +1,7 @@
 from eelib.networks.Transformer.datasets.dataset_utils import (
-    img_equal_split,
-    img_equal_unsplit
+    img_equal_split
 )
+from eelib.networks.Transformer.tiled_inference import TiledInference
 import torch
 import math
 import torchvision.transforms as standard_transforms
@@ -11,25 +11,45 @@ from easydict import EasyDict
 import numpy as np
 import h5py
 from eelib.ml_density.dataset import listDataset as Dataset2
+from eelib.ml_density.dataset_cache import DatasetCache
 from eelib.ml_density.train_config import TrainConfig
 from eelib.ml_density.utils import (
     get_gts_and_frames_in_dataset
 )
 
 
-def filter_data(data_list, crop_size):
-    def big_enough(img_path):
-        img = Image.open(img_path).convert('RGB')
-        img_w, img_h = img.size
+def filter_data(data_list, crop_size, cache=None):
+    def big_enough(img_path, den_path):
+        if cache is not None:
+            img_w, img_h = cache.image_size(img_path, den_path)
+        else:
+            # only reads the header, the image is not decoded
+            with Image.open(img_path) as img:
+                img_w, img_h = img.size
         return img_w > crop_size and img_h > crop_size
 
     filtered = [
         (img_path, den_path) for img_path, den_path
-        in data_list if big_enough(img_path)
+        in data_list if big_enough(img_path, den_path)
     ]
     return filtered
 
 
+def load_img_target(img_gt_path, cache=None):
+    img_path, gt_path = img_gt_path
+    if cache is not None:
+        image, target = cache.get(img_path, gt_path)
+        return (
+            Image.fromarray(image),
+            Image.fromarray(target.astype(np.float32))
+        )
+
+    img = Image.open(img_path).convert('RGB')
+    with h5py.File(gt_path, mode='r') as gt_file:
+        target = Image.fromarray(np.asarray(gt_file['density']))
+    return img, target
+
+
 class Config(TrainConfig):
 
     def __init__(self, model, args):
@@ -61,8 +81,17 @@ class Config(TrainConfig):
             args['train_dataset_id'])
         unfiltered_val_list = get_gts_and_frames_in_dataset(
             args['val_dataset_id'])
-        train_list = filter_data(unfiltered_train_list, crop_size)
-        val_list = filter_data(unfiltered_val_list, crop_size)
+
+        train_cache, val_cache = None, None
+        if args.get('cache_dataset'):
+            train_cache = DatasetCache(
+                'vicct_{}'.format(args['train_dataset_id']))
+            train_cache.build(unfiltered_train_list)
+            val_cache = DatasetCache('vicct_{}'.format(args['val_dataset_id']))
+            val_cache.build(unfiltered_val_list)
+
+        train_list = filter_data(unfiltered_train_list, crop_size, train_cache)
+        val_list = filter_data(unfiltered_val_list, crop_size, val_cache)
 
         self._print_filtered_number(
             len(unfiltered_train_list),
@@ -79,7 +108,7 @@ class Config(TrainConfig):
         self._train_loader = torch.utils.data.DataLoader(
             Dataset2(
                 train_list,
-                self._get_load_data(crop_size)
+                self._get_load_data(crop_size, train_cache)
             ),
             num_workers=args['workers'],
             batch_size=args['batch_size'],
@@ -87,13 +116,13 @@ class Config(TrainConfig):
         self._val_loader = torch.utils.data.DataLoader(
             Dataset2(
                 val_list,
-                self._get_load_data_val(crop_size)
+                self._get_load_data_val(crop_size, val_cache)
             ),
             num_workers=args['workers'],
             batch_size=1
         )
 
-    def _get_load_data_val(self, crop_size):
+    def _get_load_data_val(self, crop_size, cache=None):
         img_transform = standard_transforms.Compose([
             standard_transforms.ToTensor(),
             standard_transforms.Normalize(
@@ -105,10 +134,7 @@ class Config(TrainConfig):
         ])
 
         def load_data_val(img_gt_path, train, enhance):
-            img_path, gt_path = img_gt_path
-            img = Image.open(img_path).convert('RGB')
-            gt_file = h5py.File(gt_path, mode='r')
-            target = Image.fromarray(np.asarray(gt_file['density']))
+            img, target = load_img_target(img_gt_path, cache)
 
             img = img_transform(img)
             target = gt_transform(target)
@@ -126,7 +152,7 @@ class Config(TrainConfig):
 
         return load_data_val
 
-    def _get_load_data(self, crop_size):
+    def _get_load_data(self, crop_size, cache=None):
         train_cropper = own_transforms.Compose([
                 own_transforms.RandomTensorCrop([
                     crop_size,
@@ -149,10 +175,7 @@ class Config(TrainConfig):
         ])
 
         def load_data(img_gt_path, train, enhance):
-            img_path, gt_path = img_gt_path
-            img = Image.open(img_path).convert('RGB')
-            gt_file = h5py.File(gt_path, mode='r')
-            target = Image.fromarray(np.asarray(gt_file['density']))
+            img, target = load_img_target(img_gt_path, cache)
 
             img, target = train_main_transform(img, target)
             img = train_img_transform(img)
@@ -210,27 +233,20 @@ class Config(TrainConfig):
 
         _, img_h, img_w = img.shape
 
-        pred_den = model(img_stack)
-        loss = self._criterion(pred_den, gt_stack.cuda())
-        losses['loss'].append(loss.cpu().item())
-        pred_den = pred_den.cpu()
-
-        gt = img_equal_unsplit(
-            gt_stack,
-            self._data.OVERLAP,
-            self._data.IGNORE_BUFFER,
-            img_h,
-            img_w,
-            1
-        )
-        den = img_equal_unsplit(
-            pred_den,
+        tiled_inference = TiledInference(
+            model,
+            img_stack.shape[-1],
             self._data.OVERLAP,
             self._data.IGNORE_BUFFER,
-            img_h,
-            img_w,
-            1
+            self._data.BATCH_SIZE
         )
+        gt_stack = gt_stack.cuda()
+        pred_den = tiled_inference.predict_crops(img_stack)
+        loss = self._criterion(pred_den, gt_stack)
+        losses['loss'].append(loss.cpu().item())
+
+        gt = tiled_inference.unsplit(gt_stack, img_h, img_w)
+        den = tiled_inference.unsplit(pred_den, img_h, img_w)
         den = den.squeeze(0)  # Remove channel dim
 
         pred_cnt = den.sum() / self._data.LABEL_FACTOR
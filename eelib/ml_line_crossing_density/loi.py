@@ -188,6 +188,182 @@ def select_regions_v2(dot1, dot2, d_width, d_height):
     return regions
 
 
+def region_bounds(region):
+    points = np.array(region[0:4])
+    return np.min(points[:, 0]), np.max(points[:, 0]), \
+        np.min(points[:, 1]), np.max(points[:, 1])
+
+
+class RegionIndex:
+    """
+    Packed index of the pixels of all regions of one or more LOIs. Only the
+    pixels with a non zero mask weight are stored, since the others never
+    take part in the pixelwise sums. All region sums of a frame are then
+    computed in a single vectorized pass, with numpy arrays or with torch
+    tensors on the device the maps are already on.
+    """
+
+    def __init__(self, pixel_index, weights, region_ids, normals, distances,
+                 widths, region_counts):
+        self.pixel_index = pixel_index
+        self.weights = weights
+        self.region_ids = region_ids
+        self.normals = normals
+        self.distances = distances
+        self.widths = widths
+        # regions per (LOI, side), used to split the flat result again
+        self.region_counts = region_counts
+        self.device_cache = {}
+
+    @staticmethod
+    def build(calculator, result_width, result_height, offset_x=0, offset_y=0):
+        pixel_index, weights, region_ids, distances = [], [], [], []
+        normals, widths, region_counts = [], [], []
+
+        region_id = 0
+        for i, side_regions in enumerate(calculator.regions):
+            for o, region in enumerate(side_regions):
+                cropped_mask = calculator.masks[i][o]
+                min_x, max_x, min_y, max_y = region_bounds(region)
+
+                # Same slicing as the counting result gets in the region loops
+                rows = np.arange(result_height)[min_y - offset_y:max_y - offset_y]
+                cols = np.arange(result_width)[min_x - offset_x:max_x - offset_x]
+                cropped_mask = cropped_mask[:len(rows), :len(cols)]
+
+                mask_rows, mask_cols = np.nonzero(cropped_mask)
+                pixel_index.append(
+                    rows[mask_rows] * result_width + cols[mask_cols])
+                weights.append(cropped_mask[mask_rows, mask_cols])
+                region_ids.append(np.full(len(mask_rows), region_id))
+                distances.append(
+                    calculator.distance_grid[rows[mask_rows], cols[mask_cols]]
+                    if calculator.crop_processing is False
+                    else np.zeros(len(mask_rows)))
+
+                direction = np.array([
+                    region[1][0] - region[2][0],
+                    region[1][1] - region[2][1]
+                ]).astype(np.float32)
+                normals.append(direction / np.linalg.norm(direction))
+                widths.append(region[4])
+                region_id += 1
+
+            region_counts.append(len(side_regions))
+
+        return RegionIndex(
+            np.concatenate(pixel_index).astype(np.int64),
+            np.concatenate(weights).astype(np.float32),
+            np.concatenate(region_ids).astype(np.int64),
+            np.array(normals, dtype=np.float32).reshape(-1, 2),
+            np.concatenate(distances).astype(np.float32),
+            np.array(widths, dtype=np.float32),
+            region_counts
+        )
+
+    @staticmethod
+    def concat(indexes):
+        """ Combine the indexes of several LOIs on the same image size. """
+        region_offsets = np.cumsum([0] + [len(index.widths) for index in indexes])
+        return RegionIndex(
+            np.concatenate([index.pixel_index for index in indexes]),
+            np.concatenate([index.weights for index in indexes]),
+            np.concatenate([
+                index.region_ids + offset
+                for index, offset in zip(indexes, region_offsets)
+            ]),
+            np.concatenate([index.normals for index in indexes]),
+            np.concatenate([index.distances for index in indexes]),
+            np.concatenate([index.widths for index in indexes]),
+            [count for index in indexes for count in index.region_counts]
+        )
+
+    def _arrays(self, like):
+        if not torch.is_tensor(like):
+            return (self.pixel_index, self.weights, self.region_ids,
+                    self.normals, self.distances, self.widths)
+
+        if like.device not in self.device_cache:
+            self.device_cache[like.device] = tuple(
+                torch.from_numpy(array).to(like.device)
+                for array in (self.pixel_index, self.weights, self.region_ids,
+                              self.normals, self.distances, self.widths))
+        return self.device_cache[like.device]
+
+    def _region_sum(self, values, region_ids, like):
+        if torch.is_tensor(like):
+            return torch.zeros(
+                len(self.widths), dtype=values.dtype, device=values.device
+            ).index_add_(0, region_ids, values)
+        return np.bincount(region_ids, values, minlength=len(self.widths))
+
+    def _prepare(self, counting_result, flow_result):
+        pixel_index, weights, region_ids, normals, distances, widths = \
+            self._arrays(counting_result)
+
+        cc_part = counting_result.reshape(-1)[pixel_index] * weights
+        flow = flow_result.reshape(-1, 2)[pixel_index]
+        perp = (flow * normals[region_ids]).sum(1)
+        fe_part = perp * weights
+
+        # Get all the movement towards the line
+        threshold = 0.5
+        towards_pixels = fe_part > threshold
+
+        # Too remove some noise
+        total_crowd = self._region_sum(cc_part, region_ids, counting_result)
+        towards_count = self._region_sum(
+            towards_pixels * 1.0, region_ids, counting_result)
+        valid = (towards_count > 0) & (total_crowd >= 0)
+
+        return cc_part, fe_part, towards_pixels, valid, region_ids, \
+            distances, widths
+
+    def pixelwise(self, counting_result, flow_result):
+        cc_part, fe_part, towards_pixels, valid, region_ids, _, widths = \
+            self._prepare(counting_result, flow_result)
+
+        sums = self._region_sum(
+            fe_part * cc_part * towards_pixels, region_ids, counting_result)
+        return sums / widths * valid
+
+    def cross_pixelwise(self, counting_result, flow_result):
+        cc_part, fe_part, towards_pixels, valid, region_ids, distances, _ = \
+            self._prepare(counting_result, flow_result)
+
+        crossing_pixels = towards_pixels & (fe_part > distances)
+        sums = self._region_sum(
+            cc_part * crossing_pixels, region_ids, counting_result)
+        return sums * valid
+
+    def split(self, sums):
+        """
+        Split a flat result in the (side 1, side 2) lists of every LOI.
+        """
+        if torch.is_tensor(sums):
+            sums = sums.cpu().numpy()
+
+        per_side = []
+        start = 0
+        for count in self.region_counts:
+            per_side.append([float(value) for value in sums[start:start + count]])
+            start += count
+
+        return [
+            (per_side[idx], per_side[idx + 1])
+            for idx in range(0, len(per_side), 2)
+        ]
+
+
+def pixelwise_forward_all(region_index, counting_result, flow_result):
+    """
+    pixelwise_forward for all LOIs in region_index (see RegionIndex.concat)
+    in one pass. Returns the (side 1, side 2) sums of every LOI.
+    """
+    return region_index.split(
+        region_index.pixelwise(counting_result, flow_result))
+
+
 class LOI_Calculator:
     def __init__(self, point1, point2, img_width, img_height, crop_processing=False,
                  loi_version='v1', loi_width=20, loi_height=20, loi_regions=6):
@@ -212,6 +388,7 @@ class LOI_Calculator:
         self.loi_width = loi_width
         self.loi_regions = loi_regions
         self.distance_grid = None
+        self.region_index = None
 
     def create_regions(self):
         # Generate the original regions as well for later usage
@@ -220,16 +397,25 @@ class LOI_Calculator:
         else:
             self.regions = select_regions_v2(self.point1, self.point2, d_width=self.loi_width, d_height=self.loi_height)
 
+        # Only keep the part of the mask that covers the region
         self.masks = ([], [])
         for i, small_regions in enumerate(self.regions):
             for o, region in enumerate(small_regions):
                 mask = region_to_mask(region, self.rotate_angle, img_width=self.img_width, img_height=self.img_height)
-                self.masks[i].append(mask)
+                min_x, max_x, min_y, max_y = region_bounds(region)
+                self.masks[i].append(mask[min_y:max_y, min_x:max_x])
 
         self.distance_grid = self._generate_distance_grid()
 
         self.cropped_frame = select_line_outer_points(self.regions, self.crop_distance, self.img_width, self.img_height)
 
+        orig_width, orig_height = self.orig_sizes()
+        offset_x, offset_y = 0, 0
+        if self.crop_processing is not False:
+            offset_x, offset_y = self.cropped_frame[0], self.cropped_frame[2]
+        self.region_index = RegionIndex.build(
+            self, orig_width, orig_height, offset_x, offset_y)
+
     def reshape_image(self, frame):
         if self.crop_processing is False:
             return frame
@@ -313,7 +499,8 @@ class LOI_Calculator:
                 #                                                         crop['height'])
                 #     lc_min_x, lc_max_x, lc_min_y, lc_max_y = min_x - adjust_x, max_x - adjust_x, min_y - adjust_y, max_y - adjust_y
 
-                cropped_mask = mask[min_y:max_y, min_x:max_x]
+                # The stored masks are already cropped to the region
+                cropped_mask = mask
 
                 # Use cropped mask on crowd counting result
                 cc_part = cropped_mask * counting_result[lc_min_y:lc_max_y, lc_min_x:lc_max_x]
@@ -357,111 +544,14 @@ class LOI_Calculator:
         return sums
 
     def pixelwise_forward(self, counting_result, flow_result):
-        sums = ([], [])
-
-        for i, side_regions in enumerate(self.regions):
-            for o, region in enumerate(side_regions):
-                mask = self.masks[i][o]
-
-                # Get which part of the mask contains the actual mask
-                # This massively improves the speed of the model
-                points = np.array(region[0:4])
-
-                # Get the crop for the regions
-                min_x, max_x, min_y, max_y = np.min(points[:, 0]), np.max(points[:, 0]), \
-                                             np.min(points[:, 1]), np.max(points[:, 1])
-
-                # lc_min_x, lc_max_x, lc_min_y, lc_max_y = min_x, max_x, min_y, max_y
-                # Adjust the crop if we crop the prediction image as well
-                if self.crop_processing is False:
-                    lc_min_x, lc_max_x, lc_min_y, lc_max_y = min_x, max_x, min_y, max_y
-                else:
-                    adjust_x, _, adjust_y, _ = self.cropped_frame
-                    lc_min_x, lc_max_x, lc_min_y, lc_max_y = min_x - adjust_x, max_x - adjust_x, min_y - adjust_y, max_y - adjust_y
-
-                cropped_mask = mask[min_y:max_y, min_x:max_x]
-
-                # Use cropped mask on crowd counting result
-                cc_part = cropped_mask * counting_result[lc_min_y:lc_max_y, lc_min_x:lc_max_x]
-
-                # Project the flow estimation output on a line perpendicular to the LOI,
-                # so we can calculate if the people are approach/leaving the LOI.
-                direction = np.array([region[1][0] - region[2][0], region[1][1] - region[2][1]]).astype(
-                    np.float32)
-                direction = direction / np.linalg.norm(direction)
-
-                # Crop so only cropped area gets projected
-                part_flow_result = flow_result[lc_min_y:lc_max_y, lc_min_x:lc_max_x]
-
-                # Project on direction of pedestrians
-                perp = np.sum(np.multiply(part_flow_result, direction), axis=2)
-                fe_part = cropped_mask * perp
-
-                # Get all the movement towards the line
-                threshold = 0.5
-                towards_pixels = fe_part > threshold
-
-                # Too remove some noise
-                if towards_pixels.sum() == 0 or cc_part.sum() < 0:
-                    sums[i].append(0.0)
-                    continue
-
-                sums[i].append(np.multiply(fe_part[towards_pixels], cc_part[towards_pixels]).sum() / region[4])
-
-        return sums
+        # Works on numpy arrays or on torch tensors (also on the GPU)
+        return self.region_index.split(
+            self.region_index.pixelwise(counting_result, flow_result))[0]
 
     def cross_pixelwise_forward(self, counting_result, flow_result):
         if self.crop_processing is True:
             print("Crossing is not optimized for cropping")
             exit()
-            
-        sums = ([], [])
-
-        for i, side_regions in enumerate(self.regions):
-            for o, region in enumerate(side_regions):
-                mask = self.masks[i][o]
-
-                # Get which part of the mask contains the actual mask
-                # This massively improves the speed of the model
-                points = np.array(region[0:4])
-
-                # Get the crop for the regions
-                min_x, max_x, min_y, max_y = np.min(points[:, 0]), np.max(points[:, 0]), \
-                                             np.min(points[:, 1]), np.max(points[:, 1])
-
-                lc_min_x, lc_max_x, lc_min_y, lc_max_y = min_x, max_x, min_y, max_y
-                
-                cropped_mask = mask[min_y:max_y, min_x:max_x]
-
-                # Use cropped mask on crowd counting result
-                cc_part = cropped_mask * counting_result[lc_min_y:lc_max_y, lc_min_x:lc_max_x]
 
-                # Project the flow estimation output on a line perpendicular to the LOI,
-                # so we can calculate if the people are approach/leaving the LOI.
-                direction = np.array([region[1][0] - region[2][0], region[1][1] - region[2][1]]).astype(
-                    np.float32)
-                direction = direction / np.linalg.norm(direction)
-
-                # Crop so only cropped area gets projected
-                part_flow_result = flow_result[lc_min_y:lc_max_y, lc_min_x:lc_max_x]
-
-                distance_grid_part = self.distance_grid[lc_min_y:lc_max_y, lc_min_x:lc_max_x]
-
-                # Project on direction of pedestrians
-                perp = np.sum(np.multiply(part_flow_result, direction), axis=2)
-                fe_part = cropped_mask * perp
-
-                # Get all the movement towards the line
-                threshold = 0.5
-                towards_pixels = fe_part > threshold
-
-                # Too remove some noise
-                if towards_pixels.sum() == 0 or cc_part.sum() < 0:
-                    sums[i].append(0.0)
-                    continue
-
-                crossing_pixels = fe_part[towards_pixels] > distance_grid_part[towards_pixels]
-
-                sums[i].append(cc_part[towards_pixels][crossing_pixels].sum())
-
-        return sums
+        return self.region_index.split(
+            self.region_index.cross_pixelwise(counting_result, flow_result))[0]
@@ -83,7 +83,8 @@ def detect_image_2(model, cuda, imgs, batch_size=1, obj_thresh = 0.6, nms_thresh
         if cuda:
             img_tensors = img_tensors.cuda()
 
-        detections, _ = model(img_tensors)
+        with torch.no_grad():
+            detections, _ = model(img_tensors)
         detections = process_result(detections, obj_thresh, nms_thresh)
 
         if len(detections) == 0:
@@ -93,4 +94,26 @@ def detect_image_2(model, cuda, imgs, batch_size=1, obj_thresh = 0.6, nms_thresh
         bboxes.append(detections)
 
     return bboxes
-  
\ No newline at end of file
+  
+
+def detect_images_batched(model, cuda, imgs, obj_thresh=0.6, nms_thresh=0.5):
+    """
+    Runs all images through the model in one forward pass. Returns a list
+    with the detections of every image, in the same order as imgs.
+    """
+    input_size = [416, 416]
+    img_tensors = [cv_image2tensor(img, input_size) for img in imgs]
+    img_tensors = torch.stack(img_tensors)
+    if cuda:
+        img_tensors = img_tensors.cuda()
+
+    with torch.no_grad():
+        detections, _ = model(img_tensors)
+
+    detections = process_result(detections, obj_thresh, nms_thresh)
+
+    if len(detections) == 0:
+        return [[] for _ in imgs]
+
+    detections = transform_result(detections, imgs, input_size)
+    return [detections[detections[:, 0] == idx] for idx in range(len(imgs))]
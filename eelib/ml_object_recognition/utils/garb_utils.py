@@ -9,9 +9,12 @@ import json
 from imageio import imread
 import io
 import base64
+# vectorized objectness score filtering and non max suppression
+from eelib.ml_object_recognition.utils.postprocess import process_result
 
-# conduct objectness score filtering and non max supperssion
-def process_result(detection, obj_threshhold, nms_threshhold):
+# conduct objectness score filtering and non max supperssion, one box at a
+# time. Kept as the reference for the vectorized process_result
+def process_result_reference(detection, obj_threshhold, nms_threshhold):
     detection = detection.cpu()
     detection = to_corner(detection)
     output = torch.tensor([], dtype=torch.float)
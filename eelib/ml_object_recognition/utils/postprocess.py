@@ -0,0 +1,224 @@
+import time
+import numpy as np
+import torch
+from scipy.spatial import cKDTree
+
+# above this number of points the violation pairs come from a KD-tree
+# instead of the full distance matrix
+KD_TREE_MIN_POINTS = 512
+
+
+def to_corner(bboxes):
+    # (cx, cy, w, h) to (x1, y1, x2, y2), works for any number of leading dims
+    corners = bboxes.clone()
+    corners[..., 0] = bboxes[..., 0] - bboxes[..., 2] / 2
+    corners[..., 1] = bboxes[..., 1] - bboxes[..., 3] / 2
+    corners[..., 2] = bboxes[..., 0] + bboxes[..., 2] / 2
+    corners[..., 3] = bboxes[..., 1] + bboxes[..., 3] / 2
+    return corners
+
+
+def iou_matrix(boxes):
+    """
+    Pairwise IOU of (x1, y1, x2, y2) boxes, with the inclusive pixel
+    coordinates (+1) of compute_ious in garb_utils.
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    areas = (x2 - x1 + 1) * (y2 - y1 + 1)
+
+    inter_w = torch.clamp(
+        torch.min(x2[:, None], x2[None, :])
+        - torch.max(x1[:, None], x1[None, :]) + 1, 0)
+    inter_h = torch.clamp(
+        torch.min(y2[:, None], y2[None, :])
+        - torch.max(y1[:, None], y1[None, :]) + 1, 0)
+    intersection = inter_w * inter_h
+
+    return intersection / (areas[:, None] + areas[None, :] - intersection)
+
+
+def nms_tensor(boxes, scores, groups, nms_threshhold):
+    """
+    Greedy non max suppression within every group. A box is suppressed at
+    an IOU of nms_threshhold or more, like process_result_reference (the
+    torchvision nms only suppresses above the threshold). The IOUs are
+    computed on the boxes as they are, so they round like the reference.
+    Returns the indices of the kept boxes.
+    """
+    if boxes.shape[0] == 0:
+        return torch.zeros(0, dtype=torch.long)
+
+    order = torch.argsort(scores, descending=True)
+    ious = iou_matrix(boxes[order, :4])
+    same_group = groups[order][:, None] == groups[order][None, :]
+    # a box is suppressed by every earlier (higher scoring) box it overlaps
+    overlaps = torch.triu(
+        (ious >= nms_threshhold) & same_group, diagonal=1)
+
+    keep = torch.ones(order.shape[0], dtype=torch.bool)
+    for idx in range(order.shape[0]):
+        if keep[idx]:
+            keep &= ~overlaps[idx]
+
+    return order[keep]
+
+
+def process_result(detection, obj_threshhold, nms_threshhold):
+    """
+    Vectorized version of garb_utils.process_result_reference: objectness
+    filtering and per image, per class non max suppression over all images
+    of the batch at once. Returns rows of
+    (batch index, x1, y1, x2, y2, objectness, class score, class index)
+    ordered by image, class and objectness like the reference.
+    """
+    detection = to_corner(detection.cpu().float())
+    batch_index = torch.arange(detection.shape[0])[:, None].expand(
+        detection.shape[0], detection.shape[1])
+
+    selected = detection[..., 4] > obj_threshhold
+    bboxes = detection[selected]
+    batch_index = batch_index[selected]
+
+    if bboxes.shape[0] == 0:
+        return torch.tensor([], dtype=torch.float)
+
+    pred_score, pred_index = torch.max(bboxes[:, 5:], 1)
+    groups = batch_index * (bboxes.shape[1] - 5) + pred_index
+
+    keep = nms_tensor(bboxes[:, :4], bboxes[:, 4], groups, nms_threshhold)
+
+    output = torch.cat((
+        batch_index[keep].float().unsqueeze(-1),
+        bboxes[keep, :5],
+        pred_score[keep].unsqueeze(-1),
+        pred_index[keep].float().unsqueeze(-1)
+    ), dim=1)
+
+    order = np.lexsort((
+        -output[:, 5].numpy(),
+        output[:, 7].numpy(),
+        output[:, 0].numpy()))
+    return output[torch.from_numpy(order)]
+
+
+def apply_homography(points, M):
+    """
+    points: (3, n) array of homogeneous image coordinates, as passed to
+    apply_proj. Returns the (n, 2) projected points.
+    """
+    projected = np.asarray(M, dtype=np.float64) @ np.asarray(
+        points, dtype=np.float64)
+    return (projected[:2] / projected[2]).T
+
+
+def get_too_close_indices(transformed_points, scaling_factor, min_distance):
+    """
+    Indices of the points that are closer than min_distance (in meters)
+    to any other point.
+    """
+    points = np.asarray(transformed_points, dtype=np.float64)
+    if len(points) < 2:
+        return []
+
+    radius = min_distance * scaling_factor
+    if len(points) < KD_TREE_MIN_POINTS:
+        differences = points[:, None, :] - points[None, :, :]
+        distances = np.sqrt((differences ** 2).sum(-1))
+        np.fill_diagonal(distances, np.inf)
+        return np.nonzero((distances < radius).any(1))[0].tolist()
+
+    pairs = cKDTree(points).query_pairs(radius, output_type='ndarray')
+    if len(pairs) == 0:
+        return []
+
+    # query_pairs includes pairs at exactly the radius
+    distances = np.linalg.norm(points[pairs[:, 0]] - points[pairs[:, 1]], axis=1)
+    pairs = pairs[distances < radius]
+    return np.unique(pairs).tolist()
+
+
+def make_threshold_detection(n_pairs, n_classes):
+    """
+    Detections in pairs with an IOU of exactly 0.5: a 10x10 box inside a
+    10x20 box, with the inclusive areas of compute_ious.
+    """
+    detection = torch.zeros(1, n_pairs * 2, 5 + n_classes)
+    offsets = torch.randint(0, 400, (n_pairs, 2)).float()
+    for idx, (x, y) in enumerate(offsets.tolist()):
+        detection[0, idx * 2, :4] = torch.tensor([x + 4.5, y + 4.5, 9, 9])
+        detection[0, idx * 2 + 1, :4] = torch.tensor([x + 4.5, y + 9.5, 9, 19])
+
+    detection[0, :, 4] = torch.rand(n_pairs * 2) * 0.5 + 0.5
+    classes = torch.randint(0, n_classes, (n_pairs,)).repeat_interleave(2)
+    detection[0, torch.arange(n_pairs * 2), 5 + classes] = 1
+    return detection
+
+
+def benchmark(n_boxes=300, n_classes=80, repeat=10):
+    """
+    Times the vectorized functions against the loop based ones on random
+    detections, run with python -m eelib.ml_object_recognition.utils.postprocess
+    """
+    from eelib.ml_object_recognition.utils.garb_utils import (
+        process_result_reference
+    )
+    from eelib.stream.stream_object import (
+        apply_proj_reference,
+        get_to_close_indices_reference,
+        MIN_DIST_METERS
+    )
+
+    def timed(fn, *args):
+        start = time.time()
+        for _ in range(repeat):
+            result = fn(*args)
+        return result, (time.time() - start) / repeat
+
+    detection = torch.rand(1, n_boxes, 5 + n_classes)
+    detection[..., :2] *= 416
+    detection[..., 2:4] *= 100
+
+    reference, reference_time = timed(
+        process_result_reference, detection, 0.3, 0.5)
+    result, result_time = timed(process_result, detection, 0.3, 0.5)
+    print('nms: {} boxes, reference {:.4f}s, vectorized {:.4f}s, '
+          'same result: {}'.format(
+              n_boxes, reference_time, result_time,
+              reference.shape == result.shape and
+              torch.allclose(reference, result)))
+
+    detection = make_threshold_detection(n_boxes // 2, n_classes)
+    reference = process_result_reference(detection, 0.3, 0.5)
+    result = process_result(detection, 0.3, 0.5)
+    print('nms at the threshold: {} boxes, {} kept, same result: {}'.format(
+        detection.shape[1], result.shape[0],
+        reference.shape == result.shape and
+        torch.allclose(reference, result)))
+
+    points = np.array([
+        np.random.rand(n_boxes) * 1920,
+        np.random.rand(n_boxes) * 1080,
+        np.ones(n_boxes)
+    ])
+    projection = np.array([[1.1, 0.1, 0], [0.05, 0.9, 0], [0, 0, 1]])
+
+    reference, reference_time = timed(apply_proj_reference, points, projection)
+    result, result_time = timed(apply_homography, points, projection)
+    print('homography: {} points, reference {:.4f}s, vectorized {:.4f}s, '
+          'same result: {}'.format(
+              n_boxes, reference_time, result_time,
+              np.allclose(reference, result)))
+
+    reference, reference_time = timed(
+        get_to_close_indices_reference, result, 20)
+    too_close, too_close_time = timed(
+        get_too_close_indices, result, 20, MIN_DIST_METERS)
+    print('distances: {} points, reference {:.4f}s, vectorized {:.4f}s, '
+          'same result: {}'.format(
+              n_boxes, reference_time, too_close_time,
+              sorted(reference) == sorted(too_close)))
+
+
+if __name__ == '__main__':
+    for n_boxes in [50, 300, 1000]:
+        benchmark(n_boxes)
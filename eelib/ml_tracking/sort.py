@@ -15,14 +15,8 @@
 from __future__ import print_function
 
 from numba import jit
-import os.path
 import numpy as np
-from skimage import io
 from scipy.optimize import linear_sum_assignment
-import matplotlib.pyplot as plt
-import glob
-import time
-import argparse
 from filterpy.kalman import KalmanFilter
 
 
@@ -130,6 +124,15 @@ class KalmanBoxTracker(object):
         self.history.append(convert_x_to_bbox(self.kf.x))
         return self.history[-1]
 
+    def advance(self):
+        """
+        Advances the state vector for a frame without detector, this is not
+        counted as a missed detection.
+        """
+        if (self.kf.x[6] + self.kf.x[2]) <= 0:
+            self.kf.x[6] *= 0.0
+        self.kf.predict()
+
     def get_state(self):
         """
         Returns the current bounding box estimate.
@@ -233,3 +236,20 @@ class Sort(object):
         if len(ret) > 0:
             return np.concatenate(ret)
         return np.empty((0, 5))
+
+    def predict(self):
+        """
+        Advances all trackers for a frame that is not run through the detector.
+        Returns the predicted boxes of the confirmed trackers in the format of update.
+        """
+        ret = []
+        for trk in self.trackers:
+            trk.advance()
+            d = trk.get_state()[0]
+            if np.any(np.isnan(d)):
+                continue
+            if (trk.time_since_update < 1) and (trk.hit_streak >= self.min_hits or self.frame_count <= self.min_hits):
+                ret.append(np.concatenate((d, [trk.id + 1], [trk.objclass])).reshape(1, -1))
+        if len(ret) > 0:
+            return np.concatenate(ret)
+        return np.empty((0, 5))
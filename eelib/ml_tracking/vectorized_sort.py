@@ -0,0 +1,346 @@
+import time
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+
+# constant velocity model of sort.KalmanBoxTracker, state (x, y, s, r, vx, vy, vs)
+F = np.array([
+    [1, 0, 0, 0, 1, 0, 0],
+    [0, 1, 0, 0, 0, 1, 0],
+    [0, 0, 1, 0, 0, 0, 1],
+    [0, 0, 0, 1, 0, 0, 0],
+    [0, 0, 0, 0, 1, 0, 0],
+    [0, 0, 0, 0, 0, 1, 0],
+    [0, 0, 0, 0, 0, 0, 1]
+], dtype=np.float64)
+H = np.eye(4, 7)
+
+R = np.eye(4)
+R[2:, 2:] *= 10.
+
+Q = np.eye(7)
+Q[-1, -1] *= 0.01
+Q[4:, 4:] *= 0.01
+
+P_INIT = np.eye(7)
+# high uncertainty for the unobservable initial velocities
+P_INIT[4:, 4:] *= 1000.
+P_INIT *= 10.
+
+
+def boxes_to_z(boxes):
+    """
+    (n, 4) boxes [x1, y1, x2, y2] to (n, 4) measurements [x, y, s, r]
+    """
+    w = boxes[:, 2] - boxes[:, 0]
+    h = boxes[:, 3] - boxes[:, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.stack([
+            boxes[:, 0] + w / 2.,
+            boxes[:, 1] + h / 2.,
+            w * h,
+            w / h
+        ], axis=1)
+
+
+def x_to_boxes(x):
+    """
+    (n, 7) states to (n, 4) boxes [x1, y1, x2, y2]
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        w = np.sqrt(x[:, 2] * x[:, 3])
+        h = x[:, 2] / w
+    return np.stack([
+        x[:, 0] - w / 2.,
+        x[:, 1] - h / 2.,
+        x[:, 0] + w / 2.,
+        x[:, 1] + h / 2.
+    ], axis=1)
+
+
+def iou_matrix(detections, trackers):
+    """
+    (n_detections, n_trackers) IOU of [x1, y1, x2, y2] boxes, float32 like
+    the matrix of sort.associate_detections_to_trackers.
+    """
+    xx1 = np.maximum(detections[:, None, 0], trackers[None, :, 0])
+    yy1 = np.maximum(detections[:, None, 1], trackers[None, :, 1])
+    xx2 = np.minimum(detections[:, None, 2], trackers[None, :, 2])
+    yy2 = np.minimum(detections[:, None, 3], trackers[None, :, 3])
+    wh = np.maximum(0., xx2 - xx1) * np.maximum(0., yy2 - yy1)
+
+    detection_areas = (detections[:, 2] - detections[:, 0]) * (
+        detections[:, 3] - detections[:, 1])
+    tracker_areas = (trackers[:, 2] - trackers[:, 0]) * (
+        trackers[:, 3] - trackers[:, 1])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ious = wh / (
+            detection_areas[:, None] + tracker_areas[None, :] - wh)
+
+    return ious.astype(np.float32)
+
+
+def associate(detections, trackers, iou_threshold=0.3):
+    """
+    Same result as sort.associate_detections_to_trackers: the (m, 2)
+    matches and the unmatched detection and tracker indices, the unmatched
+    detections in the order new trackers are created for them.
+    """
+    if len(trackers) == 0:
+        return (
+            np.empty((0, 2), dtype=int),
+            np.arange(len(detections)),
+            np.empty(0, dtype=int))
+
+    ious = iou_matrix(detections, trackers)
+    rows, cols = linear_sum_assignment(-ious)
+
+    good = ious[rows, cols] >= iou_threshold
+    assigned_detections = np.zeros(len(detections), dtype=bool)
+    assigned_detections[rows] = True
+    assigned_trackers = np.zeros(len(trackers), dtype=bool)
+    assigned_trackers[cols[good]] = True
+
+    unmatched_detections = np.concatenate([
+        np.nonzero(~assigned_detections)[0], rows[~good]]).astype(int)
+
+    return (
+        np.stack([rows[good], cols[good]], axis=1),
+        unmatched_detections,
+        np.nonzero(~assigned_trackers)[0])
+
+
+class VectorizedSort:
+    """
+    SORT with the state of all tracks in contiguous arrays: the Kalman
+    states (n, 7), covariances (n, 7, 7) and the track counters. Predict
+    and update run as one batched matrix product over all tracks and the
+    IOU cost matrix is built with broadcasting, so the cost per frame
+    stays low with hundreds of tracks.
+
+    Drop-in replacement for sort.Sort: same parameters, the same
+    update(dets) and predict() results, without filterpy and numba.
+    """
+
+    count = 0
+
+    def __init__(self, max_age=1, min_hits=3, iou_threshold=0.3):
+        self.max_age = max_age
+        self.min_hits = min_hits
+        self.iou_threshold = iou_threshold
+        self.frame_count = 0
+
+        self.x = np.zeros((0, 7))
+        self.P = np.zeros((0, 7, 7))
+        self.ids = np.zeros(0, dtype=int)
+        self.objclass = np.zeros(0)
+        self.hits = np.zeros(0, dtype=int)
+        self.hit_streak = np.zeros(0, dtype=int)
+        self.age = np.zeros(0, dtype=int)
+        self.time_since_update = np.zeros(0, dtype=int)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def track_ids(self):
+        # ids as returned by update
+        return self.ids + 1
+
+    def keep(self, mask):
+        self.x = self.x[mask]
+        self.P = self.P[mask]
+        self.ids = self.ids[mask]
+        self.objclass = self.objclass[mask]
+        self.hits = self.hits[mask]
+        self.hit_streak = self.hit_streak[mask]
+        self.age = self.age[mask]
+        self.time_since_update = self.time_since_update[mask]
+
+    def advance(self):
+        # the area may not become negative
+        self.x[(self.x[:, 6] + self.x[:, 2]) <= 0, 6] = 0.
+        self.x = self.x @ F.T
+        self.P = F @ self.P @ F.T + Q
+
+    def kalman_update(self, indices, z):
+        x = self.x[indices]
+        P = self.P[indices]
+
+        y = z - x[:, :4]
+        PHT = P[:, :, :4]
+        S = PHT[:, :4, :] + R
+        K = PHT @ np.linalg.inv(S)
+
+        self.x[indices] = x + (K @ y[:, :, None])[:, :, 0]
+        I_KH = np.eye(7) - K @ H
+        self.P[indices] = (
+            I_KH @ P @ I_KH.transpose(0, 2, 1)
+            + K @ R @ K.transpose(0, 2, 1))
+
+    def add(self, dets):
+        n = len(dets)
+        x = np.zeros((n, 7))
+        x[:, :4] = boxes_to_z(dets[:, :4])
+
+        self.x = np.concatenate([self.x, x])
+        self.P = np.concatenate([self.P, np.repeat(P_INIT[None], n, axis=0)])
+        self.ids = np.concatenate([
+            self.ids, np.arange(VectorizedSort.count, VectorizedSort.count + n)])
+        VectorizedSort.count += n
+        self.objclass = np.concatenate([
+            self.objclass,
+            dets[:, 6] if dets.shape[1] > 6 else np.zeros(n)])
+        for name in ['hits', 'hit_streak', 'age', 'time_since_update']:
+            setattr(self, name, np.concatenate([
+                getattr(self, name), np.zeros(n, dtype=int)]))
+
+    def get_result(self):
+        """
+        Confirmed tracks as rows (x1, y1, x2, y2, id, class), in the
+        (reversed) order of sort.Sort.
+        """
+        boxes = x_to_boxes(self.x)
+        selected = (self.time_since_update < 1) & (
+            (self.hit_streak >= self.min_hits) |
+            (self.frame_count <= self.min_hits))
+        if not np.any(selected):
+            return np.empty((0, 6))
+
+        return np.concatenate([
+            boxes[selected],
+            self.track_ids[selected, None],
+            self.objclass[selected, None]
+        ], axis=1)[::-1]
+
+    def update(self, dets):
+        """
+        dets: (n, 5+) array [[x1, y1, x2, y2, score, ..., class], ...],
+        must be called once for each frame, also without detections.
+        Returns the confirmed tracks as (x1, y1, x2, y2, id, class) rows.
+        """
+        dets = np.asarray(dets, dtype=np.float64)
+        if len(dets) == 0:
+            dets = np.empty((0, 7))
+        self.frame_count += 1
+
+        self.advance()
+        self.age += 1
+        self.hit_streak[self.time_since_update > 0] = 0
+        self.time_since_update += 1
+
+        predicted = x_to_boxes(self.x)
+        valid = np.all(np.isfinite(predicted), axis=1)
+        if not np.all(valid):
+            self.keep(valid)
+            predicted = predicted[valid]
+
+        matched, unmatched_dets, _ = associate(
+            dets, predicted, self.iou_threshold)
+
+        if len(matched) > 0:
+            trackers = matched[:, 1]
+            self.time_since_update[trackers] = 0
+            self.hits[trackers] += 1
+            self.hit_streak[trackers] += 1
+            self.kalman_update(trackers, boxes_to_z(dets[matched[:, 0], :4]))
+
+        self.add(dets[unmatched_dets])
+
+        result = self.get_result()
+        self.keep(self.time_since_update <= self.max_age)
+        return result
+
+    def predict(self):
+        """
+        Same as sort.Sort.predict: advances all tracks for a frame without
+        detector, this does not count as a missed detection.
+        """
+        self.advance()
+        result = self.get_result()
+        return result[np.all(np.isfinite(result[:, :4]), axis=1)]
+
+
+def make_scene(n_objects, n_frames, seed=0, miss_rate=0.05):
+    """
+    Detections of n_objects boxes moving with a constant velocity plus
+    noise, with a fraction of the detections missing in every frame.
+    """
+    rng = np.random.RandomState(seed)
+    size = max(1000., np.sqrt(n_objects) * 100)
+    centers = rng.rand(n_objects, 2) * size
+    velocities = rng.randn(n_objects, 2) * 2
+    sizes = rng.rand(n_objects, 2) * 30 + 20
+
+    frames = []
+    for _ in range(n_frames):
+        centers = centers + velocities
+        noisy = centers + rng.randn(n_objects, 2)
+        boxes = np.concatenate([noisy - sizes / 2, noisy + sizes / 2], axis=1)
+        dets = np.concatenate([
+            boxes,
+            rng.rand(n_objects, 1),
+            rng.rand(n_objects, 1),
+            np.zeros((n_objects, 1))
+        ], axis=1)
+        frames.append(dets[rng.rand(n_objects) > miss_rate])
+
+    return frames
+
+
+def normalize_ids(results):
+    # track ids by order of appearance, so trackers with different id
+    # counters can be compared
+    mapping = {}
+    normalized = []
+    for result in results:
+        result = result[np.lexsort(result[:, :4].T[::-1])] if len(
+            result) else result
+        ids = []
+        for track_id in result[:, 4]:
+            mapping.setdefault(track_id, len(mapping))
+            ids.append(mapping[track_id])
+        normalized.append((result[:, :4], ids))
+    return normalized
+
+
+def run_tracker(tracker, frames):
+    start = time.time()
+    results = [tracker.update(dets) for dets in frames]
+    return results, (time.time() - start) / len(frames)
+
+
+def benchmark(n_objects, n_frames=30, reference_max_objects=300):
+    """
+    Times sort.Sort against VectorizedSort on a synthetic scene and checks
+    that both give the same tracks. Run with
+    python -m eelib.ml_tracking.vectorized_sort
+    """
+    frames = make_scene(n_objects, n_frames)
+    results, vectorized_time = run_tracker(VectorizedSort(), frames)
+
+    try:
+        from eelib.ml_tracking.sort import Sort
+    except ImportError as e:
+        Sort = None
+        print('reference sort not available:', e)
+
+    if Sort is None or n_objects > reference_max_objects:
+        print('{} objects: vectorized {:.4f}s per frame'.format(
+            n_objects, vectorized_time))
+        return
+
+    reference, reference_time = run_tracker(Sort(), frames)
+    same = all(
+        len(ids) == len(reference_ids) and ids == reference_ids and
+        np.allclose(boxes, reference_boxes)
+        for (boxes, ids), (reference_boxes, reference_ids) in zip(
+            normalize_ids(results), normalize_ids(reference))
+    )
+    print('{} objects: reference {:.4f}s, vectorized {:.4f}s per frame, '
+          'same tracks: {}'.format(
+              n_objects, reference_time, vectorized_time, same))
+
+
+if __name__ == '__main__':
+    for n_objects in [10, 100, 300, 1000]:
+        benchmark(n_objects)
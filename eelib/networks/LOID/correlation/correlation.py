@@ -1,10 +1,17 @@
 #!/usr/bin/env python
 
+import time
 import torch
 
-import cupy
 import re
 
+try:
+	import cupy
+except ImportError:
+	# cpu only nodes, FunctionCorrelation uses correlation_torch
+	cupy = None
+# end
+
 kernel_Correlation_rearrange = '''
 	extern "C" __global__ void kernel_Correlation_rearrange(
 		const int n,
@@ -270,11 +277,35 @@ def cupy_kernel(strFunction, objVariables):
 	return strKernel
 # end
 
-@cupy._util.memoize(for_each_device=True)
 def cupy_launch(strFunction, strKernel):
 	return cupy.cuda.compile_with_cache(strKernel).get_function(strFunction)
 # end
 
+if cupy is not None:
+	cupy_launch = cupy._util.memoize(for_each_device=True)(cupy_launch)
+# end
+
+def correlation_torch(tenFirst, tenSecond):
+	# the cost volume of the cupy kernels with plain torch operations, for
+	# inputs on the cpu or without cupy: for every displacement (o, p) in the
+	# 9x9 window the mean over the channels of first[y, x] * second[y + p, x + o],
+	# zero outside the image. One displacement at a time keeps the memory at
+	# the size of the output; the backward pass comes from autograd.
+	intHeight = tenFirst.shape[2]
+	intWidth = tenFirst.shape[3]
+
+	tenPadded = torch.nn.functional.pad(input=tenSecond, pad=[ 4, 4, 4, 4 ])
+
+	tenOutput = []
+	for intP in range(9):
+		for intO in range(9):
+			tenOutput.append((tenFirst * tenPadded[:, :, intP:intP + intHeight, intO:intO + intWidth]).mean(1))
+		# end
+	# end
+
+	return torch.stack(tenOutput, 1)
+# end
+
 class _FunctionCorrelation(torch.autograd.Function):
 	@staticmethod
 	def forward(self, first, second):
@@ -322,6 +353,7 @@ class _FunctionCorrelation(torch.autograd.Function):
 			)
 
 		elif first.is_cuda == False:
+			# FunctionCorrelation uses correlation_torch for cpu inputs
 			raise NotImplementedError()
 
 		# end
@@ -374,6 +406,7 @@ class _FunctionCorrelation(torch.autograd.Function):
 			# end
 
 		elif first.is_cuda == False:
+			# FunctionCorrelation uses correlation_torch for cpu inputs
 			raise NotImplementedError()
 
 		# end
@@ -383,7 +416,11 @@ class _FunctionCorrelation(torch.autograd.Function):
 # end
 
 def FunctionCorrelation(tenFirst, tenSecond):
-	return _FunctionCorrelation.apply(tenFirst, tenSecond)
+	if tenFirst.is_cuda == True and cupy is not None:
+		return _FunctionCorrelation.apply(tenFirst, tenSecond)
+	# end
+
+	return correlation_torch(tenFirst, tenSecond)
 # end
 
 class ModuleCorrelation(torch.nn.Module):
@@ -392,6 +429,88 @@ class ModuleCorrelation(torch.nn.Module):
 	# end
 
 	def forward(self, tenFirst, tenSecond):
-		return _FunctionCorrelation.apply(tenFirst, tenSecond)
+		return FunctionCorrelation(tenFirst, tenSecond)
 	# end
+# end
+
+def correlation_unfold(tenFirst, tenSecond):
+	# reference for the parity check, builds all 81 shifted copies at once
+	tenWindows = torch.nn.functional.unfold(input=tenSecond, kernel_size=9, padding=4).view(tenSecond.shape[0], tenSecond.shape[1], 81, tenSecond.shape[2], tenSecond.shape[3])
+
+	return (tenFirst.unsqueeze(2) * tenWindows).mean(1)
+# end
+
+def time_correlation(fnCorrelation, tenFirst, tenSecond, intRuns):
+	fnCorrelation(tenFirst, tenSecond)
+
+	if tenFirst.is_cuda == True:
+		torch.cuda.synchronize()
+	# end
+
+	fltStart = time.time()
+	for intRun in range(intRuns):
+		fnCorrelation(tenFirst, tenSecond)
+	# end
+
+	if tenFirst.is_cuda == True:
+		torch.cuda.synchronize()
+	# end
+
+	return (time.time() - fltStart) / intRuns
+# end
+
+def benchmark(intRuns=10):
+	"""
+	Checks the torch correlation against the unfold reference on the cpu and,
+	with cuda and cupy, against the cupy kernels (output and gradients), and
+	prints the time per call for the feature sizes of the PWC-Net levels of a
+	1280x720 frame. Run with python -m <this module>.
+	"""
+	torch.manual_seed(0)
+
+	tenFirst = torch.randn([ 2, 16, 13, 17 ], requires_grad=True)
+	tenSecond = torch.randn([ 2, 16, 13, 17 ], requires_grad=True)
+	fltError = (correlation_torch(tenFirst, tenSecond) - correlation_unfold(tenFirst, tenSecond)).abs().max().item()
+	print('torch vs unfold, max abs difference: {:.2e}'.format(fltError))
+
+	boolCupy = torch.cuda.is_available() == True and cupy is not None
+	if boolCupy == True:
+		tenFirstCuda = tenFirst.detach().cuda().requires_grad_()
+		tenSecondCuda = tenSecond.detach().cuda().requires_grad_()
+		tenCupy = _FunctionCorrelation.apply(tenFirstCuda, tenSecondCuda)
+		tenGrad = torch.randn_like(tenCupy)
+		tenCupy.backward(tenGrad)
+
+		tenTorch = correlation_torch(tenFirst, tenSecond)
+		tenTorch.backward(tenGrad.cpu())
+
+		print('torch vs cupy, max abs difference: output {:.2e}, grad first {:.2e}, grad second {:.2e}'.format(
+			(tenTorch - tenCupy.cpu()).abs().max().item(),
+			(tenFirst.grad - tenFirstCuda.grad.cpu()).abs().max().item(),
+			(tenSecond.grad - tenSecondCuda.grad.cpu()).abs().max().item()
+		))
+	else:
+		print('no cuda or cupy, skipping the parity check with the cupy kernels')
+	# end
+
+	with torch.no_grad():
+		for intChannels, intHeight, intWidth in [ (32, 180, 320), (64, 90, 160), (96, 45, 80), (128, 23, 40), (196, 12, 20) ]:
+			tenFirst = torch.randn([ 1, intChannels, intHeight, intWidth ])
+			tenSecond = torch.randn([ 1, intChannels, intHeight, intWidth ])
+
+			strTimes = 'cpu torch {:.4f}s'.format(time_correlation(correlation_torch, tenFirst, tenSecond, intRuns))
+			if boolCupy == True:
+				strTimes += ', cuda torch {:.4f}s, cuda cupy {:.4f}s'.format(
+					time_correlation(correlation_torch, tenFirst.cuda(), tenSecond.cuda(), intRuns),
+					time_correlation(_FunctionCorrelation.apply, tenFirst.cuda(), tenSecond.cuda(), intRuns)
+				)
+			# end
+
+			print('{}x{}x{}: {}'.format(intChannels, intHeight, intWidth, strTimes))
+		# end
+	# end
+# end
+
+if __name__ == '__main__':
+	benchmark()
 # end
\ No newline at end of file
@@ -114,11 +114,29 @@ class LOID2(torch.nn.Module):
         
         return output
 
-    def forward(self, frame1, frame2):
-        flow_fw, flow_bw, features1, features2, flow_features = self.fe_net.bidirection_forward(frame1, frame2, ret_features=True)
+    def encode(self, frame):
+        return self.fe_net.encode(frame)
+
+    def forward_encoded(self, features1, features2, frame_size, ret_bw=True):
+        """
+        forward with the feature pyramids of encode, frame_size is the
+        (width, height) of the frames. Without ret_bw the backward flow is
+        not decoded and returned as None.
+        """
+        if ret_bw:
+            flow_fw, flow_bw, features1, features2, flow_features = self.fe_net.full_forward_encoded(
+                features1, features2, frame_size, ret_features=True, ret_bw=True)
+        else:
+            flow_bw = None
+            flow_fw, features1, features2, flow_features = self.fe_net.full_forward_encoded(
+                features1, features2, frame_size, ret_features=True, ret_bw=False)
+
         density = self.cc_forward(features1, features2, flow_fw, flow_features)
         return flow_fw, flow_bw, density
 
+    def forward(self, frame1, frame2):
+        return self.forward_encoded(self.encode(frame1), self.encode(frame2), (frame1.shape[3], frame1.shape[2]))
+
 
 
 class LOID(torch.nn.Module):
@@ -153,11 +171,29 @@ class LOID(torch.nn.Module):
         
         return output
 
-    def forward(self, frame1, frame2):
-        flow_fw, flow_bw, features1, features2, flow_features = self.fe_net.bidirection_forward(frame1, frame2, ret_features=True)
+    def encode(self, frame):
+        return self.fe_net.encode(frame)
+
+    def forward_encoded(self, features1, features2, frame_size, ret_bw=True):
+        """
+        forward with the feature pyramids of encode, frame_size is the
+        (width, height) of the frames. Without ret_bw the backward flow is
+        not decoded and returned as None.
+        """
+        if ret_bw:
+            flow_fw, flow_bw, features1, features2, flow_features = self.fe_net.full_forward_encoded(
+                features1, features2, frame_size, ret_features=True, ret_bw=True)
+        else:
+            flow_bw = None
+            flow_fw, features1, features2, flow_features = self.fe_net.full_forward_encoded(
+                features1, features2, frame_size, ret_features=True, ret_bw=False)
+
         density = self.cc_forward(features1, features2, flow_fw, flow_features)
         return flow_fw, flow_bw, density
 
+    def forward(self, frame1, frame2):
+        return self.forward_encoded(self.encode(frame1), self.encode(frame2), (frame1.shape[3], frame1.shape[2]))
+
 
 class LOID2(torch.nn.Module):
     def __init__(self, load_pretrained=False):
@@ -189,7 +225,25 @@ class LOID2(torch.nn.Module):
         
         return output
 
-    def forward(self, frame1, frame2):
-        flow_fw, flow_bw, features1, features2, flow_features = self.fe_net.bidirection_forward(frame1, frame2, ret_features=True)
+    def encode(self, frame):
+        return self.fe_net.encode(frame)
+
+    def forward_encoded(self, features1, features2, frame_size, ret_bw=True):
+        """
+        forward with the feature pyramids of encode, frame_size is the
+        (width, height) of the frames. Without ret_bw the backward flow is
+        not decoded and returned as None.
+        """
+        if ret_bw:
+            flow_fw, flow_bw, features1, features2, flow_features = self.fe_net.full_forward_encoded(
+                features1, features2, frame_size, ret_features=True, ret_bw=True)
+        else:
+            flow_bw = None
+            flow_fw, features1, features2, flow_features = self.fe_net.full_forward_encoded(
+                features1, features2, frame_size, ret_features=True, ret_bw=False)
+
         density = self.cc_forward(features1, features2, flow_fw, flow_features)
-        return flow_fw, flow_bw, density
\ No newline at end of file
+        return flow_fw, flow_bw, density
+
+    def forward(self, frame1, frame2):
+        return self.forward_encoded(self.encode(frame1), self.encode(frame2), (frame1.shape[3], frame1.shape[2]))
\ No newline at end of file
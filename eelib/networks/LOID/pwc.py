@@ -13,7 +13,7 @@ def backwarp(tenInput, tenFlow):
         tenHorizontal = torch.linspace(-1.0, 1.0, tenFlow.shape[3]).view(1, 1, 1, tenFlow.shape[3]).expand(tenFlow.shape[0], -1, tenFlow.shape[2], -1)
         tenVertical = torch.linspace(-1.0, 1.0, tenFlow.shape[2]).view(1, 1, tenFlow.shape[2], 1).expand(tenFlow.shape[0], -1, -1, tenFlow.shape[3])
 
-        backwarp_tenGrid[str(tenFlow.size())] = torch.cat([ tenHorizontal, tenVertical ], 1).cuda()
+        backwarp_tenGrid[str(tenFlow.size())] = torch.cat([ tenHorizontal, tenVertical ], 1).to(tenFlow.device)
     # end
 
     if str(tenFlow.size()) not in backwarp_tenPartial:
@@ -272,30 +272,40 @@ class PWCNet(torch.nn.Module):
         flow[:, 1, :, :] *= float(int_height) / float(int_preprocessed_height)
         return flow, flow_features
 
-    def full_forward(self, frame1, frame2, ret_features=False, ret_bw=False):
-        int_width = frame1.shape[3]
-        int_height = frame1.shape[2]
+    def get_processed_sizes(self, initial_sizes):
+        (int_width, int_height) = initial_sizes
         int_preprocessed_width = int(math.ceil(math.ceil(int_width / 64.0) * 64.0))
         int_preprocessed_height = int(math.ceil(math.ceil(int_height / 64.0) * 64.0))
+        return (int_preprocessed_width, int_preprocessed_height)
+
+    # Feature pyramid of one frame, a frame can be encoded once and decoded
+    # against both its previous and its next frame
+    def encode(self, frame):
+        (int_preprocessed_width, int_preprocessed_height) = self.get_processed_sizes((frame.shape[3], frame.shape[2]))
 
         # Resize to get a size which fits into the network
-        frame1 = torch.nn.functional.interpolate(input=frame1,
-                                                 size=(int_preprocessed_height, int_preprocessed_width),
-                                                 mode='bicubic', align_corners=False)
-        frame2 = torch.nn.functional.interpolate(input=frame2,
-                                                 size=(int_preprocessed_height, int_preprocessed_width),
-                                                 mode='bicubic', align_corners=False)
-
-        # Feed through encoder and decode forward and backward
-        features1 = self.netExtractor(frame1)
-        features2 = self.netExtractor(frame2)
-        flow_fw, flow_features = self.full_decode(features1, features2, initial_sizes=(int_width, int_height),
-                                   processed_sizes=(int_preprocessed_width, int_preprocessed_height))
+        frame = torch.nn.functional.interpolate(input=frame,
+                                                size=(int_preprocessed_height, int_preprocessed_width),
+                                                mode='bicubic', align_corners=False)
+
+        return self.netExtractor(frame)
+
+    def full_forward(self, frame1, frame2, ret_features=False, ret_bw=False):
+        return self.full_forward_encoded(self.encode(frame1), self.encode(frame2),
+                                         initial_sizes=(frame1.shape[3], frame1.shape[2]),
+                                         ret_features=ret_features, ret_bw=ret_bw)
+
+    def full_forward_encoded(self, features1, features2, initial_sizes, ret_features=False, ret_bw=False):
+        processed_sizes = self.get_processed_sizes(initial_sizes)
+
+        # Decode forward and backward
+        flow_fw, flow_features = self.full_decode(features1, features2, initial_sizes=initial_sizes,
+                                   processed_sizes=processed_sizes)
         ret = [flow_fw]
 
         if ret_bw:
-            flow_bw, _ = self.full_decode(features2, features1, initial_sizes=(int_width, int_height),
-                                       processed_sizes=(int_preprocessed_width, int_preprocessed_height))
+            flow_bw, _ = self.full_decode(features2, features1, initial_sizes=initial_sizes,
+                                       processed_sizes=processed_sizes)
             ret.append(flow_bw)
 
         if ret_features:
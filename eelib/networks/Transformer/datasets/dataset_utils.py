@@ -1,4 +1,5 @@
 import math
+from functools import lru_cache
 import torch
 import scipy.ndimage
 import numpy as np
@@ -39,9 +40,14 @@ def generate_density_municipality(img, gt_points, sigma):
     return density
 
 
-def img_equal_split(img, crop_size, overlap):
-    channels, h, w = img.shape
-
+@lru_cache(maxsize=64)
+def crop_grid(h, w, crop_size, overlap):
+    """
+    Top left corners of the crops that cover an h x w image with at least
+    overlap pixels of overlap. The last row and column are moved inwards
+    so they end at the border of the image.
+    Returns (n_rows, n_cols, ys, xs).
+    """
     n_cols = (w - crop_size) / (crop_size - overlap) + 1
     n_cols = math.ceil(n_cols)  # At least this many crops needed to get >= overlap pixels of overlap
     n_rows = (h - crop_size) / (crop_size - overlap) + 1
@@ -59,61 +65,91 @@ def img_equal_split(img, crop_size, overlap):
     else:  # edge case (SHTA)
         overlap_h = 0
 
-    crops = torch.zeros((n_rows * n_cols, channels, crop_size, crop_size))
+    ys = tuple(
+        r * (crop_size - overlap_h) if r * (crop_size - overlap_h) + crop_size <= h else h - crop_size
+        for r in range(n_rows)
+    )
+    xs = tuple(
+        c * (crop_size - overlap_w) if c * (crop_size - overlap_w) + crop_size <= w else w - crop_size
+        for c in range(n_cols)
+    )
+    return n_rows, n_cols, ys, xs
+
+
+# number of index tensors kept per (h, w, crop_size, overlap,
+# ignore_buffer, device), the oldest is removed first
+INDEX_CACHE_SIZE = 16
+split_indices = {}
+unsplit_indices = {}
+
+
+def get_split_indices(h, w, crop_size, overlap, device):
+    key = (h, w, crop_size, overlap, str(device))
+    if key not in split_indices:
+        if len(split_indices) >= INDEX_CACHE_SIZE:
+            split_indices.pop(next(iter(split_indices)))
+
+        _, _, ys, xs = crop_grid(h, w, crop_size, overlap)
+        offsets = torch.arange(crop_size, device=device)
+        rows = torch.tensor(ys, device=device)[:, None] + offsets
+        cols = torch.tensor(xs, device=device)[:, None] + offsets
+        split_indices[key] = (rows[:, None, :, None], cols[None, :, None, :])
+
+    return split_indices[key]
+
+
+def get_unsplit_indices(h, w, crop_size, overlap, ignore_buffer, device):
+    """
+    Flat pixel index and weight (0 inside the ignore buffer) of every crop
+    pixel, and the divider: the number of crops that cover every pixel.
+    """
+    key = (h, w, crop_size, overlap, ignore_buffer, str(device))
+    if key not in unsplit_indices:
+        if len(unsplit_indices) >= INDEX_CACHE_SIZE:
+            unsplit_indices.pop(next(iter(unsplit_indices)))
+
+        n_rows, n_cols, ys, xs = crop_grid(h, w, crop_size, overlap)
+        offsets = torch.arange(crop_size, device=device)
+        rows = torch.tensor(ys, device=device)[:, None] + offsets
+        cols = torch.tensor(xs, device=device)[:, None] + offsets
+        index = (rows[:, None, :, None] * w + cols[None, :, None, :])
+
+        weight = torch.ones(
+            (n_rows, n_cols, crop_size, crop_size), device=device)
+        if ignore_buffer:
+            weight[1:, :, :ignore_buffer, :] = 0
+            weight[:-1, :, crop_size - ignore_buffer:, :] = 0
+            weight[:, 1:, :, :ignore_buffer] = 0
+            weight[:, :-1, :, crop_size - ignore_buffer:] = 0
+
+        index = index.reshape(-1)
+        weight = weight.reshape(-1)
+        divider = torch.zeros(h * w, device=device).index_add_(
+            0, index, weight)
+        unsplit_indices[key] = (index, weight, divider.view(h, w))
+
+    return unsplit_indices[key]
 
-    for r in range(n_rows):
-        for c in range(n_cols):
-            y1 = r * (crop_size - overlap_h) if r * (crop_size - overlap_h) + crop_size <= h else h - crop_size
-            y2 = y1 + crop_size
-            x1 = c * (crop_size - overlap_w) if c * (crop_size - overlap_w) + crop_size <= w else w - crop_size
-            x2 = x1 + crop_size
 
-            item_idx = r * n_cols + c
-            crops[item_idx, :, :, :] = img[:, y1:y2, x1:x2]
-
-    return crops
+def img_equal_split(img, crop_size, overlap):
+    channels, h, w = img.shape
+    rows, cols = get_split_indices(h, w, crop_size, overlap, img.device)
 
-    return crops
+    # (channels, n_rows, n_cols, crop, crop) gathered in one indexing op
+    crops = img[:, rows, cols]
+    return crops.permute(1, 2, 0, 3, 4).reshape(
+        -1, channels, crop_size, crop_size)
 
 
 def img_equal_unsplit(crops, overlap, ignore_buffer, img_h, img_w, img_channels):
-    w, h = img_w, img_h
     crop_size = crops.shape[-1]
-    n_cols = (w - crop_size) / (crop_size - overlap) + 1
-    n_cols = math.ceil(n_cols)  # At least this many crops needed to get >= overlap pixels of overlap
-    n_rows = (h - crop_size) / (crop_size - overlap) + 1
-    n_rows = math.ceil(n_rows)  # At least this many crops needed to get >= overlap pixels of overlap
-
-    if n_cols > 1:
-        overlap_w = crop_size - (w - crop_size) / (n_cols - 1)
-        overlap_w = math.floor(overlap_w)
-    else:
-        overlap_w = 0
-
-    if n_rows > 1:
-        overlap_h = crop_size - (h - crop_size) / (n_rows - 1)
-        overlap_h = math.floor(overlap_h)
-    else:
-        overlap_h = 0
-
-    new_img = torch.zeros((img_channels, h, w))
-    divider = torch.zeros((img_channels, h, w))
-
-    for r in range(n_rows):
-        for c in range(n_cols):
-            y1 = r * (crop_size - overlap_h) if r * (crop_size - overlap_h) + crop_size <= h else h - crop_size
-            y2 = y1 + crop_size
-            x1 = c * (crop_size - overlap_w) if c * (crop_size - overlap_w) + crop_size <= w else w - crop_size
-            x2 = x1 + crop_size
-
-            ign_top = ignore_buffer if r != 0 else 0
-            ign_bot = ignore_buffer if r != n_rows - 1 else 0
-            ign_left = ignore_buffer if c != 0 else 0
-            ign_right = ignore_buffer if c != n_cols - 1 else 0
+    index, weight, divider = get_unsplit_indices(
+        img_h, img_w, crop_size, overlap, ignore_buffer, crops.device)
 
-            item_idx = r * n_cols + c
-            new_img[:, y1 + ign_top:y2 - ign_bot, x1 + ign_left:x2 - ign_right] += \
-                crops[item_idx, :, 0 + ign_top:crop_size - ign_bot, 0 + ign_left:crop_size - ign_right]
-            divider[:, y1 + ign_top:y2 - ign_bot, x1 + ign_left:x2 - ign_right] += 1
+    values = crops.reshape(-1, img_channels, crop_size, crop_size)
+    values = values.permute(1, 0, 2, 3).reshape(img_channels, -1)
+    new_img = torch.zeros(
+        (img_channels, img_h * img_w), dtype=values.dtype, device=crops.device)
+    new_img.index_add_(1, index, values * weight.to(values.dtype))
 
-    return new_img / divider
+    return new_img.view(img_channels, img_h, img_w) / divider
@@ -9,6 +9,7 @@ from functools import partial
 from timm.models.vision_transformer import VisionTransformer, _cfg
 from timm.models.registry import register_model
 from timm.models.layers import trunc_normal_
+from eelib.networks.checkpoint import load_checkpoint
 
 __all__ = [
     'deit_tiny_patch16_224', 'deit_small_patch16_224', 'deit_base_patch16_224',
@@ -303,7 +304,7 @@ def init_model_state(model, init_path):
 
     # This model is downloaded so structured different
     elif 'deit_base_distilled_patch16_224' in init_path:
-        checkpoint = torch.load(init_path)
+        checkpoint = load_checkpoint(init_path)
         pretrained_state = checkpoint['model']
         modified_model_state = model.state_dict()
         # With this, we are able to load the pretrained modules while ignoring the new regression modules.
@@ -311,7 +312,7 @@ def init_model_state(model, init_path):
             modified_model_state[key] = pretrained_state[key]
         model.load_state_dict(modified_model_state)
     else:
-        checkpoint = torch.load(init_path)
+        checkpoint = load_checkpoint(init_path)
         modified_model_state = model.state_dict()
         for key in checkpoint['state_dict'].keys():
             modified_model_state[key] = checkpoint['state_dict'][key]
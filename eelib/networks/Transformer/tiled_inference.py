@@ -0,0 +1,78 @@
+import torch
+from eelib.networks.Transformer.datasets.dataset_utils import (
+    img_equal_split,
+    img_equal_unsplit
+)
+
+
+class TiledInference:
+    """
+    Sliding window inference for the DeiT density networks. The image is
+    cut into overlapping crops with one gather, the crops are run through
+    the network in batches of batch_size and the density map is put back
+    together on the device. The crop grid, gather indices and divider map
+    are cached per (height, width, crop size, overlap) by dataset_utils.
+
+    The last batch is padded to batch_size so the network always sees the
+    same input shape, which keeps cudnn and traced backends on one plan.
+    """
+
+    def __init__(
+        self,
+        network,
+        crop_size=224,
+        overlap=8,
+        ignore_buffer=4,
+        batch_size=16,
+        pad_batches=True
+    ):
+        self.network = network
+        self.crop_size = crop_size
+        self.overlap = overlap
+        self.ignore_buffer = ignore_buffer
+        self.batch_size = batch_size
+        self.pad_batches = pad_batches
+
+    def split(self, img):
+        return img_equal_split(img, self.crop_size, self.overlap)
+
+    def unsplit(self, crops, img_h, img_w, channels=1):
+        return img_equal_unsplit(
+            crops, self.overlap, self.ignore_buffer, img_h, img_w, channels)
+
+    def predict_crops(self, crops):
+        outputs = []
+        for start in range(0, crops.shape[0], self.batch_size):
+            batch = crops[start:start + self.batch_size]
+            size = batch.shape[0]
+            if self.pad_batches and size < self.batch_size:
+                batch = torch.cat([
+                    batch,
+                    batch.new_zeros(
+                        (self.batch_size - size,) + tuple(batch.shape[1:]))
+                ])
+            outputs.append(self.network(batch)[:size])
+
+        return torch.cat(outputs)
+
+    def __call__(self, img):
+        """
+        img: (channels, height, width) on the device of the network.
+        Returns the (1, height, width) density map on the same device.
+        """
+        _, img_h, img_w = img.shape
+        return self.unsplit(self.predict_crops(self.split(img)), img_h, img_w)
+
+    def predict_batch(self, imgs):
+        """
+        Runs the crops of several images through the same batches, returns
+        a density map for every image.
+        """
+        crops = [self.split(img) for img in imgs]
+        outputs = self.predict_crops(torch.cat(crops))
+
+        return [
+            self.unsplit(output, img.shape[1], img.shape[2])
+            for output, img in zip(
+                torch.split(outputs, [c.shape[0] for c in crops]), imgs)
+        ]
@@ -0,0 +1,21 @@
+import time
+import torch
+
+
+def load_checkpoint(checkpoint_path, device='cpu'):
+    """
+    torch.load that memory-maps the checkpoint, so tensors are read from the
+    page cache straight into the target device instead of being copied
+    through an extra CPU buffer. Older torch versions and checkpoints in the
+    legacy (non zip) format are read the normal way.
+    """
+    start = time.time()
+    try:
+        checkpoint = torch.load(
+            checkpoint_path, map_location=device, mmap=True)
+    except (TypeError, RuntimeError):
+        checkpoint = torch.load(checkpoint_path, map_location=device)
+
+    print('read checkpoint {} to {} in {:.2f}s'.format(
+        checkpoint_path, device, time.time() - start))
+    return checkpoint
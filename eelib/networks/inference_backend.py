@@ -0,0 +1,277 @@
+import os
+import copy
+import hashlib
+import tempfile
+import threading
+import torch
+
+# fp32 eager model, the reference for the other backends
+BACKEND_EAGER = 'eager'
+# eager model under torch.autocast
+BACKEND_FP16 = 'fp16'
+BACKEND_BF16 = 'bf16'
+# traced model, the artefact is cached next to the checkpoint
+BACKEND_TORCHSCRIPT = 'torchscript'
+# exported model run by ONNX Runtime on the CPU, for nodes without a GPU
+BACKEND_ONNX = 'onnx'
+
+BACKENDS = [
+    BACKEND_EAGER,
+    BACKEND_FP16,
+    BACKEND_BF16,
+    BACKEND_TORCHSCRIPT,
+    BACKEND_ONNX
+]
+
+# private directory for the onnx exports of networks without a checkpoint,
+# created on the first export
+export_dir = None
+export_dir_lock = threading.Lock()
+
+# maximum relative difference between the summed output (the count for
+# density networks) of a backend and the fp32 model
+PARITY_TOLERANCE = 0.02
+
+
+def first_tensor(output):
+    if torch.is_tensor(output):
+        return output
+    if isinstance(output, (list, tuple)):
+        for value in output:
+            tensor = first_tensor(value)
+            if tensor is not None:
+                return tensor
+    return None
+
+
+def to_float(output):
+    if torch.is_tensor(output) and output.is_floating_point():
+        return output.float()
+    if isinstance(output, (list, tuple)):
+        return type(output)(to_float(value) for value in output)
+    return output
+
+
+def get_checkpoint_version(model_path):
+    # a checkpoint that is written again gets new artefacts
+    info = os.stat(model_path)
+    return '{}-{}'.format(info.st_mtime_ns, info.st_size)
+
+
+def format_shape(input_shape):
+    # the batch size is part of the key, a trace can depend on it
+    return 'x'.join(str(size) for size in input_shape[:1] + input_shape[2:])
+
+
+def get_artefact_path(model_path, suffix, input_shape):
+    """
+    The compiled artefact is stored next to the checkpoint, one per version
+    of the checkpoint and input shape:
+    <model path>.<mtime>-<size>.<b>x<h>x<w>.<suffix>
+    """
+    return '{}.{}.{}.{}'.format(
+        model_path,
+        get_checkpoint_version(model_path),
+        format_shape(input_shape),
+        suffix)
+
+
+def get_network_hash(network):
+    digest = hashlib.sha1()
+    for name, tensor in network.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def get_export_path(network_hash, suffix, input_shape):
+    """
+    Artefact of a network without a checkpoint, named after the hash of its
+    weights in a directory only this user can access.
+    """
+    global export_dir
+    with export_dir_lock:
+        if export_dir is None:
+            export_dir = tempfile.mkdtemp(prefix='eagle_eye_export_')
+
+    return '{}.{}.{}'.format(
+        os.path.join(export_dir, network_hash),
+        format_shape(input_shape),
+        suffix)
+
+
+class InferenceNetwork:
+    """
+    Wraps a network for a stream predictor, network(img) runs the selected
+    backend under no_grad (not inference_mode, the post-processing of some
+    predictors modifies the outputs in place). The first call of every input
+    shape, batch size included, is checked against the fp32 model; a backend
+    that does not match within PARITY_TOLERANCE is replaced by the fp32
+    model for that shape.
+    """
+
+    def __init__(self, network, backend, model_path=None, check_parity=True):
+        if backend not in BACKENDS:
+            raise ValueError('Unknown inference backend: {}'.format(backend))
+
+        self.network = network.eval()
+        self.backend = backend
+        self.model_path = model_path
+        self.check_parity = check_parity and backend != BACKEND_EAGER
+        self.compiled = {}
+        self.network_hash = None
+        self.checked_shapes = set()
+        self.failed_shapes = set()
+        self.lock = threading.Lock()
+
+    def eager(self, *inputs):
+        with torch.no_grad():
+            return self.network(*inputs)
+
+    def autocast(self, dtype, *inputs):
+        with torch.no_grad():
+            with torch.autocast(inputs[0].device.type, dtype=dtype):
+                return to_float(self.network(*inputs))
+
+    def get_compiled(self, inputs):
+        key = tuple(inputs[0].shape)
+        with self.lock:
+            if key not in self.compiled:
+                if self.backend == BACKEND_TORCHSCRIPT:
+                    self.compiled[key] = self.load_torchscript(inputs)
+                else:
+                    self.compiled[key] = self.load_onnx(inputs)
+            return self.compiled[key]
+
+    def load_torchscript(self, inputs):
+        path = None
+        if self.model_path:
+            path = get_artefact_path(
+                self.model_path, 'torchscript.pt', inputs[0].shape)
+            if os.path.exists(path):
+                print('load torchscript model', path)
+                return torch.jit.load(path, map_location=inputs[0].device)
+
+        print('trace torchscript model for input', tuple(inputs[0].shape))
+        with torch.no_grad():
+            traced = torch.jit.freeze(
+                torch.jit.trace(self.network, inputs, check_trace=False))
+
+        if path is not None:
+            try:
+                torch.jit.save(traced, path)
+            except Exception as e:
+                print('could not cache torchscript model', path, e)
+
+        return traced
+
+    def load_onnx(self, inputs):
+        import onnxruntime
+
+        if self.model_path:
+            path = get_artefact_path(self.model_path, 'onnx', inputs[0].shape)
+        else:
+            if self.network_hash is None:
+                self.network_hash = get_network_hash(self.network)
+            path = get_export_path(self.network_hash, 'onnx', inputs[0].shape)
+
+        if not os.path.exists(path):
+            print('export onnx model', path)
+            cpu_inputs = tuple(tensor.cpu() for tensor in inputs)
+            # the network may be shared with other streams, so a copy is
+            # moved to the cpu for the export
+            with torch.no_grad():
+                torch.onnx.export(
+                    copy.deepcopy(self.network).cpu(),
+                    cpu_inputs,
+                    path,
+                    input_names=[
+                        'input_{}'.format(idx)
+                        for idx in range(len(inputs))
+                    ],
+                    dynamic_axes={
+                        'input_{}'.format(idx): {0: 'batch'}
+                        for idx in range(len(inputs))
+                    },
+                    opset_version=13)
+
+        return onnxruntime.InferenceSession(
+            path, providers=['CPUExecutionProvider'])
+
+    def run_compiled(self, *inputs):
+        compiled = self.get_compiled(inputs)
+        if self.backend == BACKEND_TORCHSCRIPT:
+            with torch.no_grad():
+                return compiled(*inputs)
+
+        outputs = compiled.run(None, {
+            session_input.name: tensor.detach().cpu().numpy()
+            for session_input, tensor in zip(compiled.get_inputs(), inputs)
+        })
+        outputs = [torch.from_numpy(output) for output in outputs]
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def run(self, *inputs):
+        if self.backend == BACKEND_FP16:
+            return self.autocast(torch.float16, *inputs)
+        if self.backend == BACKEND_BF16:
+            return self.autocast(torch.bfloat16, *inputs)
+        if self.backend in [BACKEND_TORCHSCRIPT, BACKEND_ONNX]:
+            return self.run_compiled(*inputs)
+
+        return self.eager(*inputs)
+
+    def parity(self, inputs, output):
+        reference = first_tensor(self.eager(*inputs))
+        tensor = first_tensor(output)
+        if reference is None or tensor is None:
+            return True
+
+        reference_count = float(reference.float().sum())
+        count = float(tensor.float().sum().to(reference.device))
+        difference = abs(count - reference_count) / max(
+            abs(reference_count), 1.0)
+        print('{} parity: {:.3f} vs fp32 {:.3f} ({:.2%})'.format(
+            self.backend, count, reference_count, difference))
+
+        return difference <= PARITY_TOLERANCE
+
+    def __call__(self, *inputs):
+        # every new shape, also a new batch size, is checked again
+        shape = tuple(inputs[0].shape)
+        if shape in self.failed_shapes:
+            return self.eager(*inputs)
+
+        try:
+            output = self.run(*inputs)
+        except Exception as e:
+            print('{} backend failed, using fp32: {}'.format(self.backend, e))
+            self.failed_shapes.add(shape)
+            return self.eager(*inputs)
+
+        if self.check_parity and shape not in self.checked_shapes:
+            self.checked_shapes.add(shape)
+            if not self.parity(inputs, output):
+                print('{} backend does not match fp32, using fp32'.format(
+                    self.backend))
+                self.failed_shapes.add(shape)
+                return self.eager(*inputs)
+
+        return output
+
+    def forward(self, *inputs):
+        return self(*inputs)
+
+    def eval(self):
+        return self
+
+
+def get_inference_network(network, backend, model_path=None):
+    """
+    Returns the network wrapped in the selected backend. Networks that are
+    not torch modules (like a model server client) are returned as they are.
+    """
+    if backend is None or not isinstance(network, torch.nn.Module):
+        return network
+
+    return InferenceNetwork(network, backend, model_path)
@@ -0,0 +1,346 @@
+import os
+import stat
+import queue
+import threading
+from multiprocessing.connection import Listener, Client
+import numpy as np
+import torch
+from eelib.config import load
+from eelib.networks.registry import get_network
+from eelib.stream.batch_scheduler import MicroBatchScheduler
+
+SOCKET_NAME = 'model_server.sock'
+# environment variable with the key when it is not in config.json
+AUTHKEY_ENV = 'EAGLE_EYE_MODEL_SERVER_AUTHKEY'
+MAX_BATCH_SIZE = 8
+MAX_BATCH_WAIT = 0.05
+
+
+def get_runtime_dir(path):
+    """
+    Creates the directory of the socket, only accessible by the user of
+    this process. An existing directory that is not a directory owned by
+    this user with mode 0700, for example one created first by another
+    user, is refused.
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode) or
+        info.st_uid != os.getuid() or
+        stat.S_IMODE(info.st_mode) & 0o077
+    ):
+        raise Exception(
+            'model server directory {} must be a directory owned by this '
+            'user with mode 0700'.format(path))
+
+    return path
+
+
+def get_server_config():
+    """
+    Optional "model_server" section in config.json with the runtime_dir of
+    the unix socket and the authkey clients authenticate with. The key can
+    also be set with the EAGLE_EYE_MODEL_SERVER_AUTHKEY environment
+    variable, there is no default: messages are unpickled, so everyone with
+    the key can run code in the server.
+    """
+    config = load().get('model_server', {})
+
+    authkey = config.get('authkey') or os.environ.get(AUTHKEY_ENV)
+    if not authkey:
+        raise Exception(
+            'no model server authkey, set model_server.authkey in '
+            'config.json or {}'.format(AUTHKEY_ENV))
+
+    runtime_dir = get_runtime_dir(config.get(
+        'runtime_dir',
+        os.path.join(os.environ['EAGLE_EYE_PATH'], 'files', 'model_server')))
+
+    return os.path.join(runtime_dir, SOCKET_NAME), authkey.encode()
+
+
+def to_wire(value):
+    # tensors are sent as numpy arrays, so no torch shared memory handles
+    # have to be passed between the processes
+    if torch.is_tensor(value):
+        return value.detach().cpu().numpy()
+    if isinstance(value, (list, tuple)):
+        return type(value)(to_wire(v) for v in value)
+    return value
+
+
+def from_wire(value, device=None):
+    if isinstance(value, np.ndarray):
+        tensor = torch.from_numpy(value)
+        return tensor.to(device) if device is not None else tensor
+    if isinstance(value, (list, tuple)):
+        return type(value)(from_wire(v, device) for v in value)
+    return value
+
+
+def split_output(output, sizes):
+    """
+    Splits the output of a batched forward pass back into one output per
+    request. Values without the batch dimension are given to every request.
+    """
+    if (
+        torch.is_tensor(output) and output.dim() > 0 and
+        output.shape[0] == sum(sizes)
+    ):
+        return list(torch.split(output, sizes))
+
+    if isinstance(output, (list, tuple)):
+        parts = [split_output(o, sizes) for o in output]
+        return [
+            type(output)(part[idx] for part in parts)
+            for idx in range(len(sizes))
+        ]
+
+    return [output] * len(sizes)
+
+
+def batch_key(args):
+    # only requests with the same input shapes and options can be batched
+    return tuple(
+        (tuple(arg.shape[1:]), str(arg.dtype))
+        if torch.is_tensor(arg) else repr(arg)
+        for arg in args
+    )
+
+
+class SharedModel:
+    """
+    One loaded network in the server. Requests of all clients go through a
+    single queue and are batched per input shape before the forward pass.
+    """
+
+    def __init__(self, network, device, max_batch_size, max_batch_wait):
+        self.network = network
+        self.device = device
+        self.requestq = queue.Queue()
+        self.scheduler = MicroBatchScheduler(
+            self.requestq,
+            lambda request: batch_key(request['args']),
+            max_batch_size,
+            max_batch_wait)
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def predict(self, args):
+        request = {
+            'args': args,
+            'done': threading.Event(),
+            'result': None,
+            'error': None
+        }
+        self.requestq.put(request)
+        request['done'].wait()
+        if request['error'] is not None:
+            raise Exception(request['error'])
+        return request['result']
+
+    def _run(self):
+        while True:
+            batches = self.scheduler.get_batches()
+            if batches is None:
+                break
+
+            for _, requests in batches:
+                self._predict(requests)
+
+    def _predict(self, requests):
+        try:
+            first = requests[0]['args']
+            sizes = [
+                next(arg.shape[0] for arg in request['args']
+                     if torch.is_tensor(arg))
+                for request in requests
+            ]
+            inputs = [
+                torch.cat([r['args'][idx] for r in requests]).to(self.device)
+                if torch.is_tensor(arg) else arg
+                for idx, arg in enumerate(first)
+            ]
+
+            with torch.no_grad():
+                output = self.network(*inputs)
+
+            for request, part in zip(requests, split_output(output, sizes)):
+                request['result'] = to_wire(part)
+        except Exception as e:
+            print('model server predict ERROR', e)
+            for request in requests:
+                request['error'] = str(e)
+        finally:
+            for request in requests:
+                request['done'].set()
+
+    def close(self):
+        self.requestq.put(None)
+
+
+class ModelServer:
+    """
+    Long-lived inference service for the stream jobs on one node. Each
+    (network, model path, device) is loaded once and shared by all clients
+    connected over a local unix socket, requests from different jobs are
+    batched together.
+    """
+
+    def __init__(
+        self,
+        address,
+        authkey,
+        max_batch_size=MAX_BATCH_SIZE,
+        max_batch_wait=MAX_BATCH_WAIT
+    ):
+        self.address = address
+        self.authkey = authkey
+        self.max_batch_size = max_batch_size
+        self.max_batch_wait = max_batch_wait
+        self.models = {}
+        self.lock = threading.Lock()
+
+    def get_model(self, network_name, model_path, cuda, cuda_device):
+        key = (network_name, model_path, bool(cuda), cuda_device)
+        with self.lock:
+            if key not in self.models:
+                print('model server loads', key)
+                network = get_network(
+                    network_name,
+                    cuda=cuda,
+                    model_path=model_path,
+                    cuda_device=cuda_device)
+                if network is None:
+                    raise Exception(
+                        'No registered network code for {}'.format(
+                            network_name))
+
+                network.eval()
+                device = torch.device(
+                    'cuda:{}'.format(cuda_device) if cuda else 'cpu')
+                self.models[key] = SharedModel(
+                    network, device, self.max_batch_size, self.max_batch_wait)
+
+            return key, self.models[key]
+
+    def handle_client(self, connection):
+        try:
+            while True:
+                message = connection.recv()
+                try:
+                    if message[0] == 'load':
+                        key, _ = self.get_model(*message[1:])
+                        connection.send(('ok', key))
+                    elif message[0] == 'predict':
+                        _, key, args = message
+                        result = self.models[key].predict(from_wire(args))
+                        connection.send(('ok', result))
+                    else:
+                        connection.send(
+                            ('error', 'unknown command {}'.format(message[0])))
+                except Exception as e:
+                    connection.send(('error', str(e)))
+        except EOFError:
+            pass
+        finally:
+            connection.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+        listener = Listener(
+            self.address, family='AF_UNIX', authkey=self.authkey)
+        print('model server listening on', self.address)
+        try:
+            while True:
+                connection = listener.accept()
+                threading.Thread(
+                    target=self.handle_client,
+                    args=[connection],
+                    daemon=True
+                ).start()
+        finally:
+            listener.close()
+            for model in self.models.values():
+                model.close()
+
+
+class RemoteNetwork:
+    """
+    Client side of the model server. Behaves like the network returned by
+    get_network for the stream predictors: network(img) returns the output
+    on the device of the input. Calls from several threads are serialized
+    over the one connection.
+    """
+
+    def __init__(
+        self,
+        network_name,
+        model_path,
+        cuda,
+        cuda_device,
+        address,
+        authkey
+    ):
+        self.connection = Client(address, family='AF_UNIX', authkey=authkey)
+        self.lock = threading.Lock()
+        self.key = self._request(
+            ('load', network_name, model_path, cuda, cuda_device))
+
+    def _request(self, message):
+        with self.lock:
+            self.connection.send(message)
+            status, value = self.connection.recv()
+
+        if status == 'error':
+            raise Exception('model server: {}'.format(value))
+
+        return value
+
+    def __call__(self, *args):
+        device = next(
+            (arg.device for arg in args if torch.is_tensor(arg)), None)
+        output = self._request(('predict', self.key, to_wire(args)))
+        return from_wire(output, device)
+
+    def forward(self, *args):
+        return self(*args)
+
+    # the model lives in the server, these are no-ops for the callers
+    def eval(self):
+        return self
+
+    def to(self, *args, **kwargs):
+        return self
+
+    def cuda(self, *args, **kwargs):
+        return self
+
+    def close(self):
+        self.connection.close()
+
+
+def get_shared_network(
+    network_name,
+    cuda=True,
+    model_path=None,
+    cuda_device=0
+):
+    """
+    Returns a client of the model server for the network, or a network
+    loaded in this process when no model server is running.
+    """
+    try:
+        address, authkey = get_server_config()
+        return RemoteNetwork(
+            network_name, model_path, cuda, cuda_device or 0, address, authkey)
+    except Exception as e:
+        print('model server not available, loading network locally:', e)
+        return get_network(
+            network_name,
+            cuda=cuda,
+            model_path=model_path,
+            cuda_device=cuda_device or 0)
@@ -8,20 +8,27 @@ from timm.models import create_model
 import torch
 import sys
 import os
+import time
+import threading
+from collections import OrderedDict
+from eelib.config import load
+from eelib.networks.checkpoint import load_checkpoint
 from eelib.ml_object_recognition.models import load_darknet_weights
 from eelib.networks.YOLOv5.models.experimental import attempt_load
 
+def get_device(cuda, cuda_device):
+    if not cuda:
+        return torch.device('cpu')
+    return torch.device('cuda:{}'.format(cuda_device or 0))
+
+
 def init_loi(nn, checkpoint_path, cuda, cuda_device):
     print("Init line crossing density NN from", checkpoint_path, 'cuda:', cuda)
 
-    if not cuda:
-        checkpoint = torch.load(
-            checkpoint_path, map_location=torch.device('cpu'))
-    else:
+    if cuda:
         print("init model with weights on cuda device", cuda_device)
-        checkpoint = torch.load(
-            checkpoint_path,
-            map_location=torch.device('cuda:{}'.format(cuda_device)))
+    checkpoint = load_checkpoint(
+        checkpoint_path, get_device(cuda, cuda_device))
 
     nn.load_state_dict(checkpoint)
     if cuda:
@@ -31,18 +38,14 @@ def init_loi(nn, checkpoint_path, cuda, cuda_device):
 
 
 def load_csrnet(checkpoint_path, cuda, cuda_device):
-    nn = CSRNet()
+    device = get_device(cuda, cuda_device)
+    nn = CSRNet().to(device)
 
     if checkpoint_path:
-        checkpoint = torch.load(
-            checkpoint_path,
-            map_location=torch.device('cpu'))
-
+        # the weights are read straight into the device of the network
+        checkpoint = load_checkpoint(checkpoint_path, device)
         nn.load_state_dict(checkpoint['state_dict'])
 
-    if cuda:
-        nn.to(torch.device('cuda:{}'.format(cuda_device)))
-
     return nn
 
 
@@ -143,32 +146,161 @@ def enable_grad_last_layers(model, enable_number_of_layers):
         param.requires_grad = True
 
 
-def get_network(
-    network_name,
-    cuda=True,
-    model_path=None,
-    cuda_device=0,
-    train_last_layers=None,
-):
-    torch.cuda.empty_cache()
-
-    model = None
+def load_network(network_name, cuda, model_path, cuda_device):
     if network_name == "VICCT":
-        model = load_transformer(model_path, cuda, cuda_device)
+        return load_transformer(model_path, cuda, cuda_device)
     elif network_name == "CSRNet":
-        model = load_csrnet(model_path, cuda, cuda_device)
+        return load_csrnet(model_path, cuda, cuda_device)
     elif network_name == "Yolo v3":
-        model = load_yolo(model_path, cuda, cuda_device)
+        return load_yolo(model_path, cuda, cuda_device)
     elif network_name == "Yolo v5s":
-        model = yolov5s(model_path, cuda, cuda_device)
+        return yolov5s(model_path, cuda, cuda_device)
     elif network_name == "Line of Interest Density":
-        model = load_loi(model_path, cuda, cuda_device)
+        return load_loi(model_path, cuda, cuda_device)
     elif network_name == "Line of Interest Density 2":
-        model = load_loi2(model_path, cuda, cuda_device)
+        return load_loi2(model_path, cuda, cuda_device)
     elif network_name == "Yolo v3 Garbage":
-        model = load_garb(model_path, cuda, cuda_device)
+        return load_garb(model_path, cuda, cuda_device)
 
-    if train_last_layers:
-        enable_grad_last_layers(model, train_last_layers)
+    return None
 
-    return model
+
+def get_model_size(model):
+    return sum(
+        tensor.numel() * tensor.element_size()
+        for tensor in list(model.parameters()) + list(model.buffers())
+    )
+
+
+class NetworkCache:
+    """
+    Process wide cache of loaded networks, keyed on (network name,
+    checkpoint path, checkpoint mtime, device) so a checkpoint that is
+    overwritten is loaded again. When the networks on a GPU would exceed
+    the memory budget the least recently used ones are evicted first.
+    """
+
+    def __init__(self, gpu_memory_budget=None):
+        # bytes per cuda device, None is unlimited
+        self.gpu_memory_budget = gpu_memory_budget
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.load_times = {}
+
+    def get_key(self, network_name, model_path, device):
+        mtime = None
+        if model_path and os.path.exists(model_path):
+            mtime = os.path.getmtime(model_path)
+        return (network_name, model_path, mtime, str(device))
+
+    def device_usage(self, device):
+        return sum(
+            size for key, (_, size) in self.entries.items()
+            if key[3] == device
+        )
+
+    def evict_for(self, device, size):
+        if self.gpu_memory_budget is None or not device.startswith('cuda'):
+            return
+
+        evicted = False
+        for key in list(self.entries.keys()):
+            if self.device_usage(device) + size <= self.gpu_memory_budget:
+                break
+            if key[3] == device:
+                print('evict network from cache', key)
+                del self.entries[key]
+                evicted = True
+
+        if evicted:
+            torch.cuda.empty_cache()
+
+    def get(self, network_name, cuda, model_path, cuda_device):
+        device = get_device(cuda, cuda_device)
+        key = self.get_key(network_name, model_path, device)
+
+        with self.lock:
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key][0]
+
+            self.misses += 1
+            start = time.time()
+            model = load_network(network_name, cuda, model_path, cuda_device)
+            if model is None:
+                return None
+
+            size = get_model_size(model)
+            self.load_times[key] = time.time() - start
+            print('loaded {} from {} on {} in {:.2f}s ({:.1f} MB)'.format(
+                network_name,
+                model_path,
+                device,
+                self.load_times[key],
+                size / 1024 / 1024))
+
+            self.evict_for(key[3], size)
+            self.entries[key] = (model, size)
+            return model
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'networks': len(self.entries),
+                'load_seconds': sum(self.load_times.values())
+            }
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        torch.cuda.empty_cache()
+
+
+def get_gpu_memory_budget():
+    """
+    Optional "network_cache": {"gpu_memory_budget_mb": ...} in config.json
+    """
+    try:
+        budget = load().get('network_cache', {}).get('gpu_memory_budget_mb')
+    except Exception:
+        return None
+
+    return None if budget is None else int(budget) * 1024 * 1024
+
+
+network_cache = None
+
+
+def get_network_cache():
+    global network_cache
+    if network_cache is None:
+        network_cache = NetworkCache(get_gpu_memory_budget())
+    return network_cache
+
+
+def get_network(
+    network_name,
+    cuda=True,
+    model_path=None,
+    cuda_device=0,
+    train_last_layers=None,
+    shared=True,
+):
+    """
+    With shared the network comes from the process-wide cache, for
+    inference only. Training callers pass shared=False and get their own
+    copy, so the cache never hands out a network that is being trained.
+    """
+    if train_last_layers or not shared:
+        model = load_network(network_name, cuda, model_path, cuda_device)
+        if train_last_layers:
+            enable_grad_last_layers(model, train_last_layers)
+        return model
+
+    return get_network_cache().get(
+        network_name, cuda, model_path, cuda_device)
@@ -1,16 +1,127 @@
+import sys
+import time
+import atexit
+import threading
+from urllib.parse import quote
 from postgres import Postgres
+from postgres.cursors import SimpleNamedTupleCursor
 from eelib.config import load
 
 DB = None
 
-def connect(config=None):
-    global DB
-    if DB is not None:
-        return DB
+# defaults for the optional keys in the postgres section of config.json
+POOL_MIN = 1
+POOL_MAX = 10
+# milliseconds, None leaves the server setting alone
+STATEMENT_TIMEOUT = None
+
+connect_lock = threading.Lock()
+local = threading.local()
+
+stats_lock = threading.Lock()
+# store function name -> [cursor checkouts, queries, total seconds, max seconds]
+query_stats = {}
+
+
+def record_query(name, queries, duration):
+    with stats_lock:
+        entry = query_stats.setdefault(name, [0, 0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += queries
+        entry[2] += duration
+        entry[3] = max(entry[3], duration)
+
+
+def get_stats():
+    with stats_lock:
+        return {
+            name: {
+                'calls': calls,
+                'queries': queries,
+                'total': total,
+                'avg': total / calls if calls else 0.0,
+                'max': maximum
+            }
+            for name, (calls, queries, total, maximum) in query_stats.items()
+        }
+
+
+def report_stats():
+    stats = get_stats()
+    if len(stats) == 0:
+        return
+
+    print('database usage per store function:')
+    for name, entry in sorted(
+        stats.items(), key=lambda item: item[1]['total'], reverse=True
+    ):
+        print(
+            "  {}: {calls} calls, {queries} queries, total {total:.3f}s, "
+            "avg {avg:.4f}s, max {max:.4f}s".format(name, **entry))
+
+
+class InstrumentedCursor(SimpleNamedTupleCursor):
+    """
+    Counts the statements executed on the cursor, so that a store function
+    that runs several queries (or pages of a bulk insert) is reported as such.
+    """
+
+    def execute(self, query, vars=None):
+        self.query_count = getattr(self, 'query_count', 0) + 1
+        return super().execute(query, vars)
+
+
+def caller_name():
+    # first frame outside this module, normally a function in eelib.store
+    frame = sys._getframe(2)
+    while frame is not None and frame.f_globals.get('__name__') == __name__:
+        frame = frame.f_back
+
+    if frame is None:
+        return 'unknown'
+
+    return '{}.{}'.format(
+        frame.f_globals.get('__name__', '?'), frame.f_code.co_name)
+
+
+class CursorContext:
+    """
+    Wraps the cursor context of the pool. Inside a transaction() the cursor
+    of the transaction is reused and nothing is committed on exit.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.context = None
+        self.cursor = None
+        self.start = None
+        self.queries_before = 0
+
+    def __enter__(self):
+        self.start = time.time()
+        transaction_cursor = getattr(local, 'cursor', None)
+        if transaction_cursor is not None:
+            self.cursor = transaction_cursor
+        else:
+            self.context = DB.get_cursor()
+            self.cursor = self.context.__enter__()
+
+        self.queries_before = getattr(self.cursor, 'query_count', 0)
+        return self.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if self.context is not None:
+                return self.context.__exit__(exc_type, exc_value, traceback)
+            return False
+        finally:
+            record_query(
+                self.name,
+                getattr(self.cursor, 'query_count', 0) - self.queries_before,
+                time.time() - self.start)
 
-    if config is None:
-        config = load()['postgres']
 
+def build_url(config):
     url = 'postgresql://{}:{}@{}/{}'.format(
             config['username'],
             config['password'],
@@ -18,14 +129,88 @@ def connect(config=None):
             config['database']
     )
 
-    DB = Postgres(url=url)
+    statement_timeout = config.get('statement_timeout', STATEMENT_TIMEOUT)
+    if statement_timeout is not None:
+        url += '?options={}'.format(
+            quote('-c statement_timeout={}'.format(int(statement_timeout))))
+
+    return url
+
+
+def connect(config=None):
+    """
+    Creates the connection pool shared by all threads of the process.
+
+    Optional keys in the postgres config: pool_min and pool_max (number of
+    connections), statement_timeout (milliseconds) and report_stats (print
+    the query statistics when the process exits).
+    """
+    global DB
+    if DB is not None:
+        return DB
+
+    with connect_lock:
+        if DB is not None:
+            return DB
+
+        if config is None:
+            config = load()['postgres']
+
+        pool_min = int(config.get('pool_min', POOL_MIN))
+        pool_max = max(pool_min, int(config.get('pool_max', POOL_MAX)))
+
+        DB = Postgres(
+            url=build_url(config),
+            minconn=pool_min,
+            maxconn=pool_max,
+            cursor_factory=InstrumentedCursor
+        )
+
+        if config.get('report_stats', False):
+            atexit.register(report_stats)
+
     return DB
 
+
 def get_cursor():
     global DB
     if DB is None:
         raise Exception('no db connection')
-    return DB.get_cursor()
+    return CursorContext(caller_name())
+
+
+class transaction:
+    """
+    Groups all store calls made by this thread inside the with block into
+    one transaction, committed when the block exits and rolled back when it
+    raises. Nested transaction() blocks join the outer one.
+
+        with pg.transaction():
+            store.insert_dataset_if_not_exists(name, nn_type_id)
+            store.insert_gts(rows)
+    """
+
+    def __init__(self):
+        self.context = None
+
+    def __enter__(self):
+        if DB is None:
+            raise Exception('no db connection')
+
+        if getattr(local, 'cursor', None) is not None:
+            return local.cursor
+
+        self.context = DB.get_cursor()
+        local.cursor = self.context.__enter__()
+        return local.cursor
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.context is None:
+            return False
+
+        local.cursor = None
+        return self.context.__exit__(exc_type, exc_value, traceback)
+
 
 def one(query, params=None):
     with get_cursor() as cursor:
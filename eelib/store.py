@@ -1,4 +1,62 @@
 import eelib.postgres as pg
+from psycopg2.extras import execute_values
+
+
+# rows per INSERT statement of the bulk inserts
+BULK_PAGE_SIZE = 1000
+
+
+def insert_many(table, columns, rows, match_columns=None, on_conflict=False):
+    """
+    Inserts rows (tuples in the order of columns) in a single transaction
+    and returns (inserted, skipped).
+
+    columns: list of (name, sql type), the type is needed so that NULL
+    values and literals compare against the existing rows.
+    on_conflict: skip rows that violate a unique constraint of the table.
+    match_columns: skip rows that equal an existing row on these columns,
+    for tables without a unique constraint.
+    """
+    rows = list(rows)
+    if len(rows) == 0:
+        return 0, 0
+
+    names = ', '.join(name for name, _ in columns)
+    template = '({})'.format(
+        ', '.join('%s::{}'.format(sql_type) for _, sql_type in columns))
+
+    if match_columns is not None:
+        match = ', '.join('v.{}'.format(name) for name in match_columns)
+        condition = ' AND '.join(
+            't.{0} = v.{0}'.format(name) for name in match_columns)
+        query = """
+            INSERT INTO {table} ({names})
+            SELECT DISTINCT ON ({match}) {values}
+            FROM (VALUES %s) AS v ({names})
+            WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {condition})
+            RETURNING 1
+        """.format(
+            table=table,
+            names=names,
+            match=match,
+            values=', '.join('v.{}'.format(name) for name, _ in columns),
+            condition=condition
+        )
+    else:
+        query = 'INSERT INTO {} ({}) VALUES %s {} RETURNING 1'.format(
+            table, names, 'ON CONFLICT DO NOTHING' if on_conflict else '')
+
+    with pg.get_cursor() as cursor:
+        inserted = len(execute_values(
+            cursor,
+            query,
+            rows,
+            template=template,
+            page_size=BULK_PAGE_SIZE,
+            fetch=True
+        ))
+
+    return inserted, len(rows) - inserted
 
 
 def update_video_capture_stream_path(job_id, output_stream_path):
@@ -210,6 +268,37 @@ def get_frames_with_tags_ordered_for_loi_dataset_id(dataset_id):
         )
 
 
+def insert_frame_pairs_loi_dataset_if_not_exist(rows):
+    """
+    rows: iterable of (input_frame_id, target_frame_id, dataset_id)
+    """
+    return insert_many(
+        'frame_pair_loi_dataset',
+        [
+            ('input_frame_id', 'integer'),
+            ('target_frame_id', 'integer'),
+            ('dataset_id', 'integer')
+        ],
+        rows,
+        match_columns=['input_frame_id', 'target_frame_id', 'dataset_id']
+    )
+
+
+def insert_frame_loi_datasets(rows):
+    """
+    rows: iterable of (order_index, frame_id, dataset_id)
+    """
+    return insert_many(
+        'frame_loi_dataset',
+        [
+            ('order_index', 'integer'),
+            ('frame_id', 'integer'),
+            ('dataset_id', 'integer')
+        ],
+        rows
+    )
+
+
 def insert_frame_loi_dataset(order_index, frame_id, dataset_id):
     query = """
         INSERT INTO frame_loi_dataset (frame_id, dataset_id, order_index)
@@ -384,6 +473,119 @@ def delete_frame_metadata(id):
             }
         )
 
+def delete_unlocked_frames_by_collection_id(id):
+    """
+    Deletes the unlocked frames of the collection that are not used by a
+    dataset, together with their metadata, tags, bounding boxes and links
+    to collections, in one transaction. The paths of the deleted frames
+    are added to pending_unlink, the files are removed afterwards by
+    unlink_pending_files. Returns (deleted, referenced) frame counts.
+    """
+    with pg.get_cursor() as cursor:
+        cursor.run(
+            """
+            CREATE TEMP TABLE collection_frames_to_delete ON COMMIT DROP AS
+            WITH unlocked AS (
+                SELECT frames.id, frames.path
+                FROM frames
+                JOIN collection_frame ON collection_frame.frame_id = frames.id
+                WHERE collection_frame.collection_id = %(id)s
+                AND (frames.locked = false OR frames.locked is null)
+            )
+            SELECT
+                unlocked.id,
+                unlocked.path,
+                (
+                    EXISTS (
+                        SELECT 1 FROM ground_truths
+                        WHERE ground_truths.frame_id = unlocked.id
+                    )
+                    OR EXISTS (
+                        SELECT 1 FROM frame_object_recognition_dataset fod
+                        WHERE fod.frame_id = unlocked.id
+                    )
+                    OR EXISTS (
+                        SELECT 1 FROM frame_pair_loi_dataset fpd
+                        WHERE fpd.input_frame_id = unlocked.id
+                        OR fpd.target_frame_id = unlocked.id
+                    )
+                ) AS referenced
+            FROM unlocked
+            """,
+            {
+                "id": id
+            }
+        )
+
+        referenced = cursor.one(
+            """
+            SELECT count(*) FROM collection_frames_to_delete
+            WHERE referenced
+            """
+        )
+
+        for table, column in [
+            ('frames_metadata', 'frames_id'),
+            ('collection_frame', 'frame_id'),
+            ('tags', 'frame_id'),
+            ('bounding_boxes', 'frame_id')
+        ]:
+            cursor.run(
+                """
+                DELETE FROM {table} WHERE {column} IN (
+                    SELECT id FROM collection_frames_to_delete
+                    WHERE NOT referenced
+                )
+                """.format(table=table, column=column)
+            )
+
+        cursor.run(
+            """
+            INSERT INTO pending_unlink (path)
+            SELECT DISTINCT path FROM collection_frames_to_delete
+            WHERE NOT referenced
+            ON CONFLICT DO NOTHING
+            """
+        )
+
+        deleted = cursor.one(
+            """
+            WITH deleted AS (
+                DELETE FROM frames WHERE id IN (
+                    SELECT id FROM collection_frames_to_delete
+                    WHERE NOT referenced
+                )
+                RETURNING 1
+            )
+            SELECT count(*) FROM deleted
+            """
+        )
+
+        cursor.run("DROP TABLE collection_frames_to_delete")
+
+    return deleted, referenced
+
+
+def get_pending_unlinks(limit=None):
+    with pg.get_cursor() as cursor:
+        return cursor.all(
+            "SELECT path FROM pending_unlink ORDER BY created_at LIMIT %(limit)s",
+            {
+                "limit": limit
+            }
+        )
+
+
+def delete_pending_unlinks(paths):
+    with pg.get_cursor() as cursor:
+        return cursor.run(
+            "DELETE FROM pending_unlink WHERE path = ANY(%(paths)s)",
+            {
+                "paths": list(paths)
+            }
+        )
+
+
 def get_unlocked_frames_by_collection_id(id):
     with pg.get_cursor() as cursor:
         return cursor.all(
@@ -629,6 +831,51 @@ def insert_gt(frame_id, dataset_id, gt_path, render_path):
         )
         return True
 
+def insert_gts(rows):
+    """
+    rows: iterable of (frame_id, dataset_id, gt_path, render_path),
+    inserted in one transaction.
+    """
+    inserted, _ = insert_many(
+        'ground_truths',
+        [
+            ('frame_id', 'integer'),
+            ('dataset_id', 'integer'),
+            ('path', 'text'),
+            ('render_path', 'text')
+        ],
+        rows
+    )
+    return inserted
+
+def get_frame_ids_with_gt_for_dataset(dataset_id):
+    with pg.get_cursor() as cursor:
+        return cursor.all(
+            'SELECT DISTINCT frame_id FROM ground_truths WHERE dataset_id = %(did)s',
+            {
+                'did': dataset_id
+            }
+        )
+
+def get_frames_with_tags_by_ids(frame_ids):
+    query = """
+        SELECT
+            frames.*,
+            array_remove(array_agg(tags.x), NULL) as tags_x,
+            array_remove(array_agg(tags.y), NULL) as tags_y
+        FROM frames
+        LEFT JOIN tags ON frames.id = tags.frame_id
+        WHERE frames.id = ANY(%(ids)s)
+        GROUP BY frames.id
+    """
+    with pg.get_cursor() as cursor:
+        return cursor.all(
+            query,
+            {
+                'ids': list(frame_ids)
+            }
+        )
+
 def insert_dataset_if_not_exists(name, nn_type_id):
     with pg.get_cursor() as cursor:
         result = cursor.one(
@@ -703,6 +950,35 @@ def insert_bounding_box_if_not_exists(frame_id, label_id, x, y, w, h):
         )
         return True
 
+def insert_tags_if_not_exist(rows):
+    """
+    rows: iterable of (frame_id, x, y)
+    """
+    return insert_many(
+        'tags',
+        [('frame_id', 'integer'), ('x', 'integer'), ('y', 'integer')],
+        rows,
+        match_columns=['frame_id', 'x', 'y']
+    )
+
+def insert_bounding_boxes_if_not_exist(rows):
+    """
+    rows: iterable of (frame_id, label_id, x, y, w, h)
+    """
+    return insert_many(
+        'bounding_boxes',
+        [
+            ('frame_id', 'integer'),
+            ('label_id', 'integer'),
+            ('x', 'real'),
+            ('y', 'real'),
+            ('w', 'real'),
+            ('h', 'real')
+        ],
+        rows,
+        on_conflict=True
+    )
+
 def get_stream_roi_by_id(id):
     with pg.get_cursor() as cursor:
         return cursor.one(
@@ -747,6 +1023,15 @@ def insert_frame_object_recognition_dataset(frame_id, dataset_id):
         )
 
 
+def insert_frame_object_recognition_datasets(frame_ids, dataset_id):
+    return insert_many(
+        'frame_object_recognition_dataset',
+        [('frame_id', 'integer'), ('dataset_id', 'integer')],
+        ((frame_id, dataset_id) for frame_id in frame_ids),
+        on_conflict=True
+    )
+
+
 def insert_collection_if_not_exists(collection_name):
     with pg.get_cursor() as cursor:
         result = cursor.one('SELECT * FROM collections WHERE name=%(name)s', { 'name': collection_name })
@@ -824,6 +1109,32 @@ def insert_frame_if_not_exists_with_timestamp(
         )
 
 
+def insert_frames_with_timestamp(rows):
+    """
+    rows: iterable of (video_file_id, path, timestamp, hidden_to_user)
+    with new frame paths. Returns a dict from path to the new frame id.
+    """
+    rows = list(rows)
+    if len(rows) == 0:
+        return {}
+
+    with pg.get_cursor() as cursor:
+        inserted = execute_values(
+            cursor,
+            """
+                INSERT INTO frames
+                    (video_file_id, path, timestamp, hidden_to_user)
+                VALUES %s
+                RETURNING path, id
+            """,
+            rows,
+            page_size=BULK_PAGE_SIZE,
+            fetch=True
+        )
+
+    return {row.path: row.id for row in inserted}
+
+
 def insert_collection_frame_if_not_exists(col_id, frame_id):
     with pg.get_cursor() as cursor:
         result = cursor.one('SELECT * FROM collection_frame WHERE collection_id=%(col_id)s AND frame_id=%(frame_id)s', {
@@ -840,6 +1151,45 @@ def insert_collection_frame_if_not_exists(col_id, frame_id):
         return True
 
 
+def insert_collection_frames_if_not_exist(col_id, frame_ids):
+    return insert_many(
+        'collection_frame',
+        [('collection_id', 'integer'), ('frame_id', 'integer')],
+        ((col_id, frame_id) for frame_id in frame_ids),
+        on_conflict=True
+    )
+
+
+def insert_collection_frames_from_collection(col_id, source_col_id):
+    """
+    Adds all frames of the source collection to the collection with one
+    INSERT ... SELECT. Returns (inserted, skipped).
+    """
+    with pg.get_cursor() as cursor:
+        total = cursor.one(
+            "SELECT count(*) FROM collection_frame WHERE collection_id = %(sid)s",
+            {
+                "sid": source_col_id
+            }
+        )
+        inserted = len(cursor.all(
+            """
+            INSERT INTO collection_frame (collection_id, frame_id)
+            SELECT %(cid)s, frame_id
+            FROM collection_frame
+            WHERE collection_id = %(sid)s
+            ON CONFLICT DO NOTHING
+            RETURNING 1
+            """,
+            {
+                "cid": col_id,
+                "sid": source_col_id
+            }
+        ))
+
+    return inserted, total - inserted
+
+
 def insert_video_file_if_not_exists(video_path):
     with pg.get_cursor() as cursor:
         result = cursor.one(
@@ -1015,6 +1365,15 @@ def get_frame_with_video_by_id(id):
     with pg.get_cursor() as cursor:
         return cursor.one(query, { 'id': id })
 
+def get_frames_with_video_by_ids(ids):
+    query = """
+        SELECT frames.*, video_files.path as video_file_path FROM frames
+        LEFT JOIN video_files ON frames.video_file_id = video_files.id
+        WHERE frames.id = ANY(%(ids)s)
+    """
+    with pg.get_cursor() as cursor:
+        return cursor.all(query, { 'ids': list(ids) })
+
 def get_frame_by_id(id):
     pg.connect()
     return pg.one('SELECT * FROM frames WHERE id=%(id)s', { 'id': id })
@@ -0,0 +1,67 @@
+import time
+import queue
+from collections import OrderedDict
+import eelib.stream.global_variables as global_variables
+
+
+class MicroBatchScheduler:
+    """
+    Sits between the predict queue and the model. Collects frames of
+    several streams and groups them by a key (model, device, input
+    resolution, ...) so every group can be predicted in one forward pass.
+
+    A collection round is closed when max_batch_size frames have been
+    collected or when max_wait seconds have passed since the first frame
+    of the round arrived.
+    """
+
+    def __init__(self, predictq, key_fn, max_batch_size=8, max_wait=0.5):
+        self.predictq = predictq
+        self.key_fn = key_fn
+        self.max_batch_size = max(1, int(max_batch_size or 1))
+        self.max_wait = max(0, float(max_wait or 0))
+        self.done = False
+
+    def _collect(self):
+        first = self.predictq.get(block=True)
+        if first is None or global_variables.g_run_capture is False:
+            self.done = True
+            return []
+
+        items = [first]
+        deadline = time.time() + self.max_wait
+        while len(items) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+
+            try:
+                data = self.predictq.get(block=True, timeout=remaining)
+            except queue.Empty:
+                break
+
+            if data is None or global_variables.g_run_capture is False:
+                self.done = True
+                break
+
+            items.append(data)
+
+        return items
+
+    def get_batches(self):
+        """
+        Returns a list of (key, [data, ...]) groups in arrival order, or
+        None when the end of the stream has been reached.
+        """
+        if self.done:
+            return None
+
+        items = self._collect()
+        if len(items) == 0:
+            return None
+
+        groups = OrderedDict()
+        for data in items:
+            groups.setdefault(self.key_fn(data), []).append(data)
+
+        return list(groups.items())
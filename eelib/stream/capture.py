@@ -1,12 +1,12 @@
 import sys
 import torch
 import threading
-import queue
 import eelib.store as store
 from eelib.stream.stream_utils import (
     open_capture,
     frame_consumer_thread,
-    remove_stream_files
+    remove_stream_files,
+    capture_stopped
 )
 from eelib.stream.stream_object import predict_consumer_thread_object
 from eelib.stream.stream_object import output_consumer_thread_object
@@ -19,7 +19,13 @@ from eelib.stream.stream_density import (
 from eelib.stream.stream_density import output_consumer_thread_density
 from eelib.stream.stream_loi_density import predict_consumer_thread_lc_density
 from eelib.stream.stream_loi_density import output_consumer_thread_lc_density
-from eelib.stream.stream_server import StreamServer
+from eelib.stream.stream_server import StreamServer, PIPE_FORMAT_RAW
+from eelib.stream.frame_queue import (
+    FrameQueue,
+    DEFAULT_QUEUE_SIZE,
+    POLICY_BLOCK,
+    POLICY_DROP_OLDEST
+)
 import eelib.stream.global_variables as global_variables
 import eelib.postgres as pg
 
@@ -102,7 +108,12 @@ def capture_stream(
     selected_device=0,
     save_images=False,
     scale_factor=1.0,
-    save_every=None
+    save_every=None,
+    tracking=False,
+    detect_every=1,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    queue_policy=POLICY_DROP_OLDEST,
+    pipe_format=PIPE_FORMAT_RAW
 ):
 
     pg.connect()
@@ -129,13 +140,25 @@ def capture_stream(
         'selected_gpu': selected_device,
         'save_images': save_images,
         'scale_factor': scale_factor,
-        'save_every': save_every
+        'save_every': save_every,
+        'tracking': tracking,
+        'detect_every': detect_every
     }]
 
-    frameq = queue.Queue(maxsize=0)
-    predictq = queue.Queue(maxsize=0)
-    outputq = queue.Queue(maxsize=0)
-    framewriteq = queue.Queue(maxsize=0) if save_images else None
+    # frames are dropped before prediction when inference falls behind,
+    # predicted frames wait for the output and video writers
+    frameq = FrameQueue(
+        'frame', queue_size, queue_policy, stop_waiting=capture_stopped)
+    predictq = FrameQueue(
+        'predict', queue_size, queue_policy, stop_waiting=capture_stopped)
+    outputq = FrameQueue(
+        'output', queue_size, POLICY_BLOCK, stop_waiting=capture_stopped)
+    framewriteq = (
+        FrameQueue(
+            'framewrite', queue_size, POLICY_BLOCK,
+            stop_waiting=capture_stopped) if save_images
+        else None
+    )
 
     # start all threads
     frame_consumer = threading.Thread(
@@ -165,7 +188,8 @@ def capture_stream(
        opencv_width,
        output_fps,
        name,
-       save_function
+       save_function,
+       pipe_format
     )
 
     def get_model(stream_index):
@@ -231,7 +255,7 @@ def capture_stream(
     if save_images:
         save_image_consumer = threading.Thread(
             target=save_image_thread,
-            args=[framewriteq, arguments],
+            args=[framewriteq, arguments, pipe_format],
             daemon=True
         )
 
@@ -262,6 +286,11 @@ def capture_stream(
     if save_images and network_type == 'density_estimation':
         save_image_consumer.join()
 
+    for q in [frameq, predictq, outputq, framewriteq]:
+        if q is not None:
+            q.report()
+    pg.report_stats()
+
     print('all threads joined main thread...close server')
     stream_server.close_server()
     print('server closed...')
@@ -0,0 +1,271 @@
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, wait
+import numpy as np
+from eelib.stream.stream_utils import extract_resolution
+
+FFMPEG_TIMEOUT = 10
+# seconds between checks of the grabs that are still running
+WAIT_INTERVAL = 0.5
+# back-off in seconds after a failed grab, doubled on every failure
+BACKOFF_START = 5
+BACKOFF_MAXIMUM = 300
+
+
+def build_grab_command(stream_url, fps=None):
+    command = ['ffmpeg', '-loglevel', 'quiet', '-y']
+    if stream_url.startswith('rtsp'):
+        command += [
+            '-rtsp_transport', 'tcp',
+            '-stimeout', str(FFMPEG_TIMEOUT * 1000000)
+        ]
+    command += ['-i', stream_url]
+
+    if fps is None:
+        command += ['-vframes', '1']
+    else:
+        command += ['-vf', 'fps={}'.format(fps)]
+
+    return command + [
+        '-f', 'image2pipe',
+        '-pix_fmt', 'rgb24',
+        '-vcodec', 'rawvideo',
+        '-'
+    ]
+
+
+def grab_single_frame(stream_url, resolution, timeout=FFMPEG_TIMEOUT):
+    width, height = resolution
+    process = subprocess.Popen(
+        build_grab_command(stream_url),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL)
+    try:
+        ffmpeg_output, _ = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.communicate()
+        raise Exception(f"Grabbing frame from {stream_url} timed out")
+
+    if process.returncode != 0 or len(ffmpeg_output) < width * height * 3:
+        raise Exception(f"Grabbing frame from {stream_url} failed")
+
+    return np.frombuffer(
+        ffmpeg_output[:width * height * 3], dtype='uint8'
+    ).reshape(height, width, 3)
+
+
+class PersistentSession:
+    """
+    Keeps one ffmpeg decoder running for a camera that emits frames at a
+    low rate. A reader thread keeps only the latest frame, so grabbing a
+    frame does not need a new RTSP handshake.
+    """
+
+    def __init__(self, stream_url, resolution, fps):
+        self.stream_url = stream_url
+        self.width, self.height = resolution
+        self.latest_frame = None
+        self.latest_time = None
+        self.lock = threading.Lock()
+        self.process = subprocess.Popen(
+            build_grab_command(stream_url, fps),
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def _read(self):
+        frame_size = self.width * self.height * 3
+        while True:
+            data = self.process.stdout.read(frame_size)
+            if data is None or len(data) < frame_size:
+                break
+
+            frame = np.frombuffer(data, dtype='uint8').reshape(
+                self.height, self.width, 3)
+            with self.lock:
+                self.latest_frame = frame
+                self.latest_time = time.time()
+
+    def is_alive(self):
+        return self.process.poll() is None
+
+    def get_frame(self, max_age, timeout=FFMPEG_TIMEOUT):
+        """
+        Returns the latest frame that is not older than max_age seconds,
+        waiting at most timeout seconds for one to arrive.
+        """
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                if (
+                    self.latest_frame is not None and
+                    time.time() - self.latest_time <= max_age
+                ):
+                    return self.latest_frame
+
+            if not self.is_alive():
+                break
+            time.sleep(0.1)
+
+        raise Exception(f"No recent frame from {self.stream_url}")
+
+    def close(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+
+
+class CameraState:
+    def __init__(self, stream_url):
+        self.stream_url = stream_url
+        self.resolution = None
+        self.session = None
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_success = None
+        self.future = None
+        # set by the worker when the grab of this cycle starts running
+        self.grab_started = None
+
+    def is_available(self, now):
+        # a grab from a previous cycle that is still hanging blocks new ones
+        if self.future is not None and not self.future.done():
+            return False
+        return now >= self.next_attempt
+
+    def mark_success(self):
+        self.failures = 0
+        self.next_attempt = 0
+        self.last_success = time.time()
+
+    def mark_failure(self):
+        self.failures += 1
+        backoff = min(
+            BACKOFF_MAXIMUM, BACKOFF_START * 2 ** (self.failures - 1))
+        self.next_attempt = time.time() + backoff
+        print("camera {} failed {} times, back-off {} seconds".format(
+            self.stream_url, self.failures, backoff))
+
+
+class FrameGrabberPool:
+    """
+    Grabs a frame from every camera in parallel with a bounded thread pool.
+    Cameras that fail are skipped until their back-off has passed, so a
+    slow camera only delays itself. The timeout of a grab starts when a
+    worker picks it up, not when it is queued, so cameras that wait for a
+    free worker are not counted as failed.
+    """
+
+    def __init__(
+        self,
+        stream_urls,
+        max_workers=8,
+        cycle_seconds=60,
+        persistent_sessions=False,
+        timeout=FFMPEG_TIMEOUT
+    ):
+        self.cameras = [CameraState(url) for url in stream_urls]
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, min(max_workers, len(self.cameras))))
+        self.cycle_seconds = cycle_seconds
+        self.persistent_sessions = persistent_sessions
+        self.timeout = timeout
+
+    def _grab(self, camera):
+        if camera.resolution is None:
+            camera.resolution = extract_resolution(camera.stream_url)
+            if camera.resolution is None:
+                raise Exception("error getting resolution for stream")
+
+        if not self.persistent_sessions:
+            return grab_single_frame(
+                camera.stream_url, camera.resolution, self.timeout)
+
+        if camera.session is None or not camera.session.is_alive():
+            if camera.session is not None:
+                camera.session.close()
+            camera.session = PersistentSession(
+                camera.stream_url,
+                camera.resolution,
+                '1/{}'.format(self.cycle_seconds))
+
+        return camera.session.get_frame(self.cycle_seconds, self.timeout)
+
+    def _run_grab(self, camera):
+        camera.grab_started = time.time()
+        try:
+            return self._grab(camera)
+        except Exception:
+            # the session is only closed by the worker that uses it
+            if camera.session is not None:
+                camera.session.close()
+                camera.session = None
+            raise
+
+    def is_timed_out(self, camera):
+        # sessions wait at most self.timeout, one-shot grabs are killed
+        return (
+            camera.grab_started is not None and
+            time.time() - camera.grab_started > self.timeout * 2
+        )
+
+    def grab_all(self):
+        """
+        Returns a list with a frame (or None) for every camera, in the
+        order the stream urls were given.
+        """
+        now = time.time()
+        futures = {}
+        for stream_index, camera in enumerate(self.cameras):
+            if camera.is_available(now):
+                camera.grab_started = None
+                camera.future = self.executor.submit(self._run_grab, camera)
+                futures[stream_index] = camera.future
+
+        # wait for every grab until it is done or past its own timeout,
+        # queued grabs are waited for at most one cycle
+        cycle_deadline = now + max(self.cycle_seconds, self.timeout * 2)
+        while time.time() < cycle_deadline:
+            waiting = [
+                future for stream_index, future in futures.items()
+                if not future.done() and
+                not self.is_timed_out(self.cameras[stream_index])
+            ]
+            if len(waiting) == 0:
+                break
+            wait(waiting, timeout=WAIT_INTERVAL)
+
+        frames = [None] * len(self.cameras)
+        for stream_index, future in futures.items():
+            camera = self.cameras[stream_index]
+            if not future.done():
+                if self.is_timed_out(camera):
+                    print("grab frame timed out", camera.stream_url)
+                    camera.mark_failure()
+                else:
+                    print("grab frame did not start this cycle",
+                          camera.stream_url)
+                continue
+
+            try:
+                frames[stream_index] = future.result()
+                camera.mark_success()
+            except Exception as e:
+                print("extract frame ERROR", camera.stream_url, e)
+                camera.mark_failure()
+
+        return frames
+
+    def close(self):
+        for camera in self.cameras:
+            if camera.future is not None:
+                camera.future.cancel()
+        # running grabs are bounded by the timeout, their sessions are
+        # closed after they are done
+        self.executor.shutdown(wait=True)
+        for camera in self.cameras:
+            if camera.session is not None:
+                camera.session.close()
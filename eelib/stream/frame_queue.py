@@ -0,0 +1,176 @@
+import time
+import queue
+import threading
+from collections import deque
+
+# producer waits until there is room
+POLICY_BLOCK = 'block'
+# the oldest frame in the queue is dropped to make room
+POLICY_DROP_OLDEST = 'drop_oldest'
+# only the newest frame is kept
+POLICY_KEEP_LATEST = 'keep_latest'
+
+POLICIES = [POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_KEEP_LATEST]
+
+DEFAULT_QUEUE_SIZE = 25
+# seconds between printing queue statistics
+REPORT_INTERVAL = 60
+# seconds a blocked producer waits before checking stop_waiting again
+STOP_POLL_INTERVAL = 0.5
+
+
+def is_droppable(data):
+    # None stops the consumers, frame 0 initializes them
+    return data is not None and data.get('frame_num') != 0
+
+
+class FrameQueue:
+    """
+    Bounded replacement for queue.Queue in the stream pipeline. When the
+    consumer falls behind, the policy decides whether the producer blocks
+    or frames are dropped, so a live stream can never lag more than
+    maxsize frames behind.
+
+    The end of stream sentinel (None) and frames that are not droppable
+    are always enqueued, even when the queue is full.
+
+    With POLICY_BLOCK, stop_waiting() is checked while a producer waits
+    for room. Once it returns True the item is dropped instead, so a
+    producer never hangs on a consumer that has stopped reading.
+    """
+
+    def __init__(
+        self,
+        name,
+        maxsize=DEFAULT_QUEUE_SIZE,
+        policy=POLICY_DROP_OLDEST,
+        can_drop=is_droppable,
+        report_interval=REPORT_INTERVAL,
+        stop_waiting=None
+    ):
+        if policy not in POLICIES:
+            raise ValueError('Unknown queue policy: {}'.format(policy))
+
+        self.name = name
+        self.policy = policy
+        self.maxsize = 1 if policy == POLICY_KEEP_LATEST else max(1, maxsize)
+        self.can_drop = can_drop
+        self.report_interval = report_interval
+        self.stop_waiting = stop_waiting
+
+        self.items = deque()
+        self.condition = threading.Condition()
+
+        self.put_count = 0
+        self.get_count = 0
+        self.drop_count = 0
+        self.max_depth = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_report = time.time()
+
+    def _drop_one(self):
+        for idx, (item, _) in enumerate(self.items):
+            if self.can_drop(item):
+                del self.items[idx]
+                self.drop_count += 1
+                return True
+
+        return False
+
+    def put(self, item, block=True, timeout=None):
+        with self.condition:
+            if item is not None and len(self.items) >= self.maxsize:
+                if self.policy == POLICY_BLOCK and self.can_drop(item):
+                    if not block:
+                        raise queue.Full
+                    if not self._wait_for_room(timeout):
+                        if timeout is None:
+                            # stop_waiting returned True
+                            self.drop_count += 1
+                            return
+                        raise queue.Full
+                else:
+                    while (
+                        len(self.items) >= self.maxsize and self._drop_one()
+                    ):
+                        pass
+
+            self.items.append((item, time.time()))
+            self.put_count += 1
+            self.max_depth = max(self.max_depth, len(self.items))
+            self.condition.notify_all()
+
+    def _wait_for_room(self, timeout):
+        def has_room():
+            return len(self.items) < self.maxsize
+
+        if self.stop_waiting is None or timeout is not None:
+            return self.condition.wait_for(has_room, timeout)
+
+        while not self.condition.wait_for(has_room, STOP_POLL_INTERVAL):
+            if self.stop_waiting():
+                return False
+
+        return True
+
+    def put_nowait(self, item):
+        # keeps the queue.Queue interface, the policy decides what happens
+        # when the queue is full
+        self.put(item, block=self.policy == POLICY_BLOCK)
+
+    def get(self, block=True, timeout=None):
+        with self.condition:
+            if not block and len(self.items) == 0:
+                raise queue.Empty
+            if not self.condition.wait_for(
+                lambda: len(self.items) > 0, timeout
+            ):
+                raise queue.Empty
+
+            item, enqueued_at = self.items.popleft()
+            latency = time.time() - enqueued_at
+            self.get_count += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+            self.condition.notify_all()
+
+        if time.time() - self.last_report > self.report_interval:
+            self.report()
+
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def qsize(self):
+        with self.condition:
+            return len(self.items)
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def stats(self):
+        with self.condition:
+            return {
+                'name': self.name,
+                'policy': self.policy,
+                'depth': len(self.items),
+                'max_depth': self.max_depth,
+                'put': self.put_count,
+                'get': self.get_count,
+                'dropped': self.drop_count,
+                'avg_latency': (
+                    self.total_latency / self.get_count
+                    if self.get_count else 0.0),
+                'max_latency': self.max_latency
+            }
+
+    def report(self):
+        self.last_report = time.time()
+        stats = self.stats()
+        print(
+            "queue {name} ({policy}): depth {depth} (max {max_depth}), "
+            "put {put}, get {get}, dropped {dropped}, "
+            "latency avg {avg_latency:.3f}s max {max_latency:.3f}s".format(
+                **stats))
@@ -1,134 +1,95 @@
 import time
 import sys
 import threading
-import signal
-import psutil
-from threading import Event, Timer
-import subprocess
-import queue
+from threading import Event
 from collections import defaultdict
-from itertools import cycle
 import torch
-import numpy as np
 import eelib.stream.global_variables as global_variables
-from eelib.stream.stream_utils import frame_consumer_thread
-from eelib.stream.stream_object import predict_consumer_thread_object
+from eelib.stream.stream_utils import (
+    frame_consumer_thread,
+    capture_stopped
+)
+from eelib.stream.stream_object import predict_consumer_thread_object_batched
 from eelib.stream.stream_object import output_consumer_thread_object
-from eelib.stream.stream_utils import extract_resolution
-from eelib.stream.stream_density import predict_consumer_thread_density
+from eelib.stream.frame_grabber import FrameGrabberPool
+from eelib.stream.stream_density import predict_consumer_thread_density_batched
 from eelib.stream.stream_density import output_consumer_thread_density
 import eelib.store as store
+import eelib.postgres as pg
+from eelib.stream.frame_queue import (
+    FrameQueue,
+    DEFAULT_QUEUE_SIZE,
+    POLICY_BLOCK,
+    POLICY_DROP_OLDEST
+)
 
 FFMPEG_TIMEOUT = 10
+# every camera is grabbed once per cycle
+CYCLE_SECONDS = 60
+MAX_GRAB_WORKERS = 8
+# frames of multiple streams that are predicted in one forward pass
+MAX_BATCH_SIZE = 8
+# seconds to wait for more frames before running an incomplete batch
+MAX_BATCH_WAIT = 0.5
 
-def kill_child_processes(parent_pid, sig=signal.SIGTERM):
-    try:
-        parent = psutil.Process(parent_pid)
-    except psutil.NoSuchProcess:
-        return
-
-    children = parent.children(recursive=True)
-    for process in children:
-        process.send_signal(sig)
-
-    parent.send_signal(sig)
-
-
-def execute_with_timeout(command, timeout):
-    def kill_process(process):
-        kill_child_processes(process.pid)
-
-    process = subprocess.Popen(
-        ' '.join(command), shell=True, stdout=subprocess.PIPE)
-    timer = Timer(timeout, kill_process, args=[process])
-    timer.start()
-    result, _ = process.communicate()
-    timer.cancel()
-    if process.returncode != 0:
-        raise Exception(f"\"{' '.join(command)}\" failed, possibly terminated due to timeout")
-
-    return result
-
-
-def extract_frame(stream_url, resolution):
-    width, height = resolution
-    print('use timeout')
-    command = [
-            'ffmpeg',
-            '-loglevel', 'quiet',
-            '-y',
-            '-rtsp_transport', 'tcp',
-            '-i', stream_url,
-            '-stimeout', str(FFMPEG_TIMEOUT*1000000),
-            '-vframes', '1',
-            '-f', 'image2pipe',
-            '-pix_fmt', 'rgb24',
-            '-vcodec', 'rawvideo',
-            '-']
-    ffmpeg_output = execute_with_timeout(command, FFMPEG_TIMEOUT)
-    image = np.frombuffer(ffmpeg_output, dtype='uint8').reshape(height, width, 3)
-    return image
-
-
-def run_multicapture_streams(frameq, arguments):
-    proccess_time_seconds = 60 / len(arguments)
-    resolution_map = {}
+
+def run_multicapture_streams(
+    frameq,
+    arguments,
+    max_grab_workers=MAX_GRAB_WORKERS,
+    persistent_sessions=False
+):
+    grabber_pool = FrameGrabberPool(
+        [args['stream'] for args in arguments],
+        max_workers=max_grab_workers,
+        cycle_seconds=CYCLE_SECONDS,
+        persistent_sessions=persistent_sessions,
+        timeout=FFMPEG_TIMEOUT)
+    model_names = {
+        args['model']: store.get_model_by_id(args['model']).name
+        for args in arguments
+    }
 
     frame_numbers = defaultdict(lambda: 0)
     try:
-        for stream_index, args in cycle(zip(range(len(arguments)), arguments)):
-
-            print("extract stream", stream_index)
+        while global_variables.g_run_capture:
             start_time = time.time()
+            print("extract frames for {} streams".format(len(arguments)))
+
+            frames = grabber_pool.grab_all()
 
             if global_variables.g_run_capture is False:
                 print("breakout multicapture_stream")
                 break
 
-            try:
-                if args['stream'] not in resolution_map:
-                    print("get resolution", args['stream'])
-                    resolution = extract_resolution(args['stream'])
-                    if resolution is not None:
-                        resolution_map[args['stream']] = resolution
-                    else:
-                        print("error getting resolution")
-                        raise Exception("error getting resolution for stream")
-
-                print("extract frame", args['stream'])
-
-                frame = extract_frame(args['stream'], resolution_map[args['stream']])
-
-                if frame is not None:
-                    print("got frame")
-                    model = store.get_model_by_id(args['model'])
-                    frameq.put_nowait({
-                        'frame': frame,
-                        'url': args['stream'],
-                        'model_name': model.name,
-                        'frame_num': frame_numbers[stream_index],
-                        'stream_index': stream_index,
-                        'scale_factor': args['scale_factor'],
-                        'stream_name': args['name']
-                    })
-                    frame_numbers[stream_index] += 1
-                else:
-                    print("no ffmpeg error - but also no frame")
-            except ValueError as e:
-                print("extract frame ERROR", e)
-            except:
-                print("extract frame ERROR", sys.exc_info()[0])
-
-            end_time = time.time()
-            total_time = end_time - start_time
-            if total_time < proccess_time_seconds:
+            for stream_index, (args, frame) in enumerate(
+                zip(arguments, frames)
+            ):
+                if frame is None:
+                    continue
+
+                frameq.put_nowait({
+                    'frame': frame,
+                    'url': args['stream'],
+                    'model_name': model_names[args['model']],
+                    'frame_num': frame_numbers[stream_index],
+                    'stream_index': stream_index,
+                    'scale_factor': args['scale_factor'],
+                    'stream_name': args['name']
+                })
+                frame_numbers[stream_index] += 1
+
+            total_time = time.time() - start_time
+            print("grabbed {} frames in {:.2f} seconds".format(
+                sum(frame is not None for frame in frames), total_time))
+            if total_time < CYCLE_SECONDS:
                 print("wait")
                 global_variables.waiter = Event()
-                global_variables.waiter.wait(
-                    proccess_time_seconds - total_time)
+                global_variables.waiter.wait(CYCLE_SECONDS - total_time)
     except Exception as e:
         print("Exiting because of error predict thread:", e)
     finally:
+        grabber_pool.close()
         frameq.put_nowait(None)
         print("multicapture loop done")
 
@@ -139,14 +100,23 @@ def multicapture_stream(
     get_model,
     get_area_points,
     on_predict_callback,
-    neural_network_type
+    neural_network_type,
+    max_batch_size=MAX_BATCH_SIZE,
+    max_batch_wait=MAX_BATCH_WAIT,
+    max_grab_workers=MAX_GRAB_WORKERS,
+    persistent_sessions=False,
+    queue_size=DEFAULT_QUEUE_SIZE,
+    queue_policy=POLICY_DROP_OLDEST
 ):
 
     torch.cuda.empty_cache()
 
-    frameq = queue.Queue(maxsize=0)
-    predictq = queue.Queue(maxsize=0)
-    outputq = queue.Queue(maxsize=0)
+    frameq = FrameQueue(
+        'frame', queue_size, queue_policy, stop_waiting=capture_stopped)
+    predictq = FrameQueue(
+        'predict', queue_size, queue_policy, stop_waiting=capture_stopped)
+    outputq = FrameQueue(
+        'output', queue_size, POLICY_BLOCK, stop_waiting=capture_stopped)
 
     # start all threads
     frame_consumer = threading.Thread(
@@ -157,7 +127,8 @@ def multicapture_stream(
 
     if neural_network_type == 'object_recognition':
         predict_consumer = threading.Thread(
-            target=predict_consumer_thread_object,
+            target=predict_consumer_thread_object_batched(
+                max_batch_size, max_batch_wait),
             args=[predictq, outputq, arguments, get_model, get_area_points],
             daemon=True
         )
@@ -168,7 +139,8 @@ def multicapture_stream(
         )
     elif neural_network_type == 'density_estimation':
         predict_consumer = threading.Thread(
-            target=predict_consumer_thread_density(False),
+            target=predict_consumer_thread_density_batched(
+                False, max_batch_size, max_batch_wait),
             args=[predictq, outputq, transformFn, arguments, get_model,
                   get_area_points],
             daemon=True
@@ -180,7 +152,8 @@ def multicapture_stream(
         )
     elif neural_network_type == 'density_estimation_transformer':
         predict_consumer = threading.Thread(
-            target=predict_consumer_thread_density(True),
+            target=predict_consumer_thread_density_batched(
+                True, max_batch_size, max_batch_wait),
             args=[predictq, outputq, transformFn, arguments, get_model,
                   get_area_points],
             daemon=True
@@ -208,13 +181,18 @@ def multicapture_stream(
     predict_consumer.start()
     output_consumer.start()
 
-    run_multicapture_streams(frameq, arguments)
+    run_multicapture_streams(
+        frameq, arguments, max_grab_workers, persistent_sessions)
 
     print('wait for join()')
     frame_consumer.join()
     predict_consumer.join()
     output_consumer.join()
 
+    for q in [frameq, predictq, outputq]:
+        q.report()
+    pg.report_stats()
+
     for idx, args in enumerate(arguments):
         model = store.get_model_by_id(args['model'])
         on_predict_callback(
@@ -0,0 +1,150 @@
+import numpy as np
+import torch
+from eelib.ml_tracking.vectorized_sort import VectorizedSort
+
+# number of detector rounds a track survives without a matching detection
+TRACK_MAX_AGE = 1
+# detector rounds a track needs before it is reported
+TRACK_MIN_HITS = 3
+
+
+def get_track_point(box):
+    # bottom center of the box, where the person stands
+    return np.array([(box[0] + box[2]) / 2, box[3]])
+
+
+def side_of_line(point, line):
+    start, end = line
+    return np.sign(
+        (end[0] - start[0]) * (point[1] - start[1])
+        - (end[1] - start[1]) * (point[0] - start[0]))
+
+
+def crosses_segment(previous, current, line):
+    """
+    True when the movement from previous to current intersects the line
+    segment, so crossing the extension of the line is not counted.
+    """
+    if side_of_line(previous, line) * side_of_line(current, line) >= 0:
+        return False
+
+    movement = (previous, current)
+    return side_of_line(line[0], movement) * side_of_line(
+        line[1], movement) <= 0
+
+
+class StreamTracker:
+    """
+    SORT tracking state of one stream. The detector runs every
+    detect_every-th frame, the frames in between advance the Kalman
+    filters of the tracks without detections.
+
+    Tracks give the number of unique persons seen in the stream and the
+    crossings of the lines of interest: line_points are the stream loi
+    polygons, in coordinates relative to the frame size. Crossings are
+    counted per line as [left to right, right to left] of the line
+    direction, like the counts of the LOI density streams.
+    """
+
+    def __init__(self, detect_every=1, line_points=None):
+        self.detect_every = max(int(detect_every or 1), 1)
+        self.line_points = line_points or []
+        self.sort = VectorizedSort(
+            max_age=TRACK_MAX_AGE, min_hits=TRACK_MIN_HITS)
+        self.frames = 0
+        self.lines = None
+        self.positions = {}
+        self.unique_ids = set()
+        self.crossings = [[0, 0] for _ in self.line_points]
+
+    def should_detect(self):
+        return self.frames % self.detect_every == 0
+
+    def get_lines(self, image_shape):
+        if self.lines is None:
+            height, width = image_shape[:2]
+            self.lines = [
+                (
+                    np.array([points[0][0] * width, points[0][1] * height]),
+                    np.array([points[1][0] * width, points[1][1] * height])
+                )
+                for points in self.line_points
+            ]
+        return self.lines
+
+    def update(self, image_shape, detections=None):
+        """
+        detections: rows of process_result for this frame, or None on the
+        frames without detector. Returns the (n, 6) confirmed tracks as
+        (x1, y1, x2, y2, track id, class) and the crossing events of the
+        frame.
+        """
+        if detections is not None:
+            dets = np.array([
+                [*row[1:5], row[5], row[6], row[7]]
+                for row in (
+                    row.detach().cpu().numpy() for row in detections)
+                if int(row[-1]) == 0
+            ]).reshape(-1, 7)
+            tracks = self.sort.update(dets)
+        else:
+            tracks = self.sort.predict()
+
+        self.frames += 1
+        return tracks, self.update_counts(image_shape, tracks)
+
+    def update_counts(self, image_shape, tracks):
+        lines = self.get_lines(image_shape)
+        events = []
+        positions = {}
+        for track in tracks:
+            track_id = int(track[4])
+            self.unique_ids.add(track_id)
+            point = get_track_point(track)
+            positions[track_id] = point
+
+            previous = self.positions.get(track_id)
+            if previous is None:
+                continue
+
+            for line_index, line in enumerate(lines):
+                if not crosses_segment(previous, point, line):
+                    continue
+
+                direction = 0 if side_of_line(previous, line) < 0 else 1
+                self.crossings[line_index][direction] += 1
+                events.append({
+                    'track_id': track_id,
+                    'line': line_index,
+                    'direction': direction
+                })
+
+        # tracks that are not reported this frame keep their last position
+        # until SORT removes them
+        self.positions.update(positions)
+        active_ids = set(self.sort.track_ids.tolist())
+        self.positions = {
+            track_id: point for track_id, point in self.positions.items()
+            if track_id in active_ids
+        }
+        return events
+
+    def get_summary(self, tracks, events):
+        return {
+            'tracked_count': len(tracks),
+            'unique_count': len(self.unique_ids),
+            'line_crossings': self.crossings,
+            'crossing_events': events
+        }
+
+
+def tracks_to_detections(tracks):
+    """
+    Confirmed tracks as process_result rows for handle_object_detections,
+    the track ids are returned separately for the labels.
+    """
+    rows = [
+        torch.tensor([0, *track[:4], 1.0, 1.0, track[5]], dtype=torch.float)
+        for track in tracks
+    ]
+    return rows, [int(track[4]) for track in tracks]
@@ -1,5 +1,7 @@
 import numpy as np
+import torch
 import eelib.stream.global_variables as global_variables
+from eelib.stream.batch_scheduler import MicroBatchScheduler
 from eelib.stream.stream_utils import (
     make_callback_payload,
     get_argument,
@@ -16,10 +18,14 @@ import cv2
 from eelib.ml.average_meter import AverageMeter
 from eelib.ml.sliding_window import SlidingWindow
 from eelib.ml.polygon_mask import polygon_mask
-from eelib.networks.Transformer.datasets.dataset_utils import (
-    img_equal_split,
-    img_equal_unsplit
-)
+from eelib.networks.Transformer.tiled_inference import TiledInference
+
+# sliding window settings of the VICCT models
+TRANSFORMER_CROP_SIZE = 224
+TRANSFORMER_OVERLAP = 8
+TRANSFORMER_IGNORE_BUFFER = 4
+# crops per forward pass
+TRANSFORMER_BATCH_SIZE = 16
 
 
 @output_consumer_loop
@@ -86,43 +92,100 @@ def output_consumer_thread_density(
     return True
 
 
-def predict_density(
-    image,
-    network,
-    transformFn,
-    cuda,
-    density_bias,
-    area_points
-):
-    image_with_mask = None
+def prepare_density_input(image, transformFn, area_points):
+    image_with_mask, mask = None, None
     if area_points:
         image_with_mask, image, mask = polygon_mask(image, area_points)
 
     img = Image.fromarray(image)
-    #print('save image')
-    #img.save("/home/publiceye/extract-csr.jpg")
     img = transformFn(img)
 
-    if cuda:
-        img = img.cuda()
+    return img, image, image_with_mask, mask
 
-    output = network(img.unsqueeze(0))
-    output = output.detach().cpu()[0][0].numpy()
+
+def finish_density_output(output, image, density_bias, mask, divider=1):
     height, width, _ = image.shape
 
     if density_bias:
-        count = max(0, output.sum() - density_bias)
+        count = max(0, (output.sum() / divider) - density_bias)
     else:
-        count = output.sum()
+        count = output.sum() / divider
 
     output = cv2.resize(np.float32(output), (width, height))
 
-    if area_points:
+    if mask is not None:
         output = np.multiply(output, mask)
 
+    return count, output
+
+
+def predict_density(
+    image,
+    network,
+    transformFn,
+    cuda,
+    density_bias,
+    area_points
+):
+    img, image, image_with_mask, mask = prepare_density_input(
+        image, transformFn, area_points)
+
+    if cuda:
+        img = img.cuda()
+
+    with torch.no_grad():
+        output = network(img.unsqueeze(0))
+    output = output.cpu()[0][0].numpy()
+
+    count, output = finish_density_output(output, image, density_bias, mask)
+
     return count, output, image_with_mask
 
 
+def predict_density_batch(
+    images,
+    network,
+    transformFn,
+    cuda,
+    density_biases,
+    area_points_list
+):
+    """
+    Batched version of predict_density. All images should have the same
+    resolution so their tensors can be stacked into one forward pass.
+    """
+    prepared = [
+        prepare_density_input(image, transformFn, area_points)
+        for image, area_points in zip(images, area_points_list)
+    ]
+
+    batch = torch.stack([img for img, _, _, _ in prepared])
+    if cuda:
+        batch = batch.cuda()
+
+    with torch.no_grad():
+        outputs = network(batch).cpu().numpy()
+
+    results = []
+    for output, (_, image, image_with_mask, mask), density_bias in zip(
+        outputs, prepared, density_biases
+    ):
+        count, output = finish_density_output(
+            output[0], image, density_bias, mask)
+        results.append((count, output, image_with_mask))
+
+    return results
+
+
+def get_tiled_inference(network):
+    return TiledInference(
+        network,
+        TRANSFORMER_CROP_SIZE,
+        TRANSFORMER_OVERLAP,
+        TRANSFORMER_IGNORE_BUFFER,
+        TRANSFORMER_BATCH_SIZE)
+
+
 def predict_density_transformer(
     image,
     network,
@@ -133,51 +196,76 @@ def predict_density_transformer(
 ):
     # All Parameters are hardcoded now,
     # they should be saved together with model somehow
-    image_with_mask = None
-    if area_points:
-        image_with_mask, image, mask = polygon_mask(image, area_points)
+    img, image, image_with_mask, mask = prepare_density_input(
+        image, transformFn, area_points)
 
-    img = Image.fromarray(image)
-    #print('save image')
-    #img.save("/home/publiceye/extract.jpg")
-    img = transformFn(img)
-    img_stack = img_equal_split(img, 224, 8)
-    img_stack = img_stack.squeeze(0)
     if cuda:
-        img_stack = img_stack.cuda()
+        img = img.cuda()
 
-    pred_den = network(img_stack)
-    pred_den = pred_den.cpu()
+    with torch.no_grad():
+        den = get_tiled_inference(network)(img)
 
-    img_h, img_w, _ = image.shape
+    output = den.squeeze(0).cpu().numpy()
 
-    den = img_equal_unsplit(
-        pred_den,
-        8,
-        4,
-        img_h,
-        img_w,
-        1
-    )
+    count, output = finish_density_output(
+        output, image, density_bias, mask, divider=3000)
 
-    output = den.squeeze(0)
-    output = output.detach().cpu().numpy()
+    return count, output, image_with_mask
 
-    if density_bias:
-        count = max(0, (output.sum() / 3000) - density_bias)
-    else:
-        count = output.sum() / 3000
 
-    output = cv2.resize(np.float32(output), (img_w, img_h))
+def predict_density_transformer_batch(
+    images,
+    network,
+    transformFn,
+    cuda,
+    density_biases,
+    area_points_list
+):
+    """
+    Batched version of predict_density_transformer. The crops of all
+    images share the fixed size batches of the tiled inference.
+    """
+    prepared = [
+        prepare_density_input(image, transformFn, area_points)
+        for image, area_points in zip(images, area_points_list)
+    ]
+
+    imgs = [img for img, _, _, _ in prepared]
+    if cuda:
+        imgs = [img.cuda() for img in imgs]
 
-    #heatmap = create_heatmap(output)
-    #heatmap = Image.fromarray(heatmap)
-    #heatmap.save('/home/publiceye/dens.jpg')
+    with torch.no_grad():
+        dens = get_tiled_inference(network).predict_batch(imgs)
 
-    if area_points:
-        output = np.multiply(output, mask)
-
-    return count, output, image_with_mask
+    results = []
+    for den, (_, image, image_with_mask, mask), density_bias in zip(
+        dens, prepared, density_biases
+    ):
+        output = den.squeeze(0).cpu().numpy()
+        count, output = finish_density_output(
+            output, image, density_bias, mask, divider=3000)
+        results.append((count, output, image_with_mask))
+
+    return results
+
+
+def make_density_output_data(data, count, run_avg_count, dens_map, image_with_mask):
+    return {
+        'image_with_mask': (
+            None if image_with_mask is None
+            else Image.fromarray(image_with_mask)
+        ),
+        'frame_num': data['frame_num'],
+        'frame': data['frame'],
+        'image': data['image'],
+        'stream_name': data['stream_name'],
+        'count': count,
+        'run_avg_count': run_avg_count,
+        'density_map': dens_map,
+        'url': data['url'],
+        'model_name': data['model_name'],
+        'stream_index': data['stream_index']
+    }
 
 
 def predict_consumer_thread_density(
@@ -243,22 +331,116 @@ def predict_consumer_thread_density(
                 print("predict {} -> {} ({})".format(
                     data['frame_num'], count, predictions.avg), data['url'])
 
-                outputq.put_nowait({
-                    'image_with_mask': (
-                        None if image_with_mask is None
-                        else Image.fromarray(image_with_mask)
-                    ),
-                    'frame_num': data['frame_num'],
-                    'frame': data['frame'],
-                    'image': data['image'],
-                    'stream_name': data['stream_name'],
-                    'count': count_sliding_window.get(),
-                    'run_avg_count': predictions.avg,
-                    'density_map': dens_map,
-                    'url': data['url'],
-                    'model_name': data['model_name'],
-                    'stream_index': data['stream_index']
-                })
+                outputq.put_nowait(make_density_output_data(
+                    data,
+                    count_sliding_window.get(),
+                    predictions.avg,
+                    dens_map,
+                    image_with_mask
+                ))
+        except Exception as e:
+            print("Exiting because of error predict thread: ", e)
+            stop_stream()
+            outputq.put_nowait(None)
+
+    return predict
+
+
+def predict_consumer_thread_density_batched(
+    use_transformer=False,
+    max_batch_size=8,
+    max_batch_wait=0.5
+):
+    """
+    Predict consumer for multicapture streams. Frames of different streams
+    that use the same model, device and resolution are predicted in one
+    batched forward pass and split back into per stream outputs.
+    """
+    predict_batch = (
+        predict_density_transformer_batch if use_transformer
+        else predict_density_batch
+    )
+
+    def predict(
+        predictq,
+        outputq,
+        transformFn,
+        arguments,
+        get_model,
+        get_area_points
+    ):
+        def batch_key(data):
+            stream_index = data['stream_index']
+            return (
+                get_argument(stream_index, 'model', arguments),
+                get_argument(stream_index, 'selected_gpu', arguments),
+                get_argument(stream_index, 'cuda', arguments),
+                data['frame'].shape
+            )
+
+        scheduler = MicroBatchScheduler(
+            predictq, batch_key, max_batch_size, max_batch_wait)
+        predictions = {}
+        count_sliding_windows = {}
+
+        try:
+            while global_variables.g_run_capture:
+                batches = scheduler.get_batches()
+                if batches is None or global_variables.g_run_capture is False:
+                    print("stop predict consumer thread")
+                    outputq.put_nowait(None)
+                    break
+
+                for (_, selected_gpu, cuda, _), batch in batches:
+                    set_selected_gpu(selected_gpu, cuda)
+
+                    for data in batch:
+                        stream_index = data['stream_index']
+                        if (
+                            data['frame_num'] == 0 or
+                            stream_index not in count_sliding_windows
+                        ):
+                            predictions[stream_index] = AverageMeter()
+                            count_sliding_windows[stream_index] = SlidingWindow(
+                                get_argument(
+                                    stream_index, 'sliding_window', arguments))
+
+                    # all streams in the batch share the same model
+                    model = get_model(batch[0]['stream_index'])
+                    results = predict_batch(
+                        [data['frame'] for data in batch],
+                        model,
+                        transformFn,
+                        cuda,
+                        [
+                            get_argument(data['stream_index'], 'bias', arguments)
+                            for data in batch
+                        ],
+                        [get_area_points(data['stream_index']) for data in batch]
+                    )
+
+                    print("predicted batch of {} frames".format(len(batch)))
+
+                    for data, (count, dens_map, image_with_mask) in zip(
+                        batch, results
+                    ):
+                        stream_index = data['stream_index']
+                        predictions[stream_index].update(count)
+                        count_sliding_windows[stream_index].update(count)
+
+                        print("predict {} -> {} ({})".format(
+                            data['frame_num'],
+                            count,
+                            predictions[stream_index].avg
+                        ), data['url'])
+
+                        outputq.put_nowait(make_density_output_data(
+                            data,
+                            count_sliding_windows[stream_index].get(),
+                            predictions[stream_index].avg,
+                            dens_map,
+                            image_with_mask
+                        ))
         except Exception as e:
             print("Exiting because of error predict thread: ", e)
             stop_stream()
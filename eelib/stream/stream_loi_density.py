@@ -1,8 +1,13 @@
 import eelib.stream.global_variables as global_variables
-from eelib.ml_line_crossing_density.loi import LOI_Calculator
+from eelib.ml_line_crossing_density.loi import (
+    LOI_Calculator,
+    RegionIndex,
+    pixelwise_forward_all
+)
 import PIL.Image as Image
 import torch
 import math
+import cv2
 import numpy as np
 from eelib.stream.stream_utils import (
     rescale_output,
@@ -15,6 +20,13 @@ from eelib.stream.stream_utils import (
 )
 from eelib.ml.average_meter import AverageMeter
 
+# the density and flow maps for the heatmap are downsampled by this factor
+# on the device before they are copied to the host
+VISUALISATION_SCALE = 0.25
+
+# conv kernels of get_max_surrounding per configuration and device
+surrounding_kernels = {}
+
 
 ### LINE CROSSING DENSITY ###
 ######## START ##############
@@ -51,9 +63,13 @@ def output_consumer_thread_lc_density(
             int(round(count[0])), int(round(count[1]))),
         data['points']
     ))
-    output = np.array(
-        concat_heatmap_to_output(output, data['density_map'], data['flow_map'])
-    )
+    if data['density_map'] is not None:
+        height, width, _ = output.shape
+        output = np.array(concat_heatmap_to_output(
+            output,
+            cv2.resize(data['density_map'], (width, height)),
+            cv2.resize(data['flow_map'], (width, height))
+        ))
     output_scale_factor = get_argument(
         data['stream_index'], 'output_scale_factor', arguments)
     output = (
@@ -67,12 +83,11 @@ def output_consumer_thread_lc_density(
     return True
 
 
-def get_max_surrounding(
-    data,
-    surrounding=1,
-    only_under=True,
-    smaller_sides=True
-):
+def get_surrounding_kernel(surrounding, only_under, smaller_sides, device):
+    key = (surrounding, only_under, smaller_sides, device)
+    if key in surrounding_kernels:
+        return surrounding_kernels[key]
+
     kernel_size = surrounding * 2 + 1
     out_channels = np.eye(kernel_size * kernel_size)
 
@@ -89,9 +104,22 @@ def get_max_surrounding(
 
     w = out_channels.reshape(
         (out_channels.shape[0], 1, kernel_size, kernel_size))
-    w = torch.tensor(w, dtype=torch.float).cuda()
+    w = torch.tensor(w, dtype=torch.float, device=device)
+
+    surrounding_kernels[key] = w
+    return w
 
-    data = data.transpose(0, 1).cuda()
+
+def get_max_surrounding(
+    data,
+    surrounding=1,
+    only_under=True,
+    smaller_sides=True
+):
+    w = get_surrounding_kernel(
+        surrounding, only_under, smaller_sides, data.device)
+
+    data = data.transpose(0, 1)
     patches = torch.nn.functional.conv2d(
         data,
         w,
@@ -107,23 +135,79 @@ def get_max_surrounding(
     return output
 
 
+def to_visualisation(frame, scale=VISUALISATION_SCALE):
+    # frame: (1, C, H, W) on the device, returns a (h, w, C) numpy array
+    frame = torch.nn.functional.interpolate(
+        frame, scale_factor=scale, mode='area')
+    return frame[0].permute(1, 2, 0).cpu().numpy()
+
+
+def encode_frame(image, network, transformFn, device, loi_model, frame_cache):
+    """
+    The transformed tensor of image on the device and, for networks with
+    encode (LOID, LOID2), its feature pyramid. The image2 of a step is the
+    image1 of the next step, so the last frame is kept in frame_cache and
+    every frame is transformed, uploaded and encoded once.
+    """
+    if (
+        frame_cache.get('image') is image and
+        frame_cache.get('network') is network
+    ):
+        return frame_cache['frames'], frame_cache['features']
+
+    frames = loi_model.reshape_image(
+        transformFn(Image.fromarray(image)).to(device).unsqueeze(0))
+    features = network.encode(frames) if hasattr(network, 'encode') else None
+    return frames, features
+
+
 def predict_line_crossing(
     image1,
     image2,
     network,
     transformFn,
     cuda,
-    loi_models
+    loi_models,
+    region_index=None,
+    show_heatmap=True,
+    frame_cache=None
 ):
+    """
+    The LOI post-processing stays on the device of the network output.
+    Only the region sums are copied to the host, plus downsampled density
+    and flow maps when show_heatmap is set (otherwise those are None).
+
+    With frame_cache (a dict kept by the caller over the steps of a stream)
+    image1 is not transformed or encoded again when it was the image2 of
+    the previous step, and the backward flow, which is not used here, is
+    not decoded.
+    """
+    device = torch.device('cuda') if cuda else torch.device('cpu')
+    if frame_cache is None:
+        frame_cache = {}
+
     with torch.no_grad():
         # print("Reshape")
-        frames1 = loi_models[0].reshape_image(
-            transformFn(Image.fromarray(image1)).cuda().unsqueeze(0))
-        frames2 = loi_models[0].reshape_image(
-            transformFn(Image.fromarray(image2)).cuda().unsqueeze(0))
+        frames1, features1 = encode_frame(
+            image1, network, transformFn, device, loi_models[0], frame_cache)
+        frames2, features2 = encode_frame(
+            image2, network, transformFn, device, loi_models[0], {})
+        frame_cache.update({
+            'image': image2,
+            'network': network,
+            'frames': frames2,
+            'features': features2
+        })
 
         # print("Model")
-        fe_output, _, cc_output = network.forward(frames1, frames2)
+        if features1 is not None:
+            fe_output, _, cc_output = network.forward_encoded(
+                features1,
+                features2,
+                (frames1.shape[3], frames1.shape[2]),
+                ret_bw=False)
+        else:
+            fe_output, _, cc_output = network.forward(frames1, frames2)
 
         # print("Do maxing")
         fe_output = get_max_surrounding(
@@ -140,25 +224,33 @@ def predict_line_crossing(
 
         # print("CC to orig")
         cc_output = loi_models[0].to_orig_size(cc_output)
-        cc_output = cc_output.squeeze().squeeze()
-        cc_output = cc_output.detach().cpu().data.numpy()
 
         # print("Flow to orig")
         fe_output = loi_models[0].to_orig_size(fe_output)
-        fe_output = fe_output.squeeze().permute(1, 2, 0)
-        fe_output = fe_output.detach().cpu().data.numpy()
+
+        dens_map, flow_map = None, None
+        if show_heatmap:
+            dens_map = to_visualisation(cc_output)[:, :, 0]
+            flow_map = to_visualisation(fe_output)
 
         # print("LOI")
+        if region_index is None:
+            region_index = RegionIndex.concat(
+                [loi_model.region_index for loi_model in loi_models])
+
         count = [0.0, 0.0]
-        for loi_model in loi_models:
-            loi_results = loi_model.pixelwise_forward(cc_output, fe_output)
+        for loi_results in pixelwise_forward_all(
+            region_index,
+            cc_output.squeeze().squeeze(),
+            fe_output.squeeze().permute(1, 2, 0)
+        ):
 
             # Swap because of inconsistency in pixelwise forward
             # @TODO Return direct for much more refined control
             count[0] = count[0] + sum(loi_results[1])
             count[1] = count[1] + sum(loi_results[0])
 
-    return count, cc_output, fe_output
+    return count, dens_map, flow_map
 
 
 def predict_consumer_thread_lc_density(
@@ -178,6 +270,8 @@ def predict_consumer_thread_lc_density(
 
         # Need 2 frames
         prev_data = None
+        # the previous frame on the device, see encode_frame
+        frame_cache = {}
         points = []
         while global_variables.g_run_capture:
             data = predictq.get(block=True)
@@ -225,7 +319,12 @@ def predict_consumer_thread_lc_density(
                     raise Exception("No LOI models were generated,\
                         at least 1 needs to be present")
 
+                # all LOIs of the stream are computed in one pass
+                region_index = RegionIndex.concat(
+                    [loi_model.region_index for loi_model in loi_models])
+
                 prev_data = data
+                frame_cache.clear()
 
                 print("Done initializing LOI")
 
@@ -237,7 +336,11 @@ def predict_consumer_thread_lc_density(
                 model,
                 transformFn,
                 get_argument(data['stream_index'], 'cuda', arguments),
-                loi_models)
+                loi_models,
+                region_index,
+                get_argument(
+                    data['stream_index'], 'show_heatmap', arguments),
+                frame_cache)
 
             predictions1.update(count[0])
             predictions2.update(count[1])
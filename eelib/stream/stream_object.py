@@ -16,7 +16,16 @@ from eelib.stream.stream_utils import (
 import eelib.stream.global_variables as global_variables
 from scipy.spatial.distance import euclidean
 from eelib.ml.polygon_mask import polygon_mask
-from eelib.ml_object_recognition.detect_image import detect_image_2
+from eelib.ml_object_recognition.detect_image import (
+    detect_image_2,
+    detect_images_batched
+)
+from eelib.stream.batch_scheduler import MicroBatchScheduler
+from eelib.ml_object_recognition.utils.postprocess import (
+    apply_homography,
+    get_too_close_indices
+)
+from eelib.stream.object_tracking import StreamTracker, tracks_to_detections
 
 MIN_DIST_METERS = 1.5
 
@@ -42,7 +51,10 @@ def output_consumer_thread_object(
     if on_predict_callback is not None:
         on_predict_callback(
             make_callback_payload(
-                count, 'object_recognition', violation_count),
+                count,
+                'object_recognition',
+                violation_count,
+                data.get('tracking')),
             stream_url,
             data['model_name'],
             data['stream_index'])
@@ -80,7 +92,9 @@ def get_classes_and_colors(model_id):
     return classes, colours
 
 
-def apply_proj(points, M):
+# loop based versions, kept as the reference for the benchmark in
+# eelib.ml_object_recognition.utils.postprocess
+def apply_proj_reference(points, M):
 
     points2 = []
     Mat = M
@@ -108,7 +122,7 @@ def apply_proj(points, M):
     return np.array(points2)
 
 
-def get_to_close_indices(transformed_points, scaling_factor):
+def get_to_close_indices_reference(transformed_points, scaling_factor):
     box_indices_standing_to_close = set()
     for idx, transformed_point_1 in enumerate(transformed_points):
         for jfx, transformed_point_2 in enumerate(transformed_points):
@@ -122,13 +136,16 @@ def get_to_close_indices(transformed_points, scaling_factor):
 
 
 # draw a bbox
-def draw_bbox(img, bbox, colors, classes, to_close=False):
+def draw_bbox(img, bbox, colors, classes, to_close=False, track_id=None):
     label = classes[int(bbox[-1])]
     if int(bbox[-1]) != 0:
         return img
 
-    confidence = int(float(bbox[6])*100)
-    label = label+' '+str(confidence)+'%'
+    if track_id is not None:
+        label = label+' #'+str(track_id)
+    else:
+        confidence = int(float(bbox[6])*100)
+        label = label+' '+str(confidence)+'%'
 
     p1 = tuple([int(b) for b in bbox[1:3]])
     p2 = tuple([int(b) for b in bbox[3:5]])
@@ -152,45 +169,30 @@ def draw_bbox(img, bbox, colors, classes, to_close=False):
     return img
 
 
-def handle_bboxes(img, boxes, colours, labels, to_close=[]):
+def handle_bboxes(img, boxes, colours, labels, to_close=[], track_ids=None):
     result = copy.deepcopy(img)
     for idx, bbox in enumerate(boxes):
         result = draw_bbox(
-            result, bbox, colours, labels, to_close=idx in to_close)
+            result, bbox, colours, labels, to_close=idx in to_close,
+            track_id=track_ids[idx] if track_ids is not None else None)
 
     return result
 
 
-def predict_object(
+def handle_object_detections(
     image,
-    network,
+    image_with_mask,
+    detections,
     classes,
     colours,
     social_distance,
     projection,
     scaling_factor,
-    cuda,
-    area_points,
-    object_threshold,
-    non_max_suppresion
+    track_ids=None
 ):
-    image_with_mask = None
-    if area_points:
-        image_with_mask, image, _ = polygon_mask(image, area_points)
-
-    bboxes = detect_image_2(
-        network, cuda, [image], obj_thresh=object_threshold or 0.95,
-        nms_thresh=non_max_suppresion or 0.5)
-
-    if len(bboxes) == 0:
-        return (
-            image_with_mask if image_with_mask is not None
-            else image, 0, 0 if social_distance else None
-        )
-
-    # only select persons [class: 0]
+    # only select persons [class: 0], tracks are always persons
     bboxes = np.array(
-        [bbox.detach().numpy() for bbox in bboxes[0] if int(bbox[-1]) == 0])
+        [bbox.detach().numpy() for bbox in detections if int(bbox[-1]) == 0])
 
     if len(bboxes) == 0:
         return (
@@ -209,16 +211,17 @@ def predict_object(
             np.ones(x_coordinate.shape[0])])
 
         # hardcoded to transform using oxford callibration
-        transformed_points = apply_proj(points, projection)
-        indices_standing_to_close = get_to_close_indices(
-            transformed_points, scaling_factor)
+        transformed_points = apply_homography(points, projection)
+        indices_standing_to_close = get_too_close_indices(
+            transformed_points, scaling_factor, MIN_DIST_METERS)
 
     result_image = handle_bboxes(
         image_with_mask if image_with_mask is not None else image,
         bboxes,
         colours,
         classes,
-        to_close=indices_standing_to_close)
+        to_close=indices_standing_to_close,
+        track_ids=track_ids)
 
     return (
         result_image,
@@ -227,6 +230,182 @@ def predict_object(
     )
 
 
+def handle_tracked_detections(
+    tracker,
+    image,
+    image_with_mask,
+    detections,
+    classes,
+    colours,
+    social_distance,
+    projection,
+    scaling_factor
+):
+    """
+    Like handle_object_detections, for the confirmed tracks of the stream
+    instead of the detections. detections is None on the frames that are
+    not run through the detector. Returns the tracking summary as well.
+    """
+    tracks, events = tracker.update(image.shape, detections)
+    rows, track_ids = tracks_to_detections(tracks)
+
+    image_with_bounding_boxes, count, violation_count = \
+        handle_object_detections(
+            image,
+            image_with_mask,
+            rows,
+            classes,
+            colours,
+            social_distance,
+            projection,
+            scaling_factor,
+            track_ids)
+
+    return (
+        image_with_bounding_boxes,
+        count,
+        violation_count,
+        tracker.get_summary(tracks, events)
+    )
+
+
+def mask_image(image, area_points):
+    image_with_mask = None
+    if area_points:
+        image_with_mask, image, _ = polygon_mask(image, area_points)
+
+    return image, image_with_mask
+
+
+def detect_object(
+    image,
+    network,
+    cuda,
+    object_threshold,
+    non_max_suppresion
+):
+    bboxes = detect_image_2(
+        network, cuda, [image], obj_thresh=object_threshold or 0.95,
+        nms_thresh=non_max_suppresion or 0.5)
+
+    return bboxes[0] if len(bboxes) > 0 else []
+
+
+def predict_object(
+    image,
+    network,
+    classes,
+    colours,
+    social_distance,
+    projection,
+    scaling_factor,
+    cuda,
+    area_points,
+    object_threshold,
+    non_max_suppresion
+):
+    image, image_with_mask = mask_image(image, area_points)
+
+    return handle_object_detections(
+        image,
+        image_with_mask,
+        detect_object(
+            image, network, cuda, object_threshold, non_max_suppresion),
+        classes,
+        colours,
+        social_distance,
+        projection,
+        scaling_factor)
+
+
+def predict_object_batch(
+    images,
+    network,
+    cuda,
+    area_points_list,
+    object_threshold,
+    non_max_suppresion
+):
+    """
+    Runs the detector once for all images. Returns for every image the
+    (image, image_with_mask, detections) needed by handle_object_detections.
+    """
+    masked = [
+        mask_image(image, area_points)
+        for image, area_points in zip(images, area_points_list)
+    ]
+
+    detections = detect_images_batched(
+        network, cuda, [image for image, _ in masked],
+        obj_thresh=object_threshold or 0.95,
+        nms_thresh=non_max_suppresion or 0.5)
+
+    return [
+        (image, image_with_mask, image_detections)
+        for (image, image_with_mask), image_detections
+        in zip(masked, detections)
+    ]
+
+
+def get_projection(stream_index, arguments, outputq):
+    if not get_argument(stream_index, 'social_distance', arguments):
+        return None, None
+
+    stream = get_argument(stream_index, 'stream', arguments)
+    camera = store.get_camera_by_stream_url(stream)
+    calibration = store.get_calibration_by_camera_id(camera.id)
+    if calibration is None:
+        print('Cannot use social distance if stream is\
+            not calibrated yet')
+        outputq.put_nowait(None)
+        stop_stream()
+        sys.exit(1)
+
+    projection = np.array([
+        [calibration.matrix_a, calibration.matrix_c, 0],
+        [calibration.matrix_b, calibration.matrix_d, 0],
+        [0, 0, 1]
+    ])
+    return projection, calibration.scaling_factor
+
+
+def get_tracker(trackers, stream_index, arguments):
+    """
+    The tracker of the stream from trackers, None when tracking is off.
+    """
+    if not get_argument(stream_index, 'tracking', arguments):
+        return None
+
+    if stream_index not in trackers:
+        trackers[stream_index] = StreamTracker(
+            get_argument(stream_index, 'detect_every', arguments),
+            get_argument(stream_index, 'loi_points', arguments))
+
+    return trackers[stream_index]
+
+
+def make_object_output_data(
+    data,
+    image_with_bounding_boxes,
+    count,
+    violation_count,
+    tracking=None
+):
+    return {
+        'frame_num': data['frame_num'],
+        'frame': data['frame'],
+        'image': data['image'],
+        'stream_index': data['stream_index'],
+        'url': data['url'],
+        'count': count,
+        'violation_count': violation_count,
+        'model_name': data['model_name'],
+        'stream_name': data['stream_name'],
+        'bounding_box_image': image_with_bounding_boxes,
+        'tracking': tracking
+    }
+
+
 def predict_consumer_thread_object(
     predictq,
     outputq,
@@ -234,6 +413,8 @@ def predict_consumer_thread_object(
     get_model,
     get_area_points
 ):
+    # tracking state per stream_index
+    trackers = {}
     try:
         while global_variables.g_run_capture:
             data = predictq.get(block=True)
@@ -256,56 +437,63 @@ def predict_consumer_thread_object(
             area_points = get_area_points(data['stream_index'])
             network.eval()
 
-            projection, calibration_scale = None, None
-            if get_argument(
-                data['stream_index'], 'social_distance', arguments
-            ):
-                stream = get_argument(
-                    data['stream_index'], 'stream', arguments)
-                camera = store.get_camera_by_stream_url(stream)
-                calibration = store.get_calibration_by_camera_id(camera.id)
-                if calibration is None:
-                    print('Cannot use social distance if stream is\
-                        not calibrated yet')
-                    outputq.put_nowait(None)
-                    stop_stream()
-                    sys.exit(1)
-
-                calibration_scale = calibration.scaling_factor
-                projection = np.array([
-                    [calibration.matrix_a, calibration.matrix_c, 0],
-                    [calibration.matrix_b, calibration.matrix_d, 0],
-                    [0, 0, 1]
-                ])
-
-            image_with_bounding_boxes, count, violation_count = predict_object(
-                data['frame'],
-                network,
-                classes,
-                colours,
-                get_argument(
-                    data['stream_index'], 'social_distance', arguments),
-                projection,
-                calibration_scale,
-                get_argument(data['stream_index'], 'cuda', arguments),
-                area_points,
-                get_argument(
-                    data['stream_index'], 'object_threshold', arguments),
-                get_argument(
-                    data['stream_index'], 'non_max_suppression', arguments))
-
-            outputq.put_nowait({
-                'frame_num': data['frame_num'],
-                'frame': data['frame'],
-                'image': data['image'],
-                'stream_index': data['stream_index'],
-                'url': data['url'],
-                'count': count,
-                'violation_count': violation_count,
-                'model_name': data['model_name'],
-                'stream_name': data['stream_name'],
-                'bounding_box_image': image_with_bounding_boxes
-            })
+            projection, calibration_scale = get_projection(
+                data['stream_index'], arguments, outputq)
+
+            tracker = get_tracker(trackers, data['stream_index'], arguments)
+            if tracker is None:
+                image_with_bounding_boxes, count, violation_count = \
+                    predict_object(
+                        data['frame'],
+                        network,
+                        classes,
+                        colours,
+                        get_argument(
+                            data['stream_index'], 'social_distance', arguments),
+                        projection,
+                        calibration_scale,
+                        get_argument(data['stream_index'], 'cuda', arguments),
+                        area_points,
+                        get_argument(
+                            data['stream_index'], 'object_threshold', arguments),
+                        get_argument(
+                            data['stream_index'], 'non_max_suppression',
+                            arguments))
+                tracking = None
+            else:
+                image, image_with_mask = mask_image(data['frame'], area_points)
+                # in between detections the tracks are only predicted
+                detections = None
+                if tracker.should_detect():
+                    detections = detect_object(
+                        image,
+                        network,
+                        get_argument(data['stream_index'], 'cuda', arguments),
+                        get_argument(
+                            data['stream_index'], 'object_threshold', arguments),
+                        get_argument(
+                            data['stream_index'], 'non_max_suppression',
+                            arguments))
+
+                image_with_bounding_boxes, count, violation_count, tracking = \
+                    handle_tracked_detections(
+                        tracker,
+                        image,
+                        image_with_mask,
+                        detections,
+                        classes,
+                        colours,
+                        get_argument(
+                            data['stream_index'], 'social_distance', arguments),
+                        projection,
+                        calibration_scale)
+
+            outputq.put_nowait(make_object_output_data(
+                data,
+                image_with_bounding_boxes,
+                count,
+                violation_count,
+                tracking))
     except Exception as e:
         print("Exiting because of error in predict thread: ", e)
         stop_stream()
@@ -313,3 +501,143 @@ def predict_consumer_thread_object(
     finally:
         del network
         gc.collect()
+
+
+def predict_consumer_thread_object_batched(
+    max_batch_size=8,
+    max_batch_wait=0.5
+):
+    """
+    Predict consumer for multicapture streams. Frames of different streams
+    that use the same model, device and thresholds are run through the
+    detector in one batched forward pass.
+    """
+    def predict(
+        predictq,
+        outputq,
+        arguments,
+        get_model,
+        get_area_points
+    ):
+        def batch_key(data):
+            stream_index = data['stream_index']
+            return (
+                get_argument(stream_index, 'model', arguments),
+                get_argument(stream_index, 'selected_gpu', arguments),
+                get_argument(stream_index, 'cuda', arguments),
+                get_argument(stream_index, 'object_threshold', arguments),
+                get_argument(stream_index, 'non_max_suppression', arguments)
+            )
+
+        scheduler = MicroBatchScheduler(
+            predictq, batch_key, max_batch_size, max_batch_wait)
+        classes_and_colours = {}
+        # tracking state per stream_index
+        trackers = {}
+
+        try:
+            while global_variables.g_run_capture:
+                batches = scheduler.get_batches()
+                if batches is None or global_variables.g_run_capture is False:
+                    print("stop predict consumer thread")
+                    outputq.put_nowait(None)
+                    break
+
+                for key, batch in batches:
+                    model_id, selected_gpu, cuda, object_threshold, nms = key
+                    set_selected_gpu(selected_gpu, cuda)
+
+                    if model_id not in classes_and_colours:
+                        classes_and_colours[model_id] = get_classes_and_colors(
+                            model_id)
+                    classes, colours = classes_and_colours[model_id]
+
+                    # all streams in the batch share the same model
+                    network = get_model(batch[0]['stream_index'])
+                    network.eval()
+
+                    stream_trackers = [
+                        get_tracker(trackers, data['stream_index'], arguments)
+                        for data in batch
+                    ]
+                    # tracked streams skip the detector in between detections
+                    detect = [
+                        tracker is None or tracker.should_detect()
+                        for tracker in stream_trackers
+                    ]
+                    detect_batch = [
+                        data for data, run in zip(batch, detect) if run]
+
+                    results = iter(predict_object_batch(
+                        [data['frame'] for data in detect_batch],
+                        network,
+                        cuda,
+                        [
+                            get_area_points(data['stream_index'])
+                            for data in detect_batch
+                        ],
+                        object_threshold,
+                        nms) if len(detect_batch) > 0 else [])
+
+                    print("predicted batch of {} frames ({} tracked)".format(
+                        len(detect_batch), len(batch) - len(detect_batch)))
+
+                    for data, tracker, run in zip(
+                        batch, stream_trackers, detect
+                    ):
+                        if run:
+                            image, image_with_mask, detections = next(results)
+                        else:
+                            image, image_with_mask = mask_image(
+                                data['frame'],
+                                get_area_points(data['stream_index']))
+                            detections = None
+
+                        projection, calibration_scale = get_projection(
+                            data['stream_index'], arguments, outputq)
+                        social_distance = get_argument(
+                            data['stream_index'], 'social_distance', arguments)
+
+                        if tracker is None:
+                            image_with_bounding_boxes, count, violation_count = \
+                                handle_object_detections(
+                                    image,
+                                    image_with_mask,
+                                    detections,
+                                    classes,
+                                    colours,
+                                    social_distance,
+                                    projection,
+                                    calibration_scale)
+                            tracking = None
+                        else:
+                            (
+                                image_with_bounding_boxes,
+                                count,
+                                violation_count,
+                                tracking
+                            ) = handle_tracked_detections(
+                                tracker,
+                                image,
+                                image_with_mask,
+                                detections,
+                                classes,
+                                colours,
+                                social_distance,
+                                projection,
+                                calibration_scale)
+
+                        outputq.put_nowait(make_object_output_data(
+                            data,
+                            image_with_bounding_boxes,
+                            count,
+                            violation_count,
+                            tracking))
+        except Exception as e:
+            print("Exiting because of error in predict thread: ", e)
+            stop_stream()
+            outputq.put_nowait(None)
+        finally:
+            gc.collect()
+
+    return predict
@@ -0,0 +1,121 @@
+import time
+import threading
+from collections import defaultdict
+import eelib.store as store
+from eelib.stream.stream_utils import stop_multistream
+
+# seconds before a cached row is read from the database again
+REFRESH_INTERVAL = 30
+
+
+class StreamResources:
+    """
+    Models, networks and region of interest polygons of the streams of a
+    multicapture job. Rows are read once per stream and checked again every
+    refresh_interval seconds; a network is loaded once for every model and
+    device and shared by all streams that use it, and loaded again only
+    when the model row changes.
+
+    load_network(model, cuda, selected_gpu) returns the network of a model
+    row. Cache hits and misses are counted per kind and printed by report.
+    """
+
+    def __init__(self, args, load_network, refresh_interval=REFRESH_INTERVAL):
+        self.args = args
+        self.load_network = load_network
+        self.refresh_interval = refresh_interval
+        self.rows = {}
+        self.networks = {}
+        self.lock = threading.RLock()
+        self.hits = defaultdict(int)
+        self.misses = defaultdict(int)
+        self.refreshes = defaultdict(int)
+
+    def get_row(self, kind, key, load):
+        """
+        Cached result of load() for (kind, key), loaded again when it is
+        older than refresh_interval.
+        """
+        with self.lock:
+            now = time.time()
+            entry = self.rows.get((kind, key))
+            if entry is not None and now - entry[1] < self.refresh_interval:
+                self.hits[kind] += 1
+                return entry[0]
+
+            value = load()
+            if entry is None:
+                self.misses[kind] += 1
+            elif value != entry[0]:
+                self.refreshes[kind] += 1
+                print('{} {} changed, reloaded'.format(kind, key))
+            else:
+                self.hits[kind] += 1
+
+            self.rows[(kind, key)] = (value, now)
+            return value
+
+    def get_model_row(self, stream_index):
+        model_id = self.args[stream_index]['model']
+        return self.get_row(
+            'model', model_id, lambda: store.get_model_by_id(model_id))
+
+    def get_model(self, stream_index):
+        args = self.args[stream_index]
+        model = self.get_model_row(stream_index)
+        key = (model.id, model.path, args['cuda'], args.get('selected_gpu'))
+
+        with self.lock:
+            if key in self.networks:
+                self.hits['network'] += 1
+                return self.networks[key]
+
+            self.misses['network'] += 1
+            # networks of an older version of the model are not used anymore
+            for old_key in [
+                k for k in self.networks
+                if k[0] == model.id and k[1] != model.path
+            ]:
+                del self.networks[old_key]
+
+            self.networks[key] = self.load_network(
+                model, args['cuda'], args.get('selected_gpu'))
+            return self.networks[key]
+
+    def load_area_points(self, stream_index):
+        roi_id = self.args[stream_index].get('roi_id')
+        stream_roi = store.get_stream_roi_by_id(roi_id)
+        if stream_roi is None:
+            print('Stream roi does not exist, exiting...!')
+            stop_multistream()
+            raise Exception('Stream roi does not exist')
+
+        camera = store.get_camera_by_id(stream_roi.camera_id)
+        if camera is None:
+            print('Camera does not exist yet, exiting...!')
+            stop_multistream()
+            raise Exception('Camera does not exist yet')
+
+        if camera.stream_url != self.args[stream_index].get('stream'):
+            print('Region of interest belongs to a different stream, exiting...!')
+            stop_multistream()
+            raise Exception('Region of interest belongs to a different stream')
+
+        return stream_roi.polygons
+
+    def get_area_points(self, stream_index):
+        roi_id = self.args[stream_index].get('roi_id')
+        if not roi_id:
+            return None
+
+        # polygon_mask caches the mask of the polygons per frame size
+        return self.get_row(
+            'roi',
+            (roi_id, self.args[stream_index].get('stream')),
+            lambda: self.load_area_points(stream_index))
+
+    def report(self):
+        for kind in sorted(set(self.hits) | set(self.misses)):
+            print('resource cache {}: {} hits, {} misses, {} refreshed'.format(
+                kind, self.hits[kind], self.misses[kind],
+                self.refreshes[kind]))
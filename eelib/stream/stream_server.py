@@ -4,6 +4,7 @@ from watchdog.events import FileSystemEventHandler
 from watchdog.observers import Observer
 import cv2
 import time
+import numpy as np
 import eelib.stream.global_variables as global_variables
 import eelib.store as store
 from eelib.stream.stream_utils import (
@@ -14,11 +15,54 @@ from eelib.stream.stream_utils import (
 # One Hour
 MAXIMUM_SECONDS_VIDEO = 3600
 
+# frames are written to ffmpeg as raw bgr24 pixels, PNG is kept as fallback
+PIPE_FORMAT_RAW = 'raw'
+PIPE_FORMAT_PNG = 'png'
+
 
 def scale_width_or_height(value, input_scale_factor, output_scale_factor):
     return int(value * (input_scale_factor or 1) * (output_scale_factor or 1))
 
 
+def build_pipe_input(pipe_format, width, height, fps):
+    if pipe_format == PIPE_FORMAT_RAW:
+        return [
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', '{}x{}'.format(width, height),
+            '-r', str(fps),
+            '-i', 'pipe:'
+        ]
+
+    return [
+        '-r', str(fps),
+        '-s', '{}x{}'.format(width, height),
+        '-i', 'pipe:'
+    ]
+
+
+def encode_frame(img, pipe_format):
+    """
+    Returns the bytes that are written to the ffmpeg pipe. Raw frames are
+    written as a view on the numpy buffer, without copying when the image
+    is already contiguous uint8.
+    """
+    if pipe_format == PIPE_FORMAT_RAW:
+        if img.dtype != np.uint8:
+            img = np.clip(img, 0, 255).astype(np.uint8)
+        return memoryview(np.ascontiguousarray(img)).cast('B')
+
+    _, frame = cv2.imencode('.png', img)
+    return frame.tobytes()
+
+
+def fit_frame(img, width, height):
+    # ffmpeg reading raw video needs every frame to have the same size
+    if img.shape[1] != width or img.shape[0] != height:
+        return cv2.resize(img, (width, height))
+    return img
+
+
 def build_ffmpeg_command(
     input_scale_factor,
     output_scale_factor,
@@ -26,21 +70,18 @@ def build_ffmpeg_command(
     width,
     fps,
     stream_name,
+    pipe_format=PIPE_FORMAT_PNG
 ):
     return [
         'ffmpeg',
         '-loglevel', 'quiet',
         '-re',
-        '-r',
-        str(fps),
-        '-s',
-        '{}x{}'.format(
-            scale_width_or_height(
-                width, input_scale_factor, output_scale_factor),
-            scale_width_or_height(
-                height, input_scale_factor, output_scale_factor)),
-        '-i',
-        'pipe:',
+    ] + build_pipe_input(
+        pipe_format,
+        scale_width_or_height(width, input_scale_factor, output_scale_factor),
+        scale_width_or_height(height, input_scale_factor, output_scale_factor),
+        fps
+    ) + [
         '-c:v',
         'libx264',
         '-tune',
@@ -85,42 +126,72 @@ class StreamServer:
         width,
         fps,
         name,
-        save_function
+        save_function,
+        pipe_format=PIPE_FORMAT_RAW
     ):
         print(f"Starting stream with resolution {height}x{width}")
         stream_folder = os.path.join(
             os.environ['EAGLE_EYE_PATH'], 'files', 'streams')
         encoded_file_name = '{}.m3u8'.format(name)
-        stream_name = os.path.join(stream_folder, encoded_file_name)
-
+        self.stream_name = os.path.join(stream_folder, encoded_file_name)
+
+        self.input_scale_factor = input_scale_factor
+        self.output_scale_factor = output_scale_factor
+        self.fps = fps
+        self.pipe_format = pipe_format
+        self.process = None
+        # the output can be wider than the input when a heatmap is
+        # concatenated, so raw video uses the size of the first frame
+        self.frame_size = None
         self.ffmpeg_command = build_ffmpeg_command(
             input_scale_factor,
             output_scale_factor,
             height,
             width,
             fps,
-            stream_name,
+            self.stream_name,
+            pipe_format
         )
         self.restart_timeout = 2
 
         observer = Observer()
         event_handler = EventHandler(
             observer,
-            stream_name,
+            self.stream_name,
             lambda: save_function(name, encoded_file_name))
         observer.schedule(event_handler, stream_folder, recursive=False)
         observer.start()
 
     def start_server(self):
+        if self.pipe_format == PIPE_FORMAT_RAW and self.frame_size is None:
+            # started when the first frame arrives
+            return
+
         print("starting server")
         self.process = subprocess.Popen(
             self.ffmpeg_command, stdin=subprocess.PIPE, close_fds=True)
 
     def push_image(self, img):
-        ret2, frame2 = cv2.imencode('.png', img)
+        if self.pipe_format == PIPE_FORMAT_RAW:
+            if self.frame_size is None:
+                height, width = img.shape[:2]
+                self.frame_size = (width, height)
+                self.ffmpeg_command = build_ffmpeg_command(
+                    None,
+                    None,
+                    height,
+                    width,
+                    self.fps,
+                    self.stream_name,
+                    self.pipe_format
+                )
+                self.start_server()
+            img = fit_frame(img, *self.frame_size)
+
+        frame = encode_frame(img, self.pipe_format)
         try:
             if global_variables.g_run_capture:
-                self.process.stdin.write(frame2.tobytes())
+                self.process.stdin.write(frame)
         except Exception as e:
             print(e)
             if global_variables.g_run_capture:
@@ -132,6 +203,9 @@ class StreamServer:
                 self.start_server()
 
     def close_server(self):
+        if self.process is None:
+            return
+
         print('close stdin')
         self.process.stdin.close()
         self.process.wait()
@@ -142,7 +216,7 @@ def count_video_segment_with_prefix(path, prefix):
     return len([file for file in os.listdir(path) if file.startswith(prefix)])
 
 
-def save_image_thread(framewriteq, arguments):
+def save_image_thread(framewriteq, arguments, pipe_format=PIPE_FORMAT_RAW):
     def start_stream(data, restart_timeout=1):
         camera = store.get_camera_by_stream_url(get_argument(
             data['stream_index'], 'stream', arguments))
@@ -157,15 +231,18 @@ def save_image_thread(framewriteq, arguments):
         )
         video_count = count_video_segment_with_prefix(path, filename_prefix)
         filename = os.path.join(path, filename_prefix + f"_#{video_count}.mp4")
+        height, width = data['frame'].shape[:2]
 
         ffmpeg_command = [
             'ffmpeg',
             '-loglevel',
             'quiet',
-            '-r',
-            str(get_argument(data['stream_index'], 'output_fps', arguments)),
-            '-i',
-            'pipe:',
+        ] + build_pipe_input(
+            pipe_format,
+            width,
+            height,
+            get_argument(data['stream_index'], 'output_fps', arguments)
+        ) + [
             '-c:v',
             'libx264',
             '-pix_fmt',
@@ -174,7 +251,14 @@ def save_image_thread(framewriteq, arguments):
         ]
         process = subprocess.Popen(
             ffmpeg_command, stdin=subprocess.PIPE, close_fds=True)
-        return process, filename, time.time(), camera, restart_timeout * 2
+        return (
+            process,
+            filename,
+            time.time(),
+            camera,
+            restart_timeout * 2,
+            (width, height)
+        )
 
     def finish_video(process, filename, camera):
         process.stdin.close()
@@ -183,15 +267,18 @@ def save_image_thread(framewriteq, arguments):
         store.insert_video_captured_by_camera(video_file_id, camera.id)
 
     def finish_videos(ffmpeg_processes):
-        for process, filename, _, camera, _ in ffmpeg_processes.values():
+        for process, filename, _, camera, _, _ in ffmpeg_processes.values():
             finish_video(process, filename, camera)
 
     def push_image(process_data, data):
-        process, filename, _, camera, restart_timeout = process_data
-        ret2, frame2 = cv2.imencode('.png', data['frame'])
+        process, filename, _, camera, restart_timeout, frame_size = process_data
+        frame = data['frame']
+        if pipe_format == PIPE_FORMAT_RAW:
+            frame = fit_frame(frame, *frame_size)
+        frame = encode_frame(frame, pipe_format)
         try:
             if global_variables.g_run_capture:
-                process.stdin.write(frame2.tobytes())
+                process.stdin.write(frame)
         except Exception as e:
             print(e)
             finish_video(process, filename, camera)
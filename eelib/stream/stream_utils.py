@@ -1,7 +1,6 @@
 import sys
 import os
 import glob
-import requests
 from datetime import datetime, timezone
 import cv2
 import math
@@ -14,6 +13,7 @@ import subprocess
 import numpy as np
 from eelib.ml_line_crossing_density.utils import flo_to_color
 import eelib.stream.global_variables as global_variables
+from eelib.stream.webhook_publisher import get_publisher
 
 
 MAX_TIMEOUT = 100
@@ -138,6 +138,11 @@ def stop_stream():
     global_variables.g_run_capture = False
 
 
+def capture_stopped():
+    # producers on the output queues stop waiting for room once this is set
+    return global_variables.g_run_capture is False
+
+
 def stop_multistream():
     # global g_run_capture
     global_variables.g_run_capture = False
@@ -148,7 +153,8 @@ def stop_multistream():
 def make_callback_payload(
     people_count,
     prediction_type,
-    violations=None
+    violations=None,
+    tracking=None
 ):
     payload = {
         'count': float(people_count),
@@ -158,6 +164,9 @@ def make_callback_payload(
     if violations is not None:
         payload["violations"] = violations
 
+    if tracking is not None:
+        payload["tracking"] = tracking
+
     return payload
 
 
@@ -277,13 +286,5 @@ def frame_consumer_thread(frameq, predictq, scale_factor=1.0):
 
 
 def publish_callback(callback_urls, publish_data):
-    if callback_urls is None:
-        return
-
-    for url in callback_urls.split(';'):
-        if url == '':
-            continue
-        try:
-            requests.post(url, json=publish_data)
-        except Exception as e:
-            print("ERROR AT WEBHOOK", url, "Error", e)
+    # delivered in the background by the publisher of the job
+    get_publisher().publish(callback_urls, publish_data)
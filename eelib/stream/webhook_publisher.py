@@ -0,0 +1,220 @@
+import time
+import queue
+import atexit
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from eelib.stream.frame_queue import FrameQueue, POLICY_DROP_OLDEST
+
+# pending payloads per callback url, the oldest update is dropped when a
+# subscriber falls further behind
+QUEUE_SIZE = 100
+# seconds for connecting to and reading from a subscriber
+TIMEOUT = 5
+MAX_RETRIES = 3
+# seconds before the first retry, doubled on every retry
+BACKOFF_START = 0.5
+MAX_BATCH_SIZE = 50
+# seconds the publisher waits for the pending payloads on exit
+CLOSE_TIMEOUT = 10
+
+
+def is_droppable(item):
+    # START and STOP events are always delivered
+    return item is not None and item['data'].get('event_name') == 'UPDATE'
+
+
+class Destination:
+    """
+    Delivery to one callback url: a bounded queue, a keep-alive session
+    and one worker that posts the payloads with retries. With one worker
+    the events of a stream arrive in the order they were published, a STOP
+    never before the last UPDATEs.
+    """
+
+    def __init__(self, url, queue_size, timeout, batch_window):
+        self.url = url
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.queue = FrameQueue(
+            'webhook {}'.format(url), queue_size, POLICY_DROP_OLDEST,
+            can_drop=is_droppable)
+
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(
+            pool_connections=1, pool_maxsize=1))
+
+        self.lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def put(self, data):
+        self.queue.put_nowait({'data': data, 'time': time.time()})
+
+    def _get_batch(self, first):
+        # payloads published within batch_window seconds are sent together
+        batch = [first]
+        deadline = time.time() + self.batch_window
+        while len(batch) < MAX_BATCH_SIZE:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # keep the stop signal for the next get of the worker
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _post(self, body):
+        backoff = BACKOFF_START
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                response = self.session.post(
+                    self.url, json=body, timeout=self.timeout)
+                # client errors are not retried
+                if response.status_code < 500:
+                    return response.status_code < 400
+                error = 'status {}'.format(response.status_code)
+            except Exception as e:
+                error = e
+
+            if attempt < MAX_RETRIES:
+                time.sleep(backoff)
+                backoff *= 2
+
+        print("ERROR AT WEBHOOK", self.url, "Error", error)
+        return False
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            items = [item] if not self.batch_window else self._get_batch(item)
+            body = (
+                items[0]['data'] if not self.batch_window
+                else [i['data'] for i in items])
+            success = self._post(body)
+
+            now = time.time()
+            with self.lock:
+                if success:
+                    self.delivered += len(items)
+                    for i in items:
+                        latency = now - i['time']
+                        self.total_latency += latency
+                        self.max_latency = max(self.max_latency, latency)
+                else:
+                    self.failed += len(items)
+
+    def close(self, deadline):
+        self.queue.put(None)
+        self.worker.join(max(0, deadline - time.time()))
+        self.session.close()
+
+    def stats(self):
+        queue_stats = self.queue.stats()
+        with self.lock:
+            return {
+                'url': self.url,
+                'delivered': self.delivered,
+                'failed': self.failed,
+                'dropped': queue_stats['dropped'],
+                'pending': queue_stats['depth'],
+                'avg_latency': (
+                    self.total_latency / self.delivered
+                    if self.delivered else 0.0),
+                'max_latency': self.max_latency
+            }
+
+
+class WebhookPublisher:
+    """
+    Publishes the prediction callbacks of a stream job in the background.
+    publish only enqueues the payload, so a slow or unreachable subscriber
+    can not stall the output of the streams. Every callback url has its own
+    queue and worker, so the urls are posted to concurrently; with
+    batch_window set, the payloads published within that many seconds are
+    posted together as one json list.
+    """
+
+    def __init__(
+        self,
+        queue_size=QUEUE_SIZE,
+        timeout=TIMEOUT,
+        batch_window=None
+    ):
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.batch_window = batch_window
+        self.destinations = {}
+        self.lock = threading.Lock()
+        self.closed = False
+
+    def get_destination(self, url):
+        with self.lock:
+            if url not in self.destinations:
+                self.destinations[url] = Destination(
+                    url,
+                    self.queue_size,
+                    self.timeout,
+                    self.batch_window)
+            return self.destinations[url]
+
+    def publish(self, callback_urls, publish_data):
+        if callback_urls is None or self.closed:
+            return
+
+        for url in callback_urls.split(';'):
+            if url == '':
+                continue
+            self.get_destination(url).put(publish_data)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Delivers the pending payloads, waiting at most timeout seconds.
+        """
+        if self.closed:
+            return
+
+        self.closed = True
+        deadline = time.time() + timeout
+        for destination in self.destinations.values():
+            destination.close(deadline)
+        self.report()
+
+    def report(self):
+        for destination in self.destinations.values():
+            print(
+                "webhook {url}: delivered {delivered}, failed {failed}, "
+                "dropped {dropped}, pending {pending}, "
+                "latency avg {avg_latency:.3f}s max {max_latency:.3f}s".format(
+                    **destination.stats()))
+
+
+publisher = None
+publisher_lock = threading.Lock()
+
+
+def get_publisher(**options):
+    """
+    The publisher of this process, created with options on the first call.
+    Pending payloads are delivered when the process exits.
+    """
+    global publisher
+    with publisher_lock:
+        if publisher is None:
+            publisher = WebhookPublisher(**options)
+            atexit.register(publisher.close)
+        return publisher
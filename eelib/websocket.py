@@ -1,18 +1,146 @@
+import atexit
+import threading
+from collections import OrderedDict
 import requests
+from requests.adapters import HTTPAdapter
 from eelib.config import load
 
-config = load()
-base_url = config["backend"]["url"]
-token = config["backend"]["token"]
+# seconds for connecting to and reading from the backend
+TIMEOUT = 5
+# messages waiting for the backend, the oldest is dropped beyond this
+MAX_PENDING = 1000
+# seconds the notifier waits for the pending messages on exit
+CLOSE_TIMEOUT = 10
+
+
+def get_coalesce_key(route, event_type, data):
+    """
+    Updates of the same object (route and id) replace each other while
+    they wait, only the latest state is sent. Other messages, like the
+    rows of the training charts, are all sent in order.
+    """
+    if event_type == 'update' and isinstance(data, dict) and 'id' in data:
+        return (route, event_type, data['id'])
+    return None
+
+
+class WebsocketNotifier:
+    """
+    Sends the websocket messages for the backend from a background thread
+    over one keep-alive session, so training and stream loops never wait
+    on the backend. The config is loaded with the first message.
+    """
+
+    def __init__(self, max_pending=MAX_PENDING, timeout=TIMEOUT):
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.pending = OrderedDict()
+        self.condition = threading.Condition()
+        self.sequence = 0
+        self.thread = None
+        self.closed = False
+        self.session = None
+        self.base_url = None
+        self.token = None
+
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def get_url(self, route):
+        if self.base_url is None:
+            config = load()
+            self.base_url = config["backend"]["url"]
+            self.token = config["backend"]["token"]
+        return f"{self.base_url}/websocket/echo/{route}?tk={self.token}"
+
+    def get_session(self):
+        if self.session is None:
+            self.session = requests.Session()
+            self.session.mount('http://', HTTPAdapter(pool_maxsize=1))
+            self.session.mount('https://', HTTPAdapter(pool_maxsize=1))
+        return self.session
+
+    def post(self, route, event_type, data):
+        try:
+            self.get_session().post(
+                self.get_url(route),
+                json={
+                    "event_type": event_type,
+                    "data": data
+                },
+                timeout=self.timeout)
+            self.sent += 1
+        except Exception as e:
+            self.failed += 1
+            print("Could not send websocket message:", repr(e))
+
+    def send(self, route, event_type, data):
+        with self.condition:
+            if self.closed:
+                # after the flush on exit messages are sent right away
+                closed = True
+            else:
+                closed = False
+                key = get_coalesce_key(route, event_type, data)
+                if key is None:
+                    key = self.sequence
+                    self.sequence += 1
+
+                if key in self.pending:
+                    self.coalesced += 1
+                elif len(self.pending) >= self.max_pending:
+                    self.pending.popitem(last=False)
+                    self.dropped += 1
+
+                # a replaced update keeps the place of the first one, the
+                # data is copied as the caller may change it before it is sent
+                self.pending[key] = (
+                    route,
+                    event_type,
+                    dict(data) if isinstance(data, dict) else data)
+                self.condition.notify()
+
+                if self.thread is None:
+                    self.thread = threading.Thread(
+                        target=self._run, daemon=True)
+                    self.thread.start()
+                    atexit.register(self.close)
+
+        if closed:
+            self.post(route, event_type, data)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(
+                    lambda: len(self.pending) > 0 or self.closed)
+                if len(self.pending) == 0:
+                    break
+                _, message = self.pending.popitem(last=False)
+
+            self.post(*message)
+
+    def close(self, timeout=CLOSE_TIMEOUT):
+        """
+        Sends the pending messages, waiting at most timeout seconds.
+        """
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.condition.notify()
+
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+        print(f"websocket messages: sent {self.sent}, coalesced "
+              f"{self.coalesced}, dropped {self.dropped}, failed {self.failed}")
+
+
+notifier = WebsocketNotifier()
 
 
 def send_websocket_message(route, event_type, data):
-    try:
-        url = f"{base_url}/websocket/echo/{route}?tk={token}"
-        body = {
-            "event_type": event_type,
-            "data": data
-        }
-        requests.post(url, json=body)
-    except Exception as e:
-        print("Exiting because of error:", repr(e))
+    notifier.send(route, event_type, data)
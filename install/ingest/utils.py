@@ -9,6 +9,7 @@ def handle_image(collection, img_path, classes):
     store.insert_frame_if_not_exists(None, img_path)
     frame = store.get_frame_by_path(img_path)
     store.insert_collection_frame_if_not_exists(collection.id, frame.id)
+    bounding_boxes = []
     try:
         with open(label_path) as f:
             for line in f.readlines():
@@ -30,10 +31,12 @@ def handle_image(collection, img_path, classes):
                     print("Skipping label in {} : Something wrong with label format".format(img_path))
                     continue
 
-                store.insert_bounding_box_if_not_exists(frame.id, label.id, x, y, w, h)
+                bounding_boxes.append((frame.id, label.id, x, y, w, h))
     except:
         print("Skipping label in {} : Label file not found".format(img_path))
 
+    store.insert_bounding_boxes_if_not_exist(bounding_boxes)
+
 def get_object_recognition_classes(names_path):
     with open(names_path) as f:
         return [label.replace("\n", "") for label in f.readlines()]
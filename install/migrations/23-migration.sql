@@ -0,0 +1,5 @@
+-- files of deleted frames that still have to be removed from disk
+CREATE TABLE IF NOT EXISTS pending_unlink (
+  path TEXT PRIMARY KEY,
+  created_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
@@ -1,25 +1,38 @@
 import sys
 import eelib.job as job
 import eelib.store as store
+import eelib.postgres as pg
+from eelib.websocket import send_websocket_message
 
 
 def main():
     collection_ids = job.get_or_fail('collection_ids')
     new_collection_name = job.get_or_fail('collection_name')
-    inserted = store.insert_collection_if_not_exists(new_collection_name)
 
-    if not inserted:
-        print('Collection: ', new_collection_name, 'already exists')
-        sys.exit(1)
+    # the new collection is created and filled completely or not at all
+    with pg.transaction():
+        inserted = store.insert_collection_if_not_exists(new_collection_name)
 
-    new_collection = store.get_collection_by_name(new_collection_name)
+        if not inserted:
+            print('Collection: ', new_collection_name, 'already exists')
+            sys.exit(1)
 
-    for collection_id in collection_ids:
-        col = store.get_collection_by_id(collection_id)
-        frames = store.get_frames_for_collection(col)
-        for frame in frames:
-            store.insert_collection_frame_if_not_exists(new_collection.id, frame.id)
+        new_collection = store.get_collection_by_name(new_collection_name)
 
+        for idx, collection_id in enumerate(collection_ids):
+            col = store.get_collection_by_id(collection_id)
+            inserted, skipped = store.insert_collection_frames_from_collection(
+                new_collection.id, col.id)
+            print('collection {}: inserted {} frames, skipped {}'.format(
+                col.name, inserted, skipped))
+            send_websocket_message(
+                'info',
+                'new',
+                "Collection '{}': combined {} of {} collections".format(
+                    new_collection_name, idx + 1, len(collection_ids)))
+
+    send_websocket_message(
+        'info', 'new', "Collection '{}' created".format(new_collection_name))
     print('done')
 
 main()
@@ -1,7 +1,7 @@
 import sys
 import eelib.job as job
 import eelib.store as store
-from eelib.store_utils import handle_create_gt_from_frame
+from eelib.ml_density.dataset_builder import build_density_dataset
 
 
 # example
@@ -10,6 +10,8 @@ from eelib.store_utils import handle_create_gt_from_frame
 #   "scriptArgs": {
 #     "dataset_name": "my test set",
 #     "frames": [5,10,11,12, ...],
+#     "processes": 8,
+#     "resume": false,
 #     "density_config": {
 #       "sigma": 12,
 #       "beta": -1,
@@ -54,7 +56,8 @@ def main():
     dataset_created = store.insert_dataset_if_not_exists(
         dataset_name, nn_type.id)
 
-    if not dataset_created:
+    # resume continues a dataset job that crashed or was stopped
+    if not dataset_created and not job_args.get('resume', False):
         print('dataset with name {} exists already'.format(dataset_name))
         sys.exit(1)
 
@@ -62,8 +65,8 @@ def main():
 
     print('dataset {}'.format(dataset))
     print('density config: sigma {}, beta {}'.format(sigma, beta))
-    for frame_id in frames:
-        handle_create_gt_from_frame(frame_id, dataset, sigma, beta)
+    build_density_dataset(
+        frames, dataset, sigma, beta, job_args.get('processes'))
 
     print('done')
 
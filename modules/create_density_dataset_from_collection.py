@@ -1,7 +1,7 @@
 import sys
 import eelib.job as job
 import eelib.store as store
-from eelib.store_utils import handle_create_gt_from_frame
+from eelib.ml_density.dataset_builder import build_density_dataset
 
 
 def main():
@@ -45,14 +45,19 @@ def main():
     dataset_created = store.insert_dataset_if_not_exists(
         dataset_name, nn_type.id)
 
-    if not dataset_created:
+    # resume continues a dataset job that crashed or was stopped
+    if not dataset_created and not job_args.get('resume', False):
         print('dataset with name {} exists already'.format(dataset_name))
         sys.exit(1)
 
     dataset = store.get_dataset_by_name(dataset_name)
 
-    for frame in frames:
-        handle_create_gt_from_frame(frame.id, dataset, sigma, beta)
+    build_density_dataset(
+        [frame.id for frame in frames],
+        dataset,
+        sigma,
+        beta,
+        job_args.get('processes'))
 
 
 main()
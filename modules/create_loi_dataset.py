@@ -1,7 +1,7 @@
 import sys
 import eelib.job as job
 import eelib.store as store
-from modules.create_loi_dataset_utils import extract_frame
+from modules.create_loi_dataset_utils import insert_next_frame_pairs
 
 
 # example
@@ -53,29 +53,13 @@ def main():
             to float")
         sys.exit(1)
 
-    for frame_id in frame_ids:
-        frame = store.get_frame_with_video_by_id(frame_id)
+    frames = store.get_frames_with_video_by_ids(frame_ids)
+    for frame in frames:
         if not frame.video_file_path:
             print('Each frame should be connected to video')
             sys.exit(1)
 
-        frame_path = extract_frame(
-            frame.video_file_path,
-            (frame.timestamp / 1000) + ss_delta_next_frame)
-
-        if not frame_path:
-            continue
-
-        # insert frame not to far in the future from current frame
-        # that is hidden from the user in the UI
-        next_frame = store.insert_frame_if_not_exists_with_timestamp(
-            frame.video_file_id,
-            frame_path,
-            frame.timestamp + int(ss_delta_next_frame * 1000),
-            hidden=True
-        )
-        store.insert_frame_pair_loi_dataset_if_not_exists(
-            frame.id, next_frame.id, dataset.id)
+    insert_next_frame_pairs(frames, dataset.id, ss_delta_next_frame)
 
     print('done')
 
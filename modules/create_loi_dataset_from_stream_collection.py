@@ -9,6 +9,7 @@ def handle_stream_collection(
     skip_between,
     distance=1
 ):
+    frame_pairs = []
     for index, input_frame, in enumerate(frames):
         if skip_between and index % distance != 0:
             continue
@@ -17,8 +18,11 @@ def handle_stream_collection(
             break
 
         target_frame = frames[index + distance]
-        store.insert_frame_pair_loi_dataset_if_not_exists(
-            input_frame.id, target_frame.id, dataset_id)
+        frame_pairs.append((input_frame.id, target_frame.id, dataset_id))
+
+    inserted, skipped = store.insert_frame_pairs_loi_dataset_if_not_exist(
+        frame_pairs)
+    print('inserted {} frame pairs, skipped {}'.format(inserted, skipped))
 
 
 def get_distance(job_args):
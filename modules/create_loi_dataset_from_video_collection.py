@@ -1,7 +1,7 @@
 import sys
 import eelib.job as job
 import eelib.store as store
-from modules.create_loi_dataset_utils import extract_frame
+from modules.create_loi_dataset_utils import insert_next_frame_pairs
 
 
 def handle_video_collection(collection_id, dataset_id, ss_delta_next_frame):
@@ -12,24 +12,7 @@ def handle_video_collection(collection_id, dataset_id, ss_delta_next_frame):
         print(f"No frames in collection '{collection_id}' connected to video")
         sys.exit(1)
 
-    for frame in frames:
-        frame_path = extract_frame(
-            frame.video_file_path,
-            (frame.timestamp / 1000) + ss_delta_next_frame)
-
-        if not frame_path:
-            continue
-
-        # insert frame not to far in the future from current frame
-        # that is hidden from the user in the UI
-        next_frame = store.insert_frame_if_not_exists_with_timestamp(
-            frame.video_file_id,
-            frame_path,
-            frame.timestamp + int(ss_delta_next_frame * 1000),
-            hidden=True
-        )
-        store.insert_frame_pair_loi_dataset_if_not_exists(
-            frame.id, next_frame.id, dataset_id)
+    insert_next_frame_pairs(frames, dataset_id, ss_delta_next_frame)
 
 
 def get_distance(job_args):
@@ -1,18 +1,201 @@
 import os
+import math
 import subprocess
 import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import numpy as np
+import eelib.store as store
+import eelib.postgres as pg
 
+FFPROBE_TIMEOUT = 10
+# requested frames closer together than this (in seconds) are decoded in
+# one streaming pass, further apart the decoder seeks to the keyframe
+# before the next frame instead of decoding everything in between
+SEEK_GAP_SECONDS = 10
+# videos decoded at the same time
+EXTRACT_WORKERS = 4
 
-def extract_frame(video_file_path, timestamp):
+
+def new_frame_path():
+    basePath = os.environ['EAGLE_EYE_PATH']
+    return f"{basePath}/files/frames/img_{uuid.uuid4()}.jpg"
+
+
+def probe_video(video_file_path):
+    """
+    Returns the (width, height, fps) of the first video stream.
+    """
+    command = [
+        'ffprobe', '-v', 'error', '-select_streams', 'v:0',
+        '-show_entries', 'stream=width,height,r_frame_rate',
+        '-of', 'csv=s=x:p=0', video_file_path]
+    output = subprocess.run(
+        command, stdout=subprocess.PIPE, timeout=FFPROBE_TIMEOUT, check=True
+    ).stdout.decode('utf-8').strip()
+    width, height, rate = output.split('x')
+    numerator, denominator = rate.split('/')
+    return int(width), int(height), float(numerator) / float(denominator)
+
+
+def group_timestamps(timestamps, max_gap=SEEK_GAP_SECONDS):
+    """
+    Splits the sorted timestamps into runs without gaps larger than
+    max_gap, every run is decoded by one ffmpeg process.
+    """
+    runs = []
+    for timestamp in timestamps:
+        if len(runs) > 0 and timestamp - runs[-1][-1] <= max_gap:
+            runs[-1].append(timestamp)
+        else:
+            runs.append([timestamp])
+    return runs
+
+
+def get_frame_indices(timestamps, fps):
+    """
+    The start of the decoding, rounded down to a frame boundary, and for
+    every timestamp the index (counted from that start) of the first frame
+    at or after it. ffmpeg outputs the first frame at or after the seek
+    position, only on a frame boundary is that frame exactly at start.
+    """
+    start = math.floor(timestamps[0] * fps + 1e-6) / fps
+    indices = [
+        max(math.ceil((timestamp - start) * fps - 1e-6), 0)
+        for timestamp in timestamps
+    ]
+    return start, indices
+
+
+def extract_run(video_file_path, timestamps, width, height, fps):
+    """
+    Decodes the video once from the first to the last timestamp and writes
+    the first frame at or after every timestamp to a new jpg. Returns a
+    dict from timestamp to frame path, None for frames past the end.
+    """
+    start, wanted_indices = get_frame_indices(timestamps, fps)
+    duration = timestamps[-1] - start + 2 / fps
+    # -ss before -i seeks to the keyframe before start, so the decoding
+    # starts there instead of at the start of the video
+    command = [
+        'ffmpeg', '-loglevel', 'quiet', '-ss', str(start),
+        '-i', video_file_path, '-t', str(duration),
+        '-f', 'image2pipe', '-pix_fmt', 'bgr24', '-vcodec', 'rawvideo', '-']
+
+    frame_size = width * height * 3
+    frame_paths = {timestamp: None for timestamp in timestamps}
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    try:
+        frame_index = -1
+        frame = None
+        for timestamp, wanted_index in zip(timestamps, wanted_indices):
+            while frame_index < wanted_index:
+                data = process.stdout.read(frame_size)
+                if len(data) < frame_size:
+                    return frame_paths
+                frame = data
+                frame_index += 1
+
+            frame_path = new_frame_path()
+            image = np.frombuffer(frame, dtype='uint8').reshape(
+                height, width, 3)
+            if cv2.imwrite(frame_path, image):
+                frame_paths[timestamp] = frame_path
+    finally:
+        process.stdout.close()
+        process.kill()
+        process.wait()
+
+    return frame_paths
+
+
+def extract_video_frames(video_file_path, timestamps):
     try:
-        basePath = os.environ['EAGLE_EYE_PATH']
-        framepath = f"{basePath}/files/frames/img_{uuid.uuid4()}.jpg"
-        ffmpeg_command = [
-            'ffmpeg', '-loglevel', 'quiet', '-i', video_file_path, '-ss',
-            str(timestamp), '-vframes', '1', framepath]
-        p = subprocess.Popen(ffmpeg_command)
-        p.wait()
-        return framepath
+        width, height, fps = probe_video(video_file_path)
     except Exception as e:
-        print(f"error: {e}")
-        return None
+        print(f"error: could not probe {video_file_path}: {e}")
+        return {}
+
+    frame_paths = {}
+    for run in group_timestamps(sorted(set(timestamps))):
+        try:
+            frame_paths.update(
+                extract_run(video_file_path, run, width, height, fps))
+        except Exception as e:
+            print(f"error: {e}")
+
+    print(f"extracted {sum(p is not None for p in frame_paths.values())} "
+          f"of {len(frame_paths)} frames from {video_file_path}")
+    return frame_paths
+
+
+def extract_frames(requests, max_workers=EXTRACT_WORKERS):
+    """
+    requests: iterable of (video_file_path, timestamp in seconds).
+    Timestamps are grouped per video and sorted, every video is decoded
+    once (with keyframe seeks over large gaps) and the videos are decoded
+    in parallel. Returns a dict from (video_file_path, timestamp) to the
+    path of the extracted frame, or None when it could not be extracted.
+    """
+    timestamps = defaultdict(list)
+    for video_file_path, timestamp in requests:
+        timestamps[video_file_path].append(timestamp)
+
+    frame_paths = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for video_file_path, video_frame_paths in zip(
+            timestamps.keys(),
+            executor.map(
+                lambda item: extract_video_frames(*item), timestamps.items())
+        ):
+            for timestamp, frame_path in video_frame_paths.items():
+                frame_paths[(video_file_path, timestamp)] = frame_path
+
+    return frame_paths
+
+
+def extract_frame(video_file_path, timestamp):
+    return extract_frames([(video_file_path, timestamp)]).get(
+        (video_file_path, timestamp))
+
+
+def insert_next_frame_pairs(frames, dataset_id, ss_delta_next_frame):
+    """
+    Extracts for every frame (joined with video_file_path) the frame
+    ss_delta_next_frame seconds later, inserts those as frames hidden from
+    the user and pairs them with the frames in the dataset, in bulk.
+    """
+    def next_timestamp(frame):
+        return (frame.timestamp / 1000) + ss_delta_next_frame
+
+    frame_paths = extract_frames(
+        (frame.video_file_path, next_timestamp(frame)) for frame in frames)
+
+    pairs = []
+    for frame in frames:
+        frame_path = frame_paths.get(
+            (frame.video_file_path, next_timestamp(frame)))
+        if frame_path:
+            pairs.append((frame, frame_path))
+
+    with pg.transaction():
+        # frame not to far in the future from current frame
+        # that is hidden from the user in the UI
+        frame_ids = store.insert_frames_with_timestamp({
+            frame_path: (
+                frame.video_file_id,
+                frame_path,
+                frame.timestamp + int(ss_delta_next_frame * 1000),
+                True
+            )
+            for frame, frame_path in pairs
+        }.values())
+        inserted, skipped = store.insert_frame_pairs_loi_dataset_if_not_exist(
+            (frame.id, frame_ids[frame_path], dataset_id)
+            for frame, frame_path in pairs
+        )
+
+    print('inserted {} frame pairs, skipped {}, {} frames not extracted'.format(
+        inserted, skipped, len(frames) - len(pairs)))
@@ -44,9 +44,9 @@ def main():
 
     print('dataset {}'.format(dataset))
 
-    print(frames, dataset.id)
-    for frame_id in frames:
-        store.insert_frame_object_recognition_dataset(frame_id, dataset.id)
+    inserted, skipped = store.insert_frame_object_recognition_datasets(
+        frames, dataset.id)
+    print('inserted {} frames, skipped {}'.format(inserted, skipped))
 
     print('done')
 
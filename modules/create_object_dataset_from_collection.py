@@ -35,8 +35,9 @@ def main():
 
     dataset = store.get_dataset_by_name(dataset_name)
 
-    for frame in frames:
-        store.insert_frame_object_recognition_dataset(frame.id, dataset.id)
+    inserted, skipped = store.insert_frame_object_recognition_datasets(
+        [frame.id for frame in frames], dataset.id)
+    print('inserted {} frames, skipped {}'.format(inserted, skipped))
 
     print('done')
 
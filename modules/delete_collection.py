@@ -1,9 +1,64 @@
 import sys
+import os
+from concurrent.futures import ThreadPoolExecutor
 import eelib.store as store
 import eelib.job as job
-import os
+import eelib.postgres as pg
 from eelib.websocket import send_websocket_message
 
+UNLINK_WORKERS = 8
+# pending files removed per round of the sweep
+UNLINK_CHUNK_SIZE = 1000
+
+
+def unlink(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        # already removed by an earlier sweep
+        pass
+    except Exception as e:
+        print(f"Could not remove {path}: {e}")
+        return False
+
+    return True
+
+
+def unlink_pending_files(name, max_workers=UNLINK_WORKERS):
+    """
+    Removes the files in pending_unlink in parallel, also the ones left
+    behind by an earlier run. A path is removed from the list only after
+    the file is gone, so an interrupted sweep is picked up by the next one.
+    """
+    removed = 0
+    failed = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            paths = [
+                path for path in store.get_pending_unlinks(
+                    UNLINK_CHUNK_SIZE + len(failed))
+                if path not in failed
+            ]
+            if len(paths) == 0:
+                break
+
+            results = list(executor.map(unlink, paths))
+            store.delete_pending_unlinks([
+                path for path, done in zip(paths, results) if done])
+            failed.update(
+                path for path, done in zip(paths, results) if not done)
+
+            removed += sum(results)
+            print(f"Removed {removed} files")
+            send_websocket_message(
+                'info', 'new', f"Collection '{name}': removed {removed} files")
+
+    if len(failed) > 0:
+        print(f"{len(failed)} files could not be removed and stay pending")
+
+    return removed
+
+
 def main():
     collection_id = job.get_or_fail('collection_id')
     collection = store.get_collection_by_id(collection_id)
@@ -11,47 +66,36 @@ def main():
         print(f"collection with id: {collection_id} doesn't exist")
         sys.exit(1)
 
-    frames = store.get_unlocked_frames_by_collection_id(collection_id)
-    database_referenced = False
-    print(f"Starting to delete {len(frames)} frames")
-    for frame in frames:
-        try:
-            ground_truths = store.get_groundtruths_by_frame_id(frame.id)
-            if len(ground_truths) > 0:
-                print(f"Frame: {frame.id} is still referenced by density dataset therefore it is not deleted")
-                database_referenced = True
-                continue
-
-            object_dataset = store.get_object_dataset_by_frame_id(frame.id)
-            if object_dataset is not None:
-                print(f"Frame: {frame.id} is still referenced by object dataset therefore it is not deleted")
-                database_referenced = True
-                continue
-
-            print(f"Deleting db references to [metadata, collections, tags, bounding boxes] frame: {frame.id}")
-            store.delete_frame_metadata(frame.id)
-            store.delete_frame_from_collections(frame.id)
-            store.delete_tags_by_frame_id(frame.id)
-            store.delete_bboxes_by_frame_id(frame.id)
-
-            print(f"Delete frame db reference: {frame.id} and remove {frame.path}")
-            os.unlink(frame.path)
-            store.delete_frame_by_id(frame.id)
-        except Exception as e:
-            print(e)
-
-    locked_frames = store.get_locked_frames_by_collection_id(collection_id)
-    if database_referenced:
+    send_websocket_message(
+        'info', 'new', f"Collection '{collection.name}': deleting frames")
+
+    # either all frames and references are deleted or none
+    with pg.transaction():
+        deleted, referenced = store.delete_unlocked_frames_by_collection_id(
+            collection_id)
+        print(f"Deleted {deleted} frames, {referenced} frames are still referenced by a dataset")
+
+        locked_frames = store.get_locked_frames_by_collection_id(collection_id)
+        delete_collection = referenced == 0 and len(locked_frames) == 0
+        if delete_collection:
+            print("No locked frames therefore deleting collection.")
+            store.delete_collection_frames_by_id(collection_id)
+            store.delete_collection_by_id(collection_id)
+
+    send_websocket_message(
+        'info', 'new', f"Collection '{collection.name}': deleted {deleted} frames, removing files")
+
+    unlink_pending_files(collection.name)
+
+    if referenced > 0:
         print('Some frames where still references by dataset and therefor not deleted.')
-    elif len(locked_frames) == 0:
-        print("No locked frames therefore deleting collection.")
-        store.delete_collection_frames_by_id(collection_id)
-        store.delete_collection_by_id(collection_id)
+    elif delete_collection:
         send_websocket_message('info', 'new', f"Collection '{collection.name}' succesfully deleted")
     else:
         send_websocket_message('info', 'new',
             f"All unlocked frames from collection '{collection.name}' succesfully deleted")
 
+    pg.report_stats()
     print("finished")
 
 main()
@@ -0,0 +1,43 @@
+import sys
+import eelib.job as job
+from eelib.networks.model_server import (
+    ModelServer,
+    get_server_config,
+    MAX_BATCH_SIZE,
+    MAX_BATCH_WAIT
+)
+
+"""
+example
+{
+   "scriptName" : "model_server.py",
+   "scriptArgs": {
+        "max_batch_size": 8,
+        "max_batch_wait": 0.05
+    }
+}
+
+Serves the networks of the stream jobs on this node that are started with
+"model_server": true, so every model is only loaded once.
+"""
+
+
+def main():
+    max_batch_size = job.get_or_default('max_batch_size', MAX_BATCH_SIZE)
+    max_batch_wait = job.get_or_default('max_batch_wait', MAX_BATCH_WAIT)
+    try:
+        address, authkey = get_server_config()
+    except Exception as e:
+        print('can not start model server:', e)
+        sys.exit(1)
+
+    server = ModelServer(address, authkey, max_batch_size, max_batch_wait)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print('got sigint. stop model server')
+
+    print('done')
+
+
+main()
@@ -1,6 +1,7 @@
 import sys
 import eelib.job as job
 import eelib.store as store
+import eelib.postgres as pg
 from eelib.websocket import send_websocket_message
 
 
@@ -18,23 +19,20 @@ def handle_density(job_args):
         sys.exit(1)
 
     split_index = int(len(groundtruths) * job_args["split"])
-    groundtruths_dataset_1 = groundtruths[:split_index]
-    for groundtruth in groundtruths_dataset_1:
-        store.insert_gt(
-            groundtruth.frame_id,
-            dataset_1.id,
-            groundtruth.path,
-            groundtruth.render_path
-        )
-
-    groundtruths_dataset_2 = groundtruths[split_index:]
-    for groundtruth in groundtruths_dataset_2:
-        store.insert_gt(
-            groundtruth.frame_id,
-            dataset_2.id,
-            groundtruth.path,
-            groundtruth.render_path
+    for dataset, groundtruths_dataset in [
+        (dataset_1, groundtruths[:split_index]),
+        (dataset_2, groundtruths[split_index:])
+    ]:
+        inserted = store.insert_gts(
+            (
+                groundtruth.frame_id,
+                dataset.id,
+                groundtruth.path,
+                groundtruth.render_path
+            )
+            for groundtruth in groundtruths_dataset
         )
+        print('inserted {} ground truths in {}'.format(inserted, dataset.name))
 
     return dataset_1, dataset_2
 
@@ -54,13 +52,14 @@ def handle_object(job_args):
         sys.exit(1)
 
     split_index = int(len(frames) * job_args["split"])
-    frames_dataset_1 = frames[:split_index]
-    for frame in frames_dataset_1:
-        store.insert_frame_object_recognition_dataset(frame.id, dataset_1.id)
-
-    frames_dataset_2 = frames[split_index:]
-    for frame in frames_dataset_2:
-        store.insert_frame_object_recognition_dataset(frame.id, dataset_2.id)
+    for dataset, frames_dataset in [
+        (dataset_1, frames[:split_index]),
+        (dataset_2, frames[split_index:])
+    ]:
+        inserted, skipped = store.insert_frame_object_recognition_datasets(
+            [frame.id for frame in frames_dataset], dataset.id)
+        print('inserted {} frames in {}, skipped {}'.format(
+            inserted, dataset.name, skipped))
 
     return dataset_1, dataset_2
 
@@ -80,22 +79,20 @@ def handle_loi(job_args):
         sys.exit(1)
 
     split_index = int(len(frame_pairs) * job_args["split"])
-
-    frame_pairs_dataset_1 = frame_pairs[:split_index]
-    for frame_pair in frame_pairs_dataset_1:
-        store.insert_frame_pair_loi_dataset_if_not_exists(
-            frame_pair.input_frame_id,
-            frame_pair.target_frame_id,
-            dataset_1.id
-        )
-
-    frame_pairs_dataset_2 = frame_pairs[split_index:]
-    for frame_pair in frame_pairs_dataset_2:
-        store.insert_frame_pair_loi_dataset_if_not_exists(
-            frame_pair.input_frame_id,
-            frame_pair.target_frame_id,
-            dataset_2.id
+    for dataset, frame_pairs_dataset in [
+        (dataset_1, frame_pairs[:split_index]),
+        (dataset_2, frame_pairs[split_index:])
+    ]:
+        inserted, skipped = store.insert_frame_pairs_loi_dataset_if_not_exist(
+            (
+                frame_pair.input_frame_id,
+                frame_pair.target_frame_id,
+                dataset.id
+            )
+            for frame_pair in frame_pairs_dataset
         )
+        print('inserted {} frame pairs in {}, skipped {}'.format(
+            inserted, dataset.name, skipped))
 
     return dataset_1, dataset_2
 
@@ -139,7 +136,9 @@ def main():
     dataset = store.get_dataset_by_id(job_args["dataset_id"])
     nn_type = store.get_nn_type_by_id(dataset.nn_type_id)
     if nn_type.name == "object_recognition":
-        dataset_1, dataset_2 = handle_object(job_args)
+        # both halves are committed together or not at all
+        with pg.transaction():
+            dataset_1, dataset_2 = handle_object(job_args)
         send_websocket_message(
             'dataset',
             'new',
@@ -152,7 +151,9 @@ def main():
         )
 
     if nn_type.name == "density_estimation":
-        dataset_1, dataset_2 = handle_density(job_args)
+        # both halves are committed together or not at all
+        with pg.transaction():
+            dataset_1, dataset_2 = handle_density(job_args)
         send_websocket_message(
             'dataset',
             'new',
@@ -165,7 +166,9 @@ def main():
         )
 
     if nn_type.name == "line_crossing_density":
-        dataset_1, dataset_2 = handle_loi(job_args)
+        # both halves are committed together or not at all
+        with pg.transaction():
+            dataset_1, dataset_2 = handle_loi(job_args)
         send_websocket_message(
             'dataset',
             'new',
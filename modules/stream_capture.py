@@ -13,8 +13,16 @@ from eelib.config import load
 from eelib.stream.capture import capture_stream
 from eelib.stream.stream_utils import stop_stream
 from eelib.networks.registry import get_network
+from eelib.networks.model_server import get_shared_network
+from eelib.networks.inference_backend import (
+    get_inference_network,
+    BACKEND_EAGER
+)
 from eelib.ml.standard_transform import standard_transform
 from eelib.stream.stream_utils import publish_callback, set_selected_gpu
+from eelib.stream.webhook_publisher import get_publisher
+from eelib.stream.frame_queue import DEFAULT_QUEUE_SIZE, POLICY_DROP_OLDEST
+from eelib.stream.stream_server import PIPE_FORMAT_RAW
 
 """
 example
@@ -63,11 +71,28 @@ def main():
     save_images = job.get_or_default('save_images', False)
     scale_factor = job.get_or_default('scale_factor', 1.0)
     save_every = job.get_or_default('save_every', None)
+    # maximum number of frames a stage may lag behind and what to do then:
+    # 'block', 'drop_oldest' or 'keep_latest'
+    queue_size = job.get_or_default('queue_size', DEFAULT_QUEUE_SIZE)
+    queue_policy = job.get_or_default('queue_policy', POLICY_DROP_OLDEST)
+    # 'raw' or 'png', the format in which frames are piped to ffmpeg
+    pipe_format = job.get_or_default('pipe_format', PIPE_FORMAT_RAW)
+    # use the network of the model server job instead of loading a copy
+    model_server = job.get_or_default('model_server', False)
+    # 'eager', 'fp16', 'bf16', 'torchscript' or 'onnx' (cpu)
+    inference_backend = job.get_or_default('inference_backend', BACKEND_EAGER)
+    # object streams: count unique tracks and crossings of the loi lines,
+    # running the detector every detect_every frames
+    tracking = job.get_or_default('tracking', False)
+    detect_every = job.get_or_default('detect_every', 1)
 
     # comma separated
     callback_urls = job.get_or_default('callback_urls', '')
+    # seconds of updates that are posted together as a list, off by default
+    callback_batch_window = job.get_or_default('callback_batch_window', None)
 
     print('run with webhook callbacks:', callback_urls)
+    get_publisher(batch_window=callback_batch_window)
 
     set_selected_gpu(selected_gpu, cuda)
 
@@ -88,7 +113,13 @@ def main():
     # confusing naming. model, network... phew.. tech debt he
     neural_network_type = store.get_nn_type_by_id(network.nn_type_id)
 
-    cuda_net = get_network(
+    # line crossing streams use more of the network than network(img)
+    load_network = (
+        get_shared_network
+        if model_server and neural_network_type.name != 'line_crossing_density'
+        else get_network
+    )
+    cuda_net = load_network(
         network.name,
         cuda=cuda,
         cuda_device=selected_gpu,
@@ -98,6 +129,10 @@ def main():
         print('No registered cuda network code for {}'.format(network.train_script))
         sys.exit(1)
 
+    if neural_network_type.name != 'line_crossing_density':
+        cuda_net = get_inference_network(
+            cuda_net, inference_backend, model.path)
+
     job_id = job.get_job_id()
     stream_instance = store.get_stream_instance_by_name(name)
     store.insert_camera_if_not_exists(stream)
@@ -156,8 +191,8 @@ def main():
                 'payload': payload,
                 'event_name': 'UPDATE'
             }
-            camera = store.get_camera_by_stream_url(stream)
 
+            # camera of the stream, loaded before the stream starts
             if camera.area_size_m2:
                 publish_data['area_size_m2'] = float(camera.area_size_m2)
 
@@ -200,7 +235,12 @@ def main():
         selected_device=selected_gpu,
         save_images=save_images,
         scale_factor=scale_factor,
-        save_every=save_every)
+        save_every=save_every,
+        tracking=tracking,
+        detect_every=detect_every,
+        queue_size=queue_size,
+        queue_policy=queue_policy,
+        pipe_format=pipe_format)
 
     publish_data = {
         'stream_url': stream,
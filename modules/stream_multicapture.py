@@ -4,12 +4,25 @@ import torch
 
 import eelib.job as job
 import eelib.postgres as pg
-from eelib.stream.multicapture import multicapture_stream
+from eelib.stream.multicapture import (
+    multicapture_stream,
+    MAX_BATCH_SIZE,
+    MAX_BATCH_WAIT,
+    MAX_GRAB_WORKERS
+)
+from eelib.stream.frame_queue import DEFAULT_QUEUE_SIZE, POLICY_DROP_OLDEST
 from eelib.stream.stream_utils import stop_multistream
 import eelib.store as store
 from eelib.networks.registry import get_network
+from eelib.networks.model_server import get_shared_network
+from eelib.networks.inference_backend import (
+    get_inference_network,
+    BACKEND_EAGER
+)
 from eelib.ml.standard_transform import standard_transform
+from eelib.stream.stream_resources import StreamResources
 from eelib.stream.stream_utils import publish_callback, set_selected_gpu
+from eelib.stream.webhook_publisher import get_publisher
 from eelib.websocket import send_websocket_message
 
 
@@ -22,6 +35,12 @@ example
 {
    "scriptName" : "stream_multicapture.py",
    "scriptArgs": {
+        "max_batch_size": 8,
+        "max_batch_wait": 0.5,
+        "max_grab_workers": 8,
+        "persistent_sessions": false,
+        "queue_size": 25,
+        "queue_policy": "drop_oldest",
         "args": [
             {
                 "name": "",
@@ -43,7 +62,10 @@ example
                 "selected_gpu": null,
                 "save_images": false,
                 "scale_factor": 1,
-                "roi_id": 5
+                "roi_id": 5,
+                "loi_id": 2,
+                "tracking": true,
+                "detect_every": 3
             },
             {
                 "name": "",
@@ -94,7 +116,10 @@ args_schema = [
     ('selected_gpu', False, 0),
     ('save_images', False, False),
     ('scale_factor', False, 1.0),
-    ('save_every', False, None)
+    ('save_every', False, None),
+    ('loi_id', False, None),
+    ('tracking', False, False),
+    ('detect_every', False, 1)
 ]
 
 
@@ -104,6 +129,20 @@ def main():
     pg.connect()
     args = job.get_array_or_fail(args_schema, 'args')
     name = job.get_or_fail('name')
+    max_batch_size = job.get_or_default('max_batch_size', MAX_BATCH_SIZE)
+    max_batch_wait = job.get_or_default('max_batch_wait', MAX_BATCH_WAIT)
+    max_grab_workers = job.get_or_default(
+        'max_grab_workers', MAX_GRAB_WORKERS)
+    persistent_sessions = job.get_or_default('persistent_sessions', False)
+    queue_size = job.get_or_default('queue_size', DEFAULT_QUEUE_SIZE)
+    queue_policy = job.get_or_default('queue_policy', POLICY_DROP_OLDEST)
+    # use the networks of the model server job instead of loading copies
+    model_server = job.get_or_default('model_server', False)
+    # 'eager', 'fp16', 'bf16', 'torchscript' or 'onnx' (cpu)
+    inference_backend = job.get_or_default('inference_backend', BACKEND_EAGER)
+    # seconds of updates that are posted together as a list, off by default
+    callback_batch_window = job.get_or_default('callback_batch_window', None)
+    get_publisher(batch_window=callback_batch_window)
     job_id = job.get_job_id()
     new = store.insert_multicapture_stream_if_not_exists(name, job_id)
     multi_capture = store.get_multi_capture_by_job_id_as_dict(job_id)
@@ -118,85 +157,74 @@ def main():
         store.insert_camera_multicapture_link_if_not_exists(
             camera.id, multi_capture['id'])
 
+        # the lines tracked objects are counted on
+        stream_args['loi_points'] = None
+        if stream_args['loi_id']:
+            stream_loi = store.get_stream_loi_by_id(stream_args['loi_id'])
+            if stream_loi is None:
+                print('Line of interest does not exist, exiting...!')
+                sys.exit(1)
+
+            stream_args['loi_points'] = stream_loi.polygons
+
     model = store.get_model_by_id(args[0]['model'])
     network = store.get_neural_network_by_id(model.neural_network_id)
     neural_network_type = store.get_nn_type_by_id(network.nn_type_id)
 
-    set_selected_gpu(args[0].get('selected_gpu'), args[0].get('cuda'))
-
-    cuda_net = get_network(
-        network.train_script,
-        cuda=args[0]['cuda'],
-        model_path=model.path)
-
-    def get_area_points(stream_index):
-        roi_id = args[stream_index].get('roi_id')
-        if not roi_id:
-            return None
-
-        stream_roi = store.get_stream_roi_by_id(roi_id)
-        if stream_roi is None:
-            print('Stream roi does not exist, exiting...!')
-            stop_multistream()
-            raise Exception('Stream roi does not exist')
-
-        camera = store.get_camera_by_id(stream_roi.camera_id)
-        if camera is None:
-            print('Camera does not exist yet, exiting...!')
-            stop_multistream()
-            raise Exception('Camera does not exist yet')
+    def load_network(model, cuda, selected_gpu):
+        set_selected_gpu(selected_gpu, cuda)
+        load = get_shared_network if model_server else get_network
+        return get_inference_network(
+            load(network.name, cuda, model.path, selected_gpu),
+            inference_backend,
+            model.path)
 
-        if camera.stream_url != args[stream_index].get('stream'):
-            print('Region of interest belongs to a different stream, exiting...!')
-            stop_multistream()
-            raise Exception('Region of interest belongs to a different stream')
-
-        roi = store.get_stream_roi_by_id(roi_id)
-        if roi is None:
-            print("Selected roi does not exist")
-            stop_multistream()
-            raise Exception('Selected roi does not exist')
-
-        return roi.polygons
+    # models, networks and rois are resolved once per stream, networks are
+    # shared by the streams that use the same model
+    resources = StreamResources(args, load_network)
 
     # function to swap models
     def get_model(stream_index):
         set_selected_gpu(
             args[stream_index].get('selected_gpu'),
             args[stream_index].get('cuda'))
-        model_id = args[stream_index]['model']
-        model = store.get_model_by_id(model_id)
-        cuda = args[stream_index]['cuda']
+        return resources.get_model(stream_index)
 
-        nn = get_network(
-            network.name,
-            cuda,
-            model.path,
-            args[stream_index].get('selected_gpu')
-        )
+    # load the network of the first stream before the streams start
+    get_model(0)
 
-        return nn
+    # callback fields that do not change, looked up once per stream
+    stream_metadata = {}
 
-    def predict_callback_handler(payload, stream, model_name, stream_index):
-        try:
-            model_id = args[stream_index]['model']
-            model = store.get_model_by_id(model_id)
+    def get_stream_metadata(stream_index, stream):
+        if stream_index not in stream_metadata:
+            model = resources.get_model_row(stream_index)
             network = store.get_neural_network_by_id(model.neural_network_id)
             neural_network_type = store.get_nn_type_by_id(network.nn_type_id)
+            metadata = {
+                'network_type': neural_network_type.name,
+                'network': network.train_script
+            }
+            camera = store.get_camera_by_stream_url(stream)
+
+            if camera.area_size_m2:
+                metadata['area_size_m2'] = float(camera.area_size_m2)
+
+            stream_metadata[stream_index] = metadata
+
+        return stream_metadata[stream_index]
+
+    def predict_callback_handler(payload, stream, model_name, stream_index):
+        try:
             callback_urls = args[stream_index].get('callback_urls')
             publish_data = {
                 'stream_url': stream,
-                'network_type': neural_network_type.name,
-                'network': network.train_script,
                 'payload': payload,
                 'model': model_name,
                 'stream_name': name,
-                'event_name': 'UPDATE'
+                'event_name': 'UPDATE',
+                **get_stream_metadata(stream_index, stream)
             }
-            camera = store.get_camera_by_stream_url(stream)
-
-            if camera.area_size_m2:
-                publish_data['area_size_m2'] = float(camera.area_size_m2)
 
             publish_callback(callback_urls, publish_data)
 
@@ -207,10 +235,17 @@ def main():
         args,
         standard_transform,
         get_model,
-        get_area_points=get_area_points,
+        get_area_points=resources.get_area_points,
         on_predict_callback=predict_callback_handler,
-        neural_network_type=neural_network_type.name
+        neural_network_type=neural_network_type.name,
+        max_batch_size=max_batch_size,
+        max_batch_wait=max_batch_wait,
+        max_grab_workers=max_grab_workers,
+        persistent_sessions=persistent_sessions,
+        queue_size=queue_size,
+        queue_policy=queue_policy
     )
+    resources.report()
 
 
 sys.exit(main())